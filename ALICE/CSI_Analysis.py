@@ -0,0 +1,335 @@
+import argparse
+import mmap
+import multiprocessing
+import os
+import re
+import sys
+import time
+import types
+
+import numpy as np
+
+import CSI_Gating
+import CSI_Log
+import CSI_Python_Parser
+import CSI_Read_File
+
+CHUNK_BYTES = 8 << 20  # most log bytes one worker decodes at a time
+MIN_CHUNK_BYTES = 256 << 10  # smaller logs are not split
+CHUNKS_PER_WORKER = 4  # split so every worker gets a few chunks, for an even load
+SKIP_SUFFIXES = (CSI_Log.INDEX_SUFFIX, ".npy", ".npz", ".json", ".jsonl")
+
+# set by analyze_logs before the pool is forked: the workers inherit the mapped logs and the
+# shared output arrays, so only chunk numbers go to them and only small counts come back
+_logs = []
+
+
+class LogAnalysis:
+    """
+    Everything analyze_logs found in one log file. data, headers and gated are in log order; data
+    is shared with the worker processes that decoded it, so nothing was copied back.
+    """
+
+    def __init__(self, file_name, log, headers, max_streams, max_tones):
+        """
+        :param file_name: name of the log file
+        :param log: CSI_Log.CSILog of the file, its records already found
+        :param headers: structured array of the record headers, from read_headers
+        :param max_streams: nr * nc of the largest config in the log
+        :param max_tones: num_tones of the largest config in the log
+        """
+        self.file_name = file_name
+        self.log = log
+        self.offsets = log.offsets
+        self.headers = headers
+        count = len(headers)
+        self.data = _shared_array((count, max_streams, max_tones), np.complex64)
+        self.gated = _shared_array(count, np.bool_)
+        self.stats = {
+            "packets": count,
+            "bytes": int(os.path.getsize(file_name)),
+            "with_csi": 0,
+            "pings": 0,
+            "gated": 0,
+            "chunks": 0,
+        }
+
+
+def _shared_array(shape, dtype):
+    # zero filled array in anonymous shared memory, written by forked workers and seen by the parent
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if nbytes == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.frombuffer(mmap.mmap(-1, nbytes), dtype=dtype).reshape(shape)
+
+
+def list_logs(paths):
+    """
+    :param paths: log files and directories of log files
+    :return: list of log file names; the files of a directory in name order, with rotated logs
+             (log, log.1, log.2, ...) in the order they were written and index/store files left out
+    """
+
+    def natural(name):
+        return [
+            int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)
+        ]
+
+    file_names = []
+    for path in paths:
+        if not os.path.isdir(path):
+            file_names.append(path)
+            continue
+        for name in sorted(os.listdir(path), key=natural):
+            file_name = os.path.join(path, name)
+            if os.path.isfile(file_name) and not name.endswith(SKIP_SUFFIXES):
+                file_names.append(file_name)
+    return file_names
+
+
+def split_records(offsets, chunk_bytes):
+    """
+    Split a log at record boundaries into chunks of about chunk_bytes
+    :param offsets: record byte offsets, from find_records
+    :param chunk_bytes: log bytes per chunk
+    :return: list of (first record, end record) of every chunk, in log order
+    """
+    if len(offsets) == 0:
+        return []
+    # first record at or past every chunk_bytes mark
+    marks = np.arange(int(offsets[0]), int(offsets[-1]) + 1, chunk_bytes)
+    bounds = np.unique(np.searchsorted(offsets, marks))
+    bounds = np.append(bounds, len(offsets))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def _analyze_chunk(task):
+    """
+    Decode and gate one chunk of a log, writing the CSI and the gate decisions in place
+    :param task: (log number in _logs, first record, end record)
+    :return: task and a dict of counts for the chunk
+    """
+    log_num, first, end = task
+    analysis, gate = _logs[log_num]
+    headers = analysis.headers[first:end]
+    data = CSI_Read_File.decode_records(
+        analysis.log.raw, analysis.offsets[first:end], headers
+    )
+    streams, tones = data.shape[1:]
+    analysis.data[first:end, :streams, :tones] = data
+
+    counts = {"with_csi": int(np.count_nonzero(headers["csi_len"] > 0))}
+    pings = np.flatnonzero(
+        (headers["payload_len"] == CSI_Python_Parser.PING_PAYLOAD_SIZE)
+        & (headers["csi_len"] > 0)
+    )
+    counts["pings"] = len(pings)
+    gated = 0
+    if gate is not None:
+        # the gate looks at one packet at a time, like Alice does live
+        packet = types.SimpleNamespace()
+        for i in pings:
+            header = headers[i]
+            for name in ("nr", "rssi_0", "rssi_1", "rssi_2"):
+                setattr(packet, name, int(header[name]))
+            streams = packet.nr * int(header["nc"])
+            packet.data = data[i, :streams, : int(header["num_tones"])]
+            if gate(packet):
+                analysis.gated[first + i] = True
+                gated += 1
+    counts["gated"] = gated
+    return task, counts
+
+
+def analyze_logs(paths, workers=None, gate=None, chunk_bytes=None, use_index=False):
+    """
+    Decode (and optionally gate) many CSI logs with a pool of worker processes. Every log is split
+    at record boundaries, so one large log keeps all workers busy as well as many small ones do.
+    Workers are forked and write straight into shared arrays, no decoded CSI is pickled.
+    :param paths: log files and directories of log files, see list_logs
+    :param workers: number of worker processes, None for one per CPU, 1 to decode in this process
+    :param gate: CSI_Gating.CSIGate to run over the ping packets, None to only decode
+    :param chunk_bytes: log bytes per chunk, None to pick from the total size and workers
+    :param use_index: keep and use the sidecar index of every log (see CSI_Log), so later runs do
+                      not walk the records again
+    :return: list of LogAnalysis, one per log in the order given
+    """
+    global _logs
+
+    workers = workers or os.cpu_count() or 1
+    analyses = []
+    for file_name in list_logs(paths):
+        log = CSI_Log.CSILog(file_name, use_index=use_index)
+        headers = CSI_Read_File.read_headers(log.raw, log.offsets, log.header_dtype)
+        has_csi = headers["csi_len"] > 0
+        max_streams = int(
+            (headers["nr"][has_csi] * headers["nc"][has_csi]).max(initial=0)
+        )
+        max_tones = int(headers["num_tones"][has_csi].max(initial=0))
+        analyses.append(LogAnalysis(file_name, log, headers, max_streams, max_tones))
+
+    if chunk_bytes is None:
+        total = sum(analysis.stats["bytes"] for analysis in analyses)
+        chunk_bytes = total // (workers * CHUNKS_PER_WORKER)
+        chunk_bytes = max(MIN_CHUNK_BYTES, min(CHUNK_BYTES, chunk_bytes))
+    tasks = [
+        (log_num, first, end)
+        for log_num, analysis in enumerate(analyses)
+        for first, end in split_records(analysis.offsets, chunk_bytes)
+    ]
+
+    _logs = [(analysis, gate) for analysis in analyses]
+    try:
+        if workers == 1 or len(tasks) <= 1:
+            _merge(analyses, map(_analyze_chunk, tasks))
+        else:
+            # fork, so the workers share the maps and output arrays instead of getting copies
+            context = multiprocessing.get_context("fork")
+            with context.Pool(min(workers, len(tasks))) as pool:
+                _merge(analyses, pool.imap(_analyze_chunk, tasks))
+    finally:
+        _logs = []
+    return analyses
+
+
+def _merge(analyses, results):
+    # add up the counts of every chunk, results come in task order
+    for (log_num, _, _), counts in results:
+        stats = analyses[log_num].stats
+        stats["chunks"] += 1
+        for name, value in counts.items():
+            stats[name] += value
+
+
+def print_analysis(analyses, elapsed):
+    """
+    Print the counts of every log and in total
+    :param analyses: list of LogAnalysis
+    :param elapsed: seconds the analysis took
+    :return:
+    """
+    total = dict.fromkeys(("packets", "bytes", "with_csi", "pings", "gated"), 0)
+    for analysis in analyses:
+        stats = analysis.stats
+        for name in total:
+            total[name] += stats[name]
+        shape = "x".join(str(size) for size in analysis.data.shape[1:])
+        print(
+            "%s: %d packets, %d with CSI, %d pings, %d gated (CSI %s, %d chunks)"
+            % (
+                analysis.file_name,
+                stats["packets"],
+                stats["with_csi"],
+                stats["pings"],
+                stats["gated"],
+                shape,
+                stats["chunks"],
+            )
+        )
+    print(
+        "Total: %d logs, %d packets, %d with CSI, %d pings, %d gated"
+        % (
+            len(analyses),
+            total["packets"],
+            total["with_csi"],
+            total["pings"],
+            total["gated"],
+        )
+    )
+    if elapsed > 0:
+        print(
+            "%.2f seconds, %.0f packets/s, %.1f MB/s"
+            % (elapsed, total["packets"] / elapsed, total["bytes"] / elapsed / 1e6)
+        )
+
+
+def save_analysis(analyses, out_dir):
+    """
+    Save the decoded CSI, headers and gate decisions of every log as .npy files
+    :param analyses: list of LogAnalysis
+    :param out_dir: directory to write NAME.csi.npy, NAME.headers.npy and NAME.gated.npy to
+    :return:
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for analysis in analyses:
+        name = os.path.join(out_dir, os.path.basename(analysis.file_name))
+        np.save(name + ".csi.npy", analysis.data)
+        np.save(name + ".headers.npy", analysis.headers)
+        np.save(name + ".gated.npy", analysis.gated)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Decode and gate CSI logs in parallel, whole directories or single large logs"
+    )
+    parser.add_argument("logs", nargs="+", help="log files or directories of log files")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="worker processes (default one per CPU, 1 for none)",
+    )
+    parser.add_argument(
+        "--chunk-mb",
+        type=float,
+        default=None,
+        help="log MB every worker decodes at a time (default from the log sizes, at most %d)"
+        % (CHUNK_BYTES >> 20),
+    )
+    parser.add_argument(
+        "--gate",
+        type=CSI_Gating.parse_criterion,
+        action="append",
+        metavar="NAME=THRESHOLD",
+        help="gate the ping packets like Alice does, can be given more than once (default range=%d)"
+        % CSI_Python_Parser.DB_THRESHOLD,
+    )
+    parser.add_argument(
+        "--gate-combine",
+        type=CSI_Gating.parse_combine,
+        default="all",
+        help="streams that have to pass: all, any or a number of streams",
+    )
+    parser.add_argument(
+        "--gate-streams",
+        type=CSI_Gating.parse_streams,
+        default=(0, 1),
+        help="comma separated streams the gate looks at, or all (default 0,1)",
+    )
+    parser.add_argument(
+        "--no-gate", action="store_true", help="only decode, do not gate"
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="keep a sidecar index next to every log so later runs open it faster",
+    )
+    parser.add_argument(
+        "--save", metavar="DIR", help="save the decoded CSI, headers and gating as .npy"
+    )
+    args = parser.parse_args()
+
+    gate = None
+    if not args.no_gate:
+        if args.gate is None:
+            args.gate = [(CSI_Gating.db_range, CSI_Python_Parser.DB_THRESHOLD)]
+        gate = CSI_Gating.CSIGate(args.gate, args.gate_combine, args.gate_streams)
+    chunk_bytes = None if args.chunk_mb is None else int(args.chunk_mb * (1 << 20))
+
+    start = time.monotonic()
+    try:
+        analyses = analyze_logs(args.logs, args.workers, gate, chunk_bytes, args.index)
+    except IOError as error:
+        print("Couldn't open file!", error.filename)
+        sys.exit(1)
+    elapsed = time.monotonic() - start
+    if not analyses:
+        print("No log files found")
+        sys.exit(1)
+    print_analysis(analyses, elapsed)
+    if args.save is not None:
+        save_analysis(analyses, args.save)
+
+
+if __name__ == "__main__":
+    main()
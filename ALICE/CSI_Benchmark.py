@@ -0,0 +1,353 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import CSI_Device_Sim
+import CSI_Gating
+import CSI_Key
+import CSI_Log_Writer
+import CSI_Metrics
+import CSI_Python_Parser
+import CSI_Read_File
+import CSI_Sender
+
+CONFIGS = ("1x1x56", "2x2x56", "3x3x114")  # nr x nc x num_tones
+# next to this script, wherever it is run from; never committed, the numbers only hold on one host
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json"
+)
+# fraction a benchmark may be slower than the baseline before it is a regression; reruns on a quiet
+# machine still differ by up to 30% on the fastest benchmarks
+TOLERANCE = 0.5
+MIN_TIME = 0.2  # seconds every timing run lasts at least
+REPEAT = 7  # timing runs per benchmark, the fastest one counts
+LOG_PACKETS = 2000  # packets in the log parse_info reads
+END_TO_END_SECONDS = 2.0
+
+
+def parse_config(config):
+    """
+    :param config: "NRxNCxNUM_TONES", e.g. "2x2x56"
+    :return: (nr, nc, num_tones)
+    """
+    nr, nc, num_tones = (int(value) for value in config.split("x"))
+    return nr, nc, num_tones
+
+
+def time_call(func, repeat=REPEAT, min_time=MIN_TIME):
+    """
+    Time a function without arguments, timeit style
+    :param func: function to time
+    :param repeat: number of timing runs, the fastest counts
+    :param min_time: seconds every timing run lasts at least
+    :return: seconds per call
+    """
+    # find how many calls make up one timing run
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return best / loops
+
+
+def bench_hot_path(nr, nc, num_tones):
+    """
+    :return: dict of benchmark name to seconds per packet for record_status, record_CSI_data and
+             process_CSI/gating of one packet
+    """
+    buff = CSI_Device_Sim.synth_buffers(nr, nc, num_tones, variety=1, seed=0)[0]
+    cnt = len(buff)
+    csi_object = CSI_Python_Parser.record_status(buff, cnt)
+    csi_object.data = CSI_Python_Parser.record_CSI_data(buff, nr, nc, num_tones, False)
+    gate = CSI_Gating.CSIGate(
+        [(CSI_Gating.db_range, CSI_Python_Parser.DB_THRESHOLD)], "all", (0, 1)
+    )
+    every_criterion = CSI_Gating.CSIGate(
+        [(criterion, 30) for criterion in CSI_Gating.CRITERIA.values()], "any"
+    )
+
+    return {
+        "record_status": time_call(lambda: CSI_Python_Parser.record_status(buff, cnt)),
+        "record_CSI_data": time_call(
+            lambda: CSI_Python_Parser.record_CSI_data(buff, nr, nc, num_tones, False)
+        ),
+        "process_CSI": time_call(
+            lambda: CSI_Python_Parser.process_CSI(
+                csi_object.data, CSI_Python_Parser.DB_THRESHOLD
+            )
+        ),
+        "gate_default": time_call(lambda: gate(csi_object)),
+        "gate_every_criterion": time_call(lambda: every_criterion(csi_object)),
+    }
+
+
+def write_log(file_name, nr, nc, num_tones, packets=LOG_PACKETS):
+    """
+    Write a binary log of synthesized packets
+    """
+    buffers = CSI_Device_Sim.synth_buffers(nr, nc, num_tones, seed=0)
+    now = time.time()
+    with open(file_name, "wb") as log_file:
+        CSI_Python_Parser.start_file(log_file)
+        for i in range(packets):
+            buff = buffers[i % len(buffers)]
+            buf_len = len(buff) - 2
+            CSI_Python_Parser.to_file(
+                log_file, buff[:buf_len], buf_len, now + i * 0.001
+            )
+
+
+def bench_parse(nr, nc, num_tones, tmp_dir):
+    """
+    :return: dict of benchmark name to seconds per logged packet for parse_info and parse_info_bulk
+    """
+    file_name = os.path.join(tmp_dir, "bench_%dx%dx%d.log" % (nr, nc, num_tones))
+    write_log(file_name, nr, nc, num_tones)
+    return {
+        "parse_info": time_call(lambda: CSI_Read_File.parse_info(file_name), repeat=3)
+        / LOG_PACKETS,
+        "parse_info_bulk": time_call(
+            lambda: CSI_Read_File.parse_info_bulk(file_name), repeat=3
+        )
+        / LOG_PACKETS,
+    }
+
+
+def _flood(write_fd, buffers, stop):
+    # separate process, so the sender does not compete with the receive loop for the GIL
+    i = 0
+    while not stop.is_set():
+        try:
+            os.write(write_fd, buffers[i % len(buffers)])
+            i += 1
+        except BlockingIOError:
+            time.sleep(0)  # pipe is full, Alice is behind
+        except BrokenPipeError:
+            return
+
+
+def bench_end_to_end(nr, nc, num_tones, tmp_dir, seconds=END_TO_END_SECONDS):
+    """
+    Run Alice's receive loop (CSI_Python_Parser.PacketHandler: read, status, decode, gate, queue
+    the chunk to send, metrics) against a simulated device that is always full, on its own, while
+    logging and while extracting key bits
+    :param tmp_dir: directory for the log
+    :return: dict with the seconds per packet of every variant
+    """
+    read_fd, write_fd = CSI_Device_Sim.open_pipe()
+    buffers = CSI_Device_Sim.synth_buffers(nr, nc, num_tones, seed=0)
+    stop = multiprocessing.Event()
+    flood = multiprocessing.Process(target=_flood, args=(write_fd, buffers, stop))
+    flood.start()
+
+    # the receiving end only discards, so sending costs what it costs Alice
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sink.setblocking(False)
+
+    def run_handler(log=None, key_extractor=None, key_file=None):
+        sender = CSI_Sender.CSISender(
+            bytes(CSI_Python_Parser.PACKET_SIZE * 64),
+            [sink.getsockname()],
+            payload_end="wrap",
+        )
+        gate = CSI_Gating.CSIGate(
+            [(CSI_Gating.db_range, CSI_Python_Parser.DB_THRESHOLD)], "all", (0, 1)
+        )
+        handler = CSI_Python_Parser.PacketHandler(
+            gate,
+            sender,
+            CSI_Metrics.Metrics(),
+            log,
+            key_extractor=key_extractor,
+            key_file=key_file,
+        )
+        start = time.perf_counter()
+        packets = handler.receive_loop(read_fd, seconds)
+        elapsed = time.perf_counter() - start
+        sender.close()
+        return elapsed / max(packets, 1)
+
+    timings = {"end_to_end": run_handler()}
+    log = CSI_Log_Writer.CSILogWriter(
+        os.path.join(tmp_dir, "end_to_end_%dx%dx%d.log" % (nr, nc, num_tones))
+    )
+    timings["end_to_end_log"] = run_handler(log)
+    log.close()
+    with open(os.devnull, "wb") as key_file:
+        timings["end_to_end_key"] = run_handler(
+            key_extractor=CSI_Key.KeyExtractor(), key_file=key_file
+        )
+
+    stop.set()
+    os.close(read_fd)
+    flood.join()
+    os.close(write_fd)
+    sink.close()
+    return timings
+
+
+def run(configs, end_to_end=True, parse=True):
+    """
+    Run every benchmark for every config
+    :param configs: list of "NRxNCxNUM_TONES"
+    :return: results dict, see main
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for config in configs:
+            nr, nc, num_tones = parse_config(config)
+            timings = bench_hot_path(nr, nc, num_tones)
+            if parse:
+                timings.update(bench_parse(nr, nc, num_tones, tmp_dir))
+            if end_to_end:
+                timings.update(bench_end_to_end(nr, nc, num_tones, tmp_dir))
+            for name, seconds in timings.items():
+                results["%s/%s" % (name, config)] = {
+                    "us_per_packet": seconds * 1000000,
+                    "packets_per_second": 1 / seconds,
+                }
+    return {
+        "time": datetime.datetime.now().isoformat(),
+        "host": socket.gethostname(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+
+
+def compare(current, baseline, tolerance=TOLERANCE):
+    """
+    Compare results against a baseline run
+    :param current: results dict from run
+    :param baseline: results dict from an earlier run
+    :param tolerance: fraction a benchmark may be slower before it counts as a regression
+    :return: list of (benchmark, baseline us, current us, ratio) for every regression
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["us_per_packet"]
+        ratio = result["us_per_packet"] / before
+        if ratio > 1 + tolerance:
+            regressions.append((name, before, result["us_per_packet"], ratio))
+    return regressions
+
+
+def print_results(current, baseline=None):
+    for name, result in current["results"].items():
+        line = "%-34s %12.2f us %14.0f packets/s" % (
+            name,
+            result["us_per_packet"],
+            result["packets_per_second"],
+        )
+        if baseline is not None and name in baseline["results"]:
+            ratio = result["us_per_packet"] / baseline["results"][name]["us_per_packet"]
+            line += "   x%.2f of baseline" % ratio
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark Alice's parse/decide/send path"
+    )
+    parser.add_argument(
+        "--configs",
+        default=",".join(CONFIGS),
+        help="comma separated NRxNCxNUM_TONES configs (default %s)" % ",".join(CONFIGS),
+    )
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument(
+        "--baseline",
+        default=BASELINE_FILE,
+        help="compare against this JSON file if it exists (default %s)" % BASELINE_FILE,
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=TOLERANCE,
+        help="fraction slower than the baseline that counts as a regression (default %.2f)"
+        % TOLERANCE,
+    )
+    parser.add_argument(
+        "--no-end-to-end", action="store_true", help="skip the end to end benchmark"
+    )
+    parser.add_argument(
+        "--no-parse", action="store_true", help="skip the log parsing benchmarks"
+    )
+    args = parser.parse_args()
+
+    current = run(
+        args.configs.split(","),
+        end_to_end=not args.no_end_to_end,
+        parse=not args.no_parse,
+    )
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("host") != current["host"]:
+            print(
+                "Not comparing, %s was saved on %s, not on %s"
+                % (
+                    args.baseline,
+                    baseline.get("host", "an unknown host"),
+                    current["host"],
+                )
+            )
+            baseline = None
+    print_results(current, baseline)
+
+    if args.out is not None:
+        with open(args.out, "w") as out_file:
+            json.dump(current, out_file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(current, baseline_file, indent=2)
+        print("Saved baseline", args.baseline)
+        return
+
+    if baseline is not None:
+        regressions = compare(current, baseline, args.tolerance)
+        for name, before, after, ratio in regressions:
+            print(
+                "REGRESSION %s: %.2f us -> %.2f us (x%.2f)"
+                % (name, before, after, ratio)
+            )
+        if regressions:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+import argparse
+import threading
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+import CSI_Gating
+import CSI_Log
+import CSI_Plot
+import CSI_Python_Parser
+import CSI_Read_File
+
+HISTORY = 256  # packets the waterfall scrolls through
+FPS = 30.0  # frames per second the dashboard redraws at most
+COLOURMAP = "viridis"  # of the waterfall
+FOLLOW_POLL = 0.05  # seconds between looks for records appended to a followed log
+BATCH = 64  # packets read from the source at a time
+PACE_STEP = 0.01  # seconds between the pieces a replay hands out, well under a frame
+
+
+def dB_colours(dB, colourmap=COLOURMAP):
+    """
+    Colour dB magnitudes like the waterfall does, so the reader thread does it once per packet
+    instead of matplotlib once per frame for the whole waterfall
+    :param dB: dB magnitudes of any shape, nan for none
+    :param colourmap: matplotlib colour map name
+    :return: uint8 RGBA shaped dB.shape + (4,), transparent where dB is nan
+    """
+    table = (plt.get_cmap(colourmap)(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+    low, high = CSI_Plot.DB_LIMITS
+    scaled = (dB - low) * (255 / (high - low))
+    index = np.clip(np.nan_to_num(scaled), 0, 255).astype(np.uint8)
+    colours = table[index]
+    colours[np.isnan(dB)] = 0
+    return colours
+
+
+class CSIFeed:
+    """
+    Reads CSI batches from a source in a background thread and keeps only what the dashboard
+    shows: a ring of the coloured dB magnitudes of one stream for the waterfall and the newest
+    packet. The reader never waits for the dashboard, frames are skipped instead of packets.
+    """
+
+    def __init__(self, batches, history=HISTORY, stream=0):
+        """
+        :param batches: iterator of (complex CSI shaped (packets, streams, tones), headers), e.g.
+                        from CSI_Read_File.iter_csi
+        :param history: packets in the waterfall
+        :param stream: stream the waterfall shows
+        """
+        self.batches = batches
+        self.history = history
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.ring = None  # (history, tones, 4) RGBA, row next is overwritten next
+        self.next = 0
+        self.latest = None  # CSI of the newest packet, (streams, tones)
+        self.packets = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._read, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def alive(self):
+        return self.thread.is_alive()
+
+    def _read(self):
+        try:
+            for data, headers in self.batches:
+                data = data[headers["csi_len"] > 0]
+                if len(data) == 0:
+                    continue
+                # colours of the waterfall stream only, outside the lock
+                stream = min(self.stream, data.shape[1] - 1)
+                dB = CSI_Gating.dB_per_array(data[-self.history :, stream], np.float32)
+                rows = dB_colours(dB)
+                with self.lock:
+                    if self.ring is None or self.ring.shape[1] != rows.shape[1]:
+                        self.ring = np.zeros((self.history, rows.shape[1], 4), np.uint8)
+                        self.next = 0
+                    for row in rows:  # at most history rows
+                        self.ring[self.next] = row
+                        self.next = (self.next + 1) % self.history
+                    self.latest = data[-1]
+                    self.packets += len(data)
+        except Exception as error:
+            self.error = error
+
+    def snapshot(self):
+        """
+        :return: (waterfall RGBA shaped (history, tones, 4) newest row first, CSI of the newest
+                 packet, packets read), None for the first two before the first packet
+        """
+        with self.lock:
+            if self.ring is None:
+                return None, None, self.packets
+            order = (self.next - 1 - np.arange(self.history)) % self.history
+            return self.ring[order], self.latest.copy(), self.packets
+
+
+class CSIDashboard:
+    """
+    One figure with a scrolling per sub-carrier dB waterfall, stems of the dB magnitudes of the
+    newest packet and its I/Q constellation. All artists are made once and only get new data every
+    frame; frames are drawn by blitting them over a saved background instead of redrawing the
+    figure.
+    """
+
+    def __init__(self, num_streams, num_tones, history=HISTORY, stream=0, fig=None):
+        """
+        :param num_streams: streams (nr * nc) of the CSI shown
+        :param num_tones: sub-carriers of the CSI shown
+        :param history: packets in the waterfall
+        :param stream: stream the waterfall shows
+        :param fig: figure to draw in, a new one if None
+        """
+        self.fig = fig if fig is not None else plt.figure(figsize=(12, 7))
+        self.background = None
+        self.frames = 0
+        self.frame_times = None  # (first, newest) time a frame was blitted
+        self.fig.canvas.mpl_connect("draw_event", self._on_draw)
+        self.layout(num_streams, num_tones, history, stream)
+
+    def layout(self, num_streams, num_tones, history=HISTORY, stream=0):
+        """
+        Make the axes and artists for CSI of this shape, again when the shape changes
+        """
+        self.fig.clear()
+        self.shape = (num_streams, num_tones)
+        self.history = history
+        self.stream = stream
+        freqs = CSI_Plot.tone_frequencies(num_tones)
+        grid = self.fig.add_gridspec(2, 2, width_ratios=(3, 2))
+        colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+        stream_colors = [colors[i % len(colors)] for i in range(num_streams)]
+
+        ax = self.fig.add_subplot(grid[:, 0])
+        ax.set_title("stream %d, newest packet on top" % stream)
+        ax.set_xlabel("MHz")
+        ax.set_ylabel("packets ago")
+        half = CSI_Plot.TONE_SPACING / 2
+        self.waterfall = ax.imshow(
+            np.zeros((history, num_tones, 4), np.uint8),
+            cmap=COLOURMAP,
+            aspect="auto",
+            interpolation="none",
+            origin="upper",
+            extent=(freqs[0] - half, freqs[-1] + half, history, 0),
+            vmin=CSI_Plot.DB_LIMITS[0],
+            vmax=CSI_Plot.DB_LIMITS[1],
+            animated=True,
+        )
+        # the image gets colours from the feed, the colour bar shows what they mean
+        self.fig.colorbar(self.waterfall, ax=ax, label="dB")
+
+        ax = self.fig.add_subplot(grid[0, 1])
+        CSI_Plot.setup_stem_axes(ax, freqs)
+        # streams side by side around every tone so their stems do not cover each other
+        offsets = (np.arange(num_streams) - (num_streams - 1) / 2) * (
+            CSI_Plot.TONE_SPACING / (num_streams + 1)
+        )
+        self.stem_x = freqs + offsets[:, np.newaxis]  # (streams, tones)
+        self.stems = [
+            ax.plot([], [], color=color, animated=True)[0] for color in stream_colors
+        ]
+        self.heads = [
+            ax.plot([], [], "o", markersize=3, color=color, animated=True)[0]
+            for color in stream_colors
+        ]
+
+        ax = self.fig.add_subplot(grid[1, 1])
+        CSI_Plot.setup_complex_axes(ax)
+        ax.set_aspect("equal")
+        self.points = [
+            ax.plot([], [], ".", color=color, label=str(i), animated=True)[0]
+            for i, color in enumerate(stream_colors)
+        ]
+        ax.legend(handles=self.points, loc="lower left", fontsize="small")
+
+        self.status = self.fig.text(0.01, 0.01, "", animated=True)
+        self.artists = [self.waterfall, self.status]
+        self.artists += self.stems + self.heads + self.points
+        self.fig.canvas.draw()  # saves the background through _on_draw
+
+    def _on_draw(self, event):
+        # the figure was drawn in full (first time, resize): keep it without the animated artists
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            self.fig.draw_artist(artist)
+
+    def update(self, waterfall, data, status=""):
+        """
+        Give the artists new data and blit them
+        :param waterfall: RGBA shaped (history, tones, 4), newest packet first
+        :param data: complex CSI of the newest packet shaped (streams, tones)
+        :param status: text for the bottom left corner
+        :return:
+        """
+        if data.shape != self.shape:
+            self.layout(data.shape[0], data.shape[1], self.history, self.stream)
+        self.waterfall.set_data(waterfall)
+
+        dB = CSI_Gating.dB_per_array(data, np.float32)
+        dB = np.nan_to_num(dB, nan=CSI_Plot.DB_LIMITS[0])
+        for stream, head in enumerate(self.heads):
+            self.stems[stream].set_data(
+                *CSI_Plot.stem_path(self.stem_x[stream], dB[stream])
+            )
+            head.set_data(self.stem_x[stream], dB[stream])
+            self.points[stream].set_data(data[stream].real, data[stream].imag)
+        self.status.set_text(status)
+
+        if self.background is None:
+            return
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        self._draw_artists()
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+        self.frames += 1
+        now = time.monotonic()
+        self.frame_times = (now if self.frames == 1 else self.frame_times[0], now)
+
+    def frame_rate(self):
+        """
+        :return: frames per second blitted since the first frame
+        """
+        if self.frames < 2:
+            return 0.0
+        return (self.frames - 1) / (self.frame_times[1] - self.frame_times[0])
+
+
+def run_dashboard(feed, history=HISTORY, stream=0, fps=FPS, seconds=None):
+    """
+    Show the dashboard until its window is closed, the feed ends or seconds pass
+    :param feed: CSIFeed, started here
+    :param history: packets in the waterfall
+    :param stream: stream the waterfall shows
+    :param fps: frames per second to draw at most
+    :param seconds: stop after this many seconds, None for no limit
+    :return: CSIDashboard, None if no packet came in
+    """
+    feed.start()
+    dashboard = None
+    started = time.monotonic()
+    frame_time = 1.0 / fps
+    next_frame = started
+    last_packets = -1
+    while seconds is None or time.monotonic() - started < seconds:
+        waterfall, data, packets = feed.snapshot()
+        if data is not None and packets != last_packets:
+            if dashboard is None:
+                dashboard = CSIDashboard(data.shape[0], data.shape[1], history, stream)
+                plt.show(block=False)
+            status = "%d packets, %.0f frames/s" % (packets, dashboard.frame_rate())
+            dashboard.update(waterfall, data, status)
+            last_packets = packets
+        if dashboard is not None and not plt.fignum_exists(dashboard.fig.number):
+            break  # window closed
+        if not feed.alive() and last_packets == feed.packets:
+            break  # source ended and its last packet is shown
+        # keep to the frame times, a late frame does not move the ones after it
+        next_frame = max(next_frame + frame_time, time.monotonic() - frame_time)
+        pause = next_frame - time.monotonic()
+        if pause > 0:
+            if dashboard is not None:
+                dashboard.fig.canvas.start_event_loop(pause)
+            else:
+                time.sleep(pause)
+    if feed.error is not None:
+        print("Reading CSI failed:", feed.error)
+    return dashboard
+
+
+def paced(batches, speed, step=PACE_STEP):
+    """
+    Hand out the batches of a log as fast as they were logged, in pieces of at most step seconds
+    so a slow replay still changes every frame
+    :param batches: iterator of (data, headers) of a log
+    :param speed: play this many times faster, 0 for as fast as possible
+    :param step: seconds of replay per piece
+    :return: generator of (data, headers)
+    """
+    start = None
+    for data, headers in batches:
+        if speed <= 0:
+            yield data, headers
+            continue
+        times = CSI_Read_File.header_times(headers)
+        if start is None:
+            start = (time.monotonic(), times[0])
+        # seconds after the start every packet is due
+        due = (times - start[1]) / np.timedelta64(1, "s") / speed
+        cuts = np.flatnonzero(np.diff(np.floor(due / step))) + 1
+        for first, end in zip(np.append(0, cuts), np.append(cuts, len(due))):
+            pause = start[0] + due[end - 1] - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            yield data[first:end], headers[first:end]
+
+
+def follow_log(file_name, poll=FOLLOW_POLL):
+    """
+    Hand out the records of a log while it is being written, e.g. by Alice
+    :param file_name: log file
+    :param poll: seconds between looks for new records
+    :return: endless generator of (data, headers) of the new records
+    """
+    log = CSI_Log.CSILog(file_name)
+    seen = 0
+    while True:
+        if log.refresh() > seen:
+            offsets = log.offsets[seen:]
+            headers = CSI_Read_File.read_headers(log.raw, offsets, log.header_dtype)
+            seen = len(log)
+            yield CSI_Read_File.decode_records(log.raw, offsets, headers), headers
+        else:
+            time.sleep(poll)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Live CSI dashboard: dB waterfall, stems and I/Q constellation"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--device", help="read a CSI device (not while Alice reads it)")
+    source.add_argument("--log", help="replay a log")
+    source.add_argument(
+        "--follow", help="show the records of a log as they are written"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="replay this many times faster, 0 as fast as possible",
+    )
+    parser.add_argument("--stream", type=int, default=0, help="stream of the waterfall")
+    parser.add_argument(
+        "--history", type=int, default=HISTORY, help="packets in the waterfall"
+    )
+    parser.add_argument("--fps", type=float, default=FPS, help="frames per second")
+    parser.add_argument(
+        "--seconds", type=float, default=None, help="close after this many seconds"
+    )
+    args = parser.parse_args()
+
+    if args.device is not None:
+        fd = CSI_Python_Parser.open_csi_device(args.device)
+        batches = CSI_Read_File.iter_csi(fd, BATCH, max_wait=0.5 / args.fps)
+    elif args.log is not None:
+        batches = paced(CSI_Read_File.iter_csi(args.log, BATCH), args.speed)
+    else:
+        batches = follow_log(args.follow)
+
+    feed = CSIFeed(batches, args.history, args.stream)
+    try:
+        dashboard = run_dashboard(
+            feed, args.history, args.stream, args.fps, args.seconds
+        )
+    except KeyboardInterrupt:
+        dashboard = None
+    if dashboard is not None:
+        print(
+            "Frames drawn: %d (%.1f frames/s), packets: %d"
+            % (dashboard.frames, dashboard.frame_rate(), feed.packets)
+        )
+        if args.seconds is None:
+            plt.show()  # the source ended, keep its last packet up until the window is closed
+
+
+if __name__ == "__main__":
+    main()
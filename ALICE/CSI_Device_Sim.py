@@ -0,0 +1,428 @@
+import argparse
+import fcntl
+import os
+import signal
+import stat
+import struct
+import threading
+import time
+
+import numpy as np
+
+import CSI_Log
+import CSI_Python_Parser
+
+DEFAULT_FIFO = "/tmp/CSI_dev"  # FIFO Alice reads with --device
+DEFAULT_RATE = 1000.0  # packets per second
+# packets the FIFO holds, later packets are dropped like CSI_dev does
+QUEUE_PACKETS = 256
+SPIN_TIME = 0.0002  # seconds before a packet is due the sender stops sleeping and spins
+VARIETY = 64  # distinct synthesized packets, sent round robin
+# coherence times of a fading channel before the round robin repeats
+FADING_PERIODS = 32
+
+SUBCARRIER_SPACING = 312500.0  # Hz
+MAX_DELAY = 200e-9  # seconds, longest multipath delay of a synthesized channel
+PEAK_MAGNITUDE = 300.0  # largest CSI magnitude of a synthesized packet (10 bit values)
+NOISE_STD = 3.0  # noise added to every synthesized CSI value
+
+
+def pack_CSI_bits(values):
+    """
+    Pack signed 10 bit values the way the CSI kernel module does, inverse of unpack_CSI_bits
+    :param values: integer numpy array of values between -512 and 511
+    :return: bytes, 5 bytes for every 4 values (last group cut short)
+    """
+    n_values = len(values)
+    n_groups = (n_values + 3) // 4
+    bits = CSI_Python_Parser.BIT_RESOLUTION
+    fields = np.zeros(n_groups * 4, dtype=np.uint64)
+    fields[:n_values] = np.asarray(values, dtype=np.int64) & ((1 << bits) - 1)
+
+    shifts = np.arange(4, dtype=np.uint64) * np.uint64(bits)
+    words = (fields.reshape(n_groups, 4) << shifts).sum(axis=1, dtype=np.uint64)
+    groups = (words[:, np.newaxis] >> (np.arange(5, dtype=np.uint64) * 8)) & 0xFF
+    packed = groups.astype(np.uint8).tobytes()
+    return packed[: (n_values * bits + 7) // 8]
+
+
+def synth_channel(nr, nc, num_tones, rng):
+    """
+    Random multipath channel with noise
+    :return: complex array shaped (nr * nc, num_tones), row nc_idx * nr + nr_idx
+    """
+    tones = np.arange(num_tones) - num_tones // 2
+    n_paths = 3
+    delays = rng.uniform(0, MAX_DELAY, (nr * nc, n_paths, 1))
+    gains = rng.exponential(1.0, (nr * nc, n_paths, 1)) * np.exp(
+        2j * np.pi * rng.random((nr * nc, n_paths, 1))
+    )
+    data = (gains * np.exp(-2j * np.pi * SUBCARRIER_SPACING * tones * delays)).sum(
+        axis=1
+    )
+    data *= PEAK_MAGNITUDE / np.abs(data).max()
+    return data + rng.normal(0, NOISE_STD, data.shape) * (1 + 1j)
+
+
+def fading_channels(nr, nc, num_tones, coherence, rng):
+    """
+    A fading channel: it moves smoothly from one random multipath channel to the next every
+    coherence packets and is measured with fresh noise every packet
+    :return: endless generator of complex arrays shaped (nr * nc, num_tones), one per packet
+    """
+    start = synth_channel(nr, nc, num_tones, rng)
+    end = synth_channel(nr, nc, num_tones, rng)
+    step = 0
+    while True:
+        if step == coherence:
+            start, end = end, synth_channel(nr, nc, num_tones, rng)
+            step = 0
+        weight = 0.5 - 0.5 * np.cos(np.pi * step / coherence)
+        noise = rng.normal(0, NOISE_STD, (2, nr * nc, num_tones))
+        yield (1 - weight) * start + weight * end + noise[0] + 1j * noise[1]
+        step += 1
+
+
+def make_buffer(data, nr, nc, payload, rssi=(40, 40, 40), channel=2437):
+    """
+    Lay out one packet the way a read of CSI_dev returns it: CSI status, packed CSI, payload and
+    buf_len in the last 2 bytes
+    :param data: complex CSI shaped (nr * nc, num_tones)
+    :param nr: number of receiving antennae
+    :param nc: number of transmitting antennae
+    :param payload: payload bytes of the packet
+    :param rssi: RSSI of the three receive antennae
+    :param channel: channel frequency in MHz
+    :return: bytearray
+    """
+    num_tones = data.shape[1]
+    # values are ordered tone -> transmitter -> receiver -> (imag, real)
+    values = np.empty((num_tones, nr * nc, 2))
+    values[..., 0] = data.T.imag
+    values[..., 1] = data.T.real
+    values = np.clip(np.rint(values), -512, 511).astype(np.int64).ravel()
+    csi = pack_CSI_bits(values)
+
+    status = CSI_Python_Parser.CSI_STATUS_STRUCT.pack(
+        0,  # tfs_stamp, set when the packet is sent
+        len(csi),
+        channel,
+        0,  # phyerr
+        0,  # noise
+        0,  # rate
+        1 if num_tones > 56 else 0,  # chan_bw
+        num_tones,
+        nr,
+        nc,
+        max(rssi),
+        rssi[0],
+        rssi[1],
+        rssi[2],
+        len(payload),
+    )
+    buf_len = len(status) + len(csi) + len(payload)
+    return bytearray(status + csi + payload + struct.pack("=H", buf_len))
+
+
+def set_sequence(buff, seq):
+    """
+    Number a packet like the 802.11 sequence control of its frame, so Alice can tell which packets
+    were dropped (see CSI_Python_Parser.DeviceDrops)
+    :param buff: buffer from make_buffer
+    :param seq: packet number
+    :return:
+    """
+    csi_len = CSI_Python_Parser.TWO_BYTE_STRUCT.unpack_from(
+        buff, CSI_Python_Parser.CSI_LEN_OFFSET
+    )[0]
+    payload_start = CSI_Python_Parser.CSI_STATUS_STRUCT.size + csi_len
+    offset = payload_start + CSI_Python_Parser.SEQ_CTRL_OFFSET
+    if offset + 2 <= len(buff) - 2:  # payload long enough to hold a MAC header
+        CSI_Python_Parser.SEQ_CTRL_STRUCT.pack_into(
+            buff, offset, (seq % CSI_Python_Parser.SEQ_MODULO) << 4
+        )
+
+
+def synth_buffers(
+    nr,
+    nc,
+    num_tones,
+    payload_len=CSI_Python_Parser.PING_PAYLOAD_SIZE,
+    variety=VARIETY,
+    seed=None,
+    coherence=None,
+):
+    """
+    :param nr: number of receiving antennae
+    :param nc: number of transmitting antennae
+    :param num_tones: number of sub-carriers
+    :param payload_len: payload length, PING_PAYLOAD_SIZE makes Alice decode and gate the CSI
+    :param variety: number of distinct packets to make
+    :param seed: random seed
+    :param coherence: packets a fading channel takes to change (see fading_channels), None for
+                      an unrelated random channel in every packet
+    :return: list of buffers
+    """
+    rng = np.random.default_rng(seed)
+    payload = bytes(payload_len)
+    fading = None
+    if coherence is not None:
+        fading = fading_channels(nr, nc, num_tones, coherence, rng)
+    buffers = []
+    for _ in range(variety):
+        rssi = tuple(int(value) for value in rng.integers(30, 50, 3))
+        if fading is None:
+            data = synth_channel(nr, nc, num_tones, rng)
+        else:
+            data = next(fading)
+        buffers.append(make_buffer(data, nr, nc, payload, rssi))
+    return buffers
+
+
+def log_buffers(log_file_name):
+    """
+    Read back the buffers of a log the way CSI_dev returned them
+    :param log_file_name: log written by Alice (any format)
+    :return: (list of buffers, numpy array of seconds each packet came after the first)
+    """
+    with CSI_Log.CSILog(log_file_name) as log:
+        prefix_len = CSI_Python_Parser.log_prefix_len(log.header_dtype)
+        raw = log.raw
+        buffers = []
+        for entry in log.index:
+            start = int(entry["offset"]) + prefix_len
+            buf_len = int(entry["buf_len"])
+            buffers.append(
+                bytearray(raw[start : start + buf_len].tobytes())
+                + struct.pack("=H", buf_len)
+            )
+        times = log.time_stamps - log.time_stamps[:1]
+        del raw
+    return buffers, times.astype(np.int64) / 1000000.0
+
+
+def open_fifo(path=DEFAULT_FIFO, queue_packets=QUEUE_PACKETS):
+    """
+    Create the FIFO Alice reads from and open it for writing, waits until Alice opens it.
+    The FIFO is put in packet mode, so every read returns exactly one packet like CSI_dev does.
+    :param path: path of the FIFO, created if needed
+    :param queue_packets: packets the FIFO holds before new packets are dropped
+    :return: file descriptor to pass to CSIDeviceSim.run
+    """
+    if not os.path.exists(path):
+        os.mkfifo(path)
+    elif not stat.S_ISFIFO(os.stat(path).st_mode):
+        raise ValueError(path + " exists and is not a FIFO")
+
+    fd = os.open(path, os.O_WRONLY)
+    _packet_mode(fd, queue_packets)
+    return fd
+
+
+def open_pipe(queue_packets=QUEUE_PACKETS):
+    """
+    Simulated device within one process, e.g. for benchmarks
+    :param queue_packets: packets the pipe holds before new packets are dropped
+    :return: (fd to read like CSI_dev, fd to pass to CSIDeviceSim.run)
+    """
+    read_fd, write_fd = os.pipe2(os.O_DIRECT)
+    os.set_blocking(read_fd, False)
+    _packet_mode(write_fd, queue_packets)
+    return read_fd, write_fd
+
+
+def _packet_mode(fd, queue_packets):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_DIRECT)
+    os.set_blocking(fd, False)
+    # every packet takes up one page of the pipe
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, queue_packets * os.sysconf("SC_PAGE_SIZE"))
+    except PermissionError:
+        pass  # larger than /proc/sys/fs/pipe-max-size, keep the default size
+
+
+class CSIDeviceSim:
+    """
+    Stands in for CSI_dev: writes packets in the kernel buffer layout to a FIFO or pipe at a given
+    rate, with optional jitter. Packets are either synthesized (synth_buffers) or replayed from a
+    log (log_buffers), at a fixed rate or with the spacing they were logged with.
+    """
+
+    def __init__(
+        self, buffers, rate=DEFAULT_RATE, jitter=0.0, count=None, times=None, seed=None
+    ):
+        """
+        :param buffers: list of buffers to send, sent round robin
+        :param rate: packets per second, None to keep the spacing in times
+        :param jitter: standard deviation of the send time of every packet, seconds
+        :param count: packets to send, None to send each buffer once (replay) or forever (rate)
+        :param times: seconds after the first packet each buffer was logged, used when rate is None
+        :param seed: random seed for the jitter
+        """
+        if rate is None and times is None:
+            raise ValueError("either a rate or the logged times are needed")
+        self.buffers = buffers
+        self.rate = rate
+        self.jitter = jitter
+        self.count = count
+        self.times = times
+        self.rng = np.random.default_rng(seed)
+
+        self.sent = 0
+        self.dropped = 0  # packets the reader did not keep up with
+        self.max_late = 0.0  # most seconds a packet was sent after it was due
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _schedule(self):
+        # (due time in seconds after the start, buffer)
+        n_buffers = len(self.buffers)
+        if self.rate is None:
+            period = self.times[-1] + (self.times[-1] / max(n_buffers - 1, 1))
+        i = 0
+        while self.count is None or i < self.count:
+            if self.rate is not None:
+                due = i / self.rate
+            else:
+                due = (i // n_buffers) * period + self.times[i % n_buffers]
+            yield due, self.buffers[i % n_buffers]
+            i += 1
+            if self.count is None and self.rate is None and i == n_buffers:
+                return
+
+    def run(self, fd, speed=1.0):
+        """
+        Send packets until count is reached or stop is called
+        :param fd: write end from open_fifo or open_pipe
+        :param speed: play the schedule this many times faster
+        :return:
+        """
+        start = time.perf_counter()
+        tfs_base = int(time.time() * 1000000)
+        seq = 0
+        for due, buff in self._schedule():
+            if self.stopped.is_set():
+                break
+            due /= speed
+            if self.jitter > 0:
+                due += self.rng.normal(0, self.jitter)
+
+            delay = start + due - time.perf_counter()
+            if delay > SPIN_TIME:
+                time.sleep(delay - SPIN_TIME)
+            while start + due > time.perf_counter():
+                pass
+            self.max_late = max(self.max_late, time.perf_counter() - start - due)
+
+            # tfs_stamp in microseconds, the first 8 bytes of the status
+            struct.pack_into("=Q", buff, 0, tfs_base + int(due * 1000000))
+            set_sequence(buff, seq)
+            seq += 1
+            try:
+                os.write(fd, buff)
+                self.sent += 1
+            except BlockingIOError:
+                self.dropped += 1
+            except BrokenPipeError:
+                break  # reader went away
+
+    def start(self, fd, speed=1.0):
+        """
+        Run in a background thread
+        :return:
+        """
+        self.thread = threading.Thread(target=self.run, args=(fd, speed), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulated CSI_dev: run Alice with --device FIFO to read from it"
+    )
+    parser.add_argument("--fifo", default=DEFAULT_FIFO, help="FIFO to create and write")
+    parser.add_argument("--replay", help="log file to replay instead of synthesizing")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="packets per second (default %d; a replay keeps its logged spacing)"
+        % DEFAULT_RATE,
+    )
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="play this many times faster"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="send time jitter, seconds (std dev)"
+    )
+    parser.add_argument(
+        "--count", type=int, default=None, help="packets to send (default no limit)"
+    )
+    parser.add_argument("--nr", type=int, default=2, help="receiving antennae")
+    parser.add_argument("--nc", type=int, default=2, help="transmitting antennae")
+    parser.add_argument("--num-tones", type=int, default=56, help="sub-carriers")
+    parser.add_argument(
+        "--payload-len",
+        type=int,
+        default=CSI_Python_Parser.PING_PAYLOAD_SIZE,
+        help="payload length of synthesized packets",
+    )
+    parser.add_argument(
+        "--queue",
+        type=int,
+        default=QUEUE_PACKETS,
+        help="packets the FIFO holds before packets are dropped",
+    )
+    parser.add_argument(
+        "--coherence",
+        type=int,
+        default=None,
+        help="synthesize a fading channel that changes over this many packets instead of an "
+        "unrelated one per packet (for CSI_Key.py)",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    args = parser.parse_args()
+
+    times = None
+    if args.replay is not None:
+        buffers, times = log_buffers(args.replay)
+        if len(buffers) == 0:
+            print("No packets in", args.replay)
+            return
+    else:
+        if args.rate is None:
+            args.rate = DEFAULT_RATE
+        variety = VARIETY
+        if args.coherence is not None:
+            variety = max(VARIETY, FADING_PERIODS * args.coherence)
+        buffers = synth_buffers(
+            args.nr,
+            args.nc,
+            args.num_tones,
+            args.payload_len,
+            variety,
+            args.seed,
+            args.coherence,
+        )
+
+    sim = CSIDeviceSim(buffers, args.rate, args.jitter, args.count, times, args.seed)
+    # stop on SIGINT even when started in the background, where it is ignored by default
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    print("Waiting for a reader on", args.fifo)
+    fd = open_fifo(args.fifo, args.queue)
+    print("Sending")
+    try:
+        sim.run(fd, args.speed)
+    except KeyboardInterrupt:
+        pass
+    os.close(fd)
+    print("Packets sent:", sim.sent, "dropped:", sim.dropped)
+    print("Most a packet was late: %.6f seconds" % sim.max_late)
+
+
+if __name__ == "__main__":
+    main()
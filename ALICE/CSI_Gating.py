@@ -0,0 +1,177 @@
+import numpy as np
+
+SPREAD_PERCENTILES = (10, 90)  # percentiles the spread criterion compares
+
+
+def dB_per_array(npArray, dtype=None):
+    """
+    :param npArray: complex numpy array of any shape
+    :param dtype: float dtype of the result, e.g. np.float32 for half the memory; None for float64
+    :return: 20 * log10(abs(x)) of every element, nan for zero magnitude tones instead of -inf
+    """
+    mag = np.abs(npArray)
+    with np.errstate(divide="ignore"):
+        dB_array = 20 * np.log10(mag, dtype=dtype)
+    dB_array[mag == 0] = np.nan
+    return dB_array
+
+
+# Every criterion takes the decoded CSI of the selected streams shaped (streams, tones), the
+# csi_object of the packet, a threshold and the index in the packet of every selected stream, and
+# returns one boolean per selected stream. Zero magnitude tones are left out of the dB statistics;
+# a stream without any non-zero tone never passes.
+
+
+def db_range(data, csi_object, threshold, streams):
+    """
+    :return: per stream, max - min dB over the tones is at most threshold
+    """
+    mag = np.abs(data)
+    peak = mag.max(axis=-1)
+    floor = np.where(mag > 0, mag, np.inf).min(axis=-1)
+    # log is monotonic, so the dB range is the dB of the max / min magnitude ratio
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (floor <= peak) & (20 * np.log10(peak / floor) <= threshold)
+
+
+def db_variance(data, csi_object, threshold, streams):
+    """
+    :return: per stream, variance of the tones in dB is at most threshold (dB^2)
+    """
+    dB_array = dB_per_array(data)
+    valid = ~np.isnan(dB_array)
+    count = valid.sum(axis=-1)
+    dB_array[~valid] = 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = dB_array.sum(axis=-1) / count
+        dev = np.where(valid, dB_array - mean[..., None], 0)
+        variance = (dev * dev).sum(axis=-1) / count
+    return variance <= threshold
+
+
+def _percentile(sorted_dB, count, q):
+    # linear interpolation like np.percentile, sorted_dB has the nan tones at the end of each row
+    pos = (count - 1) * (q / 100.0)
+    low = np.clip(np.floor(pos).astype(np.intp), 0, None)
+    high = np.clip(np.ceil(pos).astype(np.intp), 0, None)
+    frac = pos - np.floor(pos)
+    rows = np.arange(len(count))
+    return sorted_dB[rows, low] * (1 - frac) + sorted_dB[rows, high] * frac
+
+
+def db_spread(data, csi_object, threshold, streams, percentiles=SPREAD_PERCENTILES):
+    """
+    Like db_range but ignores the outlying tones
+    :return: per stream, dB difference between the two percentiles is at most threshold
+    """
+    sorted_dB = np.sort(dB_per_array(data), axis=-1)  # nan sorts last
+    count = np.count_nonzero(~np.isnan(sorted_dB), axis=-1)
+    low, high = percentiles
+    with np.errstate(invalid="ignore"):
+        spread = _percentile(sorted_dB, count, high) - _percentile(
+            sorted_dB, count, low
+        )
+        return spread <= threshold
+
+
+def rssi(data, csi_object, threshold, streams):
+    """
+    :return: per stream, RSSI of the receive antenna of the stream is at least threshold; never
+             for a packet without receive antennae
+    """
+    if csi_object.nr == 0:
+        return np.zeros(len(streams), dtype=bool)
+    antenna_rssi = np.array((csi_object.rssi_0, csi_object.rssi_1, csi_object.rssi_2))
+    # streams are ordered nc_idx * nr + nr_idx, so stream % nr is the receive antenna
+    return antenna_rssi[np.asarray(streams) % csi_object.nr] >= threshold
+
+
+CRITERIA = {
+    "range": db_range,
+    "variance": db_variance,
+    "spread": db_spread,
+    "rssi": rssi,
+}
+
+
+def parse_criterion(text):
+    """
+    Parse a command line criterion like "range=20"
+    :param text: NAME=THRESHOLD with NAME one of CRITERIA
+    :return: (criterion function, threshold)
+    """
+    name, _, threshold = text.partition("=")
+    if name not in CRITERIA or not threshold:
+        raise ValueError(
+            "criterion must be NAME=THRESHOLD, NAME one of " + ", ".join(CRITERIA)
+        )
+    return CRITERIA[name], float(threshold)
+
+
+def parse_combine(text):
+    """
+    :param text: "all", "any" or a number of streams
+    :return: "all", "any" or an int
+    """
+    if text in ("all", "any"):
+        return text
+    return int(text)
+
+
+def parse_streams(text):
+    """
+    :param text: "all" or comma separated stream indices like "0,1"
+    :return: tuple of stream indices, None for all
+    """
+    if text == "all":
+        return None
+    return tuple(int(stream) for stream in text.split(","))
+
+
+class CSIGate:
+    """
+    Decides if the CSI of a packet is good enough to act on. A stream passes when it passes every
+    criterion, the streams are then combined: all of them, any of them or at least a number of them.
+    """
+
+    def __init__(self, criteria, combine="all", streams=None):
+        """
+        :param criteria: list of (criterion function, threshold), see CRITERIA
+        :param combine: "all", "any", or an int for at least that many streams
+        :param streams: stream indices to look at, None for all; indices the packet does not have
+                        are left out
+        """
+        self.criteria = list(criteria)
+        self.combine = combine
+        self.streams = None if streams is None else np.array(streams, dtype=np.intp)
+
+    def stream_flags(self, csi_object):
+        """
+        :param csi_object: packet with decoded CSI in csi_object.data
+        :return: boolean per selected stream
+        """
+        data = csi_object.data
+        if self.streams is None:
+            streams = np.arange(len(data))
+        else:
+            streams = self.streams[self.streams < len(data)]
+            data = data[streams]
+
+        flags = np.ones(len(data), dtype=bool)
+        for criterion, threshold in self.criteria:
+            flags &= criterion(data, csi_object, threshold, streams)
+        return flags
+
+    def __call__(self, csi_object):
+        """
+        :param csi_object: packet with decoded CSI in csi_object.data
+        :return: True if the packet passes the gate
+        """
+        flags = self.stream_flags(csi_object)
+        if len(flags) == 0:
+            return False
+        if self.combine == "all":
+            return bool(flags.all())
+        if self.combine == "any":
+            return bool(flags.any())
+        return int(np.count_nonzero(flags)) >= self.combine
@@ -0,0 +1,422 @@
+import argparse
+import time
+
+import numpy as np
+
+import CSI_Device_Sim
+import CSI_Gating
+import CSI_Python_Parser
+import CSI_Read_File
+
+WINDOW = 64  # packets the quantization thresholds of every subcarrier adapt over
+HOP = 16  # new packets between key blocks, the window slides on by this many
+LEVELS = 4  # quantization levels per subcarrier, a power of 2 (2 bits each)
+GUARD = 0.2  # fraction of every level, next to its edges, that is dropped as too close to call
+RECONCILIATION_EFFICIENCY = 1.2  # bits leaked per bit of h2(mismatch) when correcting
+SYNTH_COHERENCE = 32  # packets a synthesized channel takes to fade into the next
+
+
+def h2(p):
+    """
+    :param p: probability, scalar or numpy array
+    :return: binary entropy of p in bits
+    """
+    p = np.clip(p, 1e-12, 1 - 1e-12)
+    return -(p * np.log2(p) + (1 - p) * np.log2(1 - p))
+
+
+def gray_bits(levels):
+    """
+    :param levels: number of quantization levels, a power of 2
+    :return: uint8 array shaped (levels, bits), the Gray code of every level, so neighbouring
+             levels differ in one bit
+    """
+    n_bits = max(1, int(levels).bit_length() - 1)
+    codes = np.arange(levels) ^ (np.arange(levels) >> 1)
+    shifts = np.arange(n_bits - 1, -1, -1)
+    return ((codes[:, np.newaxis] >> shifts) & 1).astype(np.uint8)
+
+
+def quantize(values, window, levels=LEVELS, guard=GUARD):
+    """
+    Quantize every subcarrier against its own distribution over a window of packets: the levels
+    are equally likely ranges of its values in the window (found from the rank of the value among
+    them), values in the guard band next to a level edge are dropped
+    :param values: float array shaped (packets, ...) of dB values to quantize, nan for no CSI
+    :param window: float array shaped (window packets, ...) of dB values the thresholds come from
+    :param levels: number of levels
+    :param guard: fraction of every level next to its inner edges that is dropped
+    :return: (level of every value, int array like values; True where the value is kept)
+    """
+    valid = ~np.isnan(values)
+    count = np.count_nonzero(~np.isnan(window), axis=0)
+    # window values below every value, comparisons with nan are False so those do not count
+    ranks = (window < values[:, np.newaxis]).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        position = (ranks + 0.5) / count * levels
+    level = np.clip(np.floor(np.nan_to_num(position)), 0, levels - 1).astype(np.intp)
+    frac = position - level
+
+    half_guard = guard / 2
+    keep = valid & (count > 1)
+    keep &= ~((frac < half_guard) & (level > 0))
+    keep &= ~((frac > 1 - half_guard) & (level < levels - 1))
+    return level, keep
+
+
+def disagreement(bits_a, bits_b, keep):
+    """
+    :param bits_a: bit array of one side
+    :param bits_b: bit array of the other side, same shape
+    :param keep: True where both sides kept the bit
+    :return: fraction of the kept bits that differ, 0 if none are kept
+    """
+    n_kept = np.count_nonzero(keep)
+    if n_kept == 0:
+        return 0.0
+    return np.count_nonzero((bits_a != bits_b) & keep) / n_kept
+
+
+def toeplitz_hash(bits, out_len, seed_bits):
+    """
+    Privacy amplification: multiply the bits by a random Toeplitz matrix over GF(2), a 2-universal
+    hash. The product is a convolution, so it is done with FFTs instead of building the matrix.
+    :param bits: uint8 array of 0/1, the reconciled raw key
+    :param out_len: length of the key to make
+    :param seed_bits: uint8 array of len(bits) + out_len - 1 public random bits, the first
+                      column and row of the matrix
+    :return: uint8 array of out_len bits
+    """
+    n_bits = len(bits)
+    if out_len <= 0 or n_bits == 0:
+        return np.zeros(0, dtype=np.uint8)
+    size = n_bits + len(seed_bits) - 1
+    product = np.fft.irfft(np.fft.rfft(bits, size) * np.fft.rfft(seed_bits, size), size)
+    # row i of the matrix is seed_bits[i : i + n_bits] reversed
+    sums = np.rint(product[n_bits - 1 : n_bits - 1 + out_len]).astype(np.int64)
+    return (sums & 1).astype(np.uint8)
+
+
+class KeyExtractor:
+    """
+    Secret key bits from the reciprocity of the channel: both ends measure the same channel within
+    a coherence time, so quantizing their CSI gives nearly the same bits, which someone elsewhere
+    can not measure. CSI goes in packet by packet or in batches; every HOP packets (about the
+    coherence time, so the bits of one block do not just repeat the last) the thresholds of every
+    subcarrier are found over the last WINDOW packets, the newest packets are quantized and a key
+    block is made.
+
+    Only Alice's CSI is here, so the last two packets stand in for the two ends: the newer one is
+    the other end's measurement. Their mismatch estimates the bit disagreement a reconciliation
+    code has to correct (and leaks), the change since the last block beyond that mismatch
+    estimates how much of each bit is new. What is left after both is hashed out of the raw bits.
+    """
+
+    def __init__(
+        self,
+        window=WINDOW,
+        hop=HOP,
+        levels=LEVELS,
+        guard=GUARD,
+        streams=None,
+        tone_step=1,
+        seed=0,
+        efficiency=RECONCILIATION_EFFICIENCY,
+    ):
+        """
+        :param window: packets the thresholds adapt over
+        :param hop: new packets per key block, at least 2 and at most window
+        :param levels: quantization levels per subcarrier, a power of 2
+        :param guard: fraction of every level next to its edges that is dropped
+        :param streams: stream indices to use, None for all
+        :param tone_step: use every tone_step-th tone, neighbouring tones are strongly correlated
+        :param seed: seed of the public Toeplitz matrices, both ends have to use the same
+        :param efficiency: bits leaked by reconciliation per bit of h2(disagreement)
+        """
+        if levels & (levels - 1) or levels < 2:
+            raise ValueError("levels must be a power of 2")
+        if not 2 <= hop <= window:
+            raise ValueError("hop must be between 2 and window")
+        self.window = window
+        self.hop = hop
+        self.levels = levels
+        self.guard = guard
+        self.streams = None if streams is None else np.array(streams, dtype=np.intp)
+        self.tone_step = tone_step
+        self.seed = seed
+        self.efficiency = efficiency
+        self.gray = gray_bits(levels)
+
+        # dB magnitudes of the last window packets, a ring; nan until filled, which the
+        # quantization leaves out like tones without CSI
+        self.history = None
+        self.next = 0  # ring slot the next packet goes to
+        self.new = 0  # packets since the last key block
+        self.last = None  # bits and kept bits of the last key block
+
+        self.packets = 0
+        self.blocks = 0
+        self.raw_bits = 0  # bits the pairs agreed to keep
+        self.key_bits = 0
+        self.mismatches = 0  # estimated disagreeing bits over all blocks
+        self.seconds = 0.0  # time spent in add
+        self.started = time.monotonic()
+
+    def add_packet(self, data):
+        """
+        :param data: decoded CSI of one packet shaped (streams, tones)
+        :return: list of key blocks (bytes) made with this packet, usually empty
+        """
+        return self.add(data[np.newaxis])
+
+    def add(self, data):
+        """
+        :param data: decoded CSI shaped (packets, streams, tones)
+        :return: list of key blocks (bytes) made with these packets
+        """
+        start = time.perf_counter()
+        if self.streams is not None:
+            data = data[:, self.streams[self.streams < data.shape[1]]]
+        if self.tone_step > 1:
+            data = data[:, :, :: self.tone_step]
+        dB = CSI_Gating.dB_per_array(data, np.float32)
+
+        if self.history is None or self.history.shape[1:] != dB.shape[1:]:
+            # first packets, or the antenna/tone config changed: start over
+            self.history = np.full((self.window,) + dB.shape[1:], np.nan, np.float32)
+            self.next = 0
+            self.new = 0
+            self.last = None
+
+        blocks = []
+        while len(dB) > 0:
+            room = min(len(dB), self.hop - self.new, self.window - self.next)
+            self.history[self.next : self.next + room] = dB[:room]
+            dB = dB[room:]
+            self.next = (self.next + room) % self.window
+            self.new += room
+            self.packets += room
+            if self.new == self.hop:
+                self.new = 0
+                block = self._key_block()
+                if block is not None:
+                    blocks.append(block)
+        self.seconds += time.perf_counter() - start
+        return blocks
+
+    def _key_block(self):
+        """
+        Quantize the newest pair of packets against the window and hash what is left of its bits
+        into a key block
+        :return: key block as bytes, None if nothing is left
+        """
+        pair = self.history[
+            [(self.next - 2) % self.window, (self.next - 1) % self.window]
+        ]
+        level, keep = quantize(pair, self.history, self.levels, self.guard)
+        # (..., bits), the older packet of the pair is this end, the newer one the other end
+        ours, theirs = self.gray[level[0]], self.gray[level[1]]
+        both_keep = np.broadcast_to((keep[0] & keep[1])[..., np.newaxis], ours.shape)
+
+        mismatch = disagreement(ours, theirs, both_keep)
+        # how often a bit changed since the last block, beyond what the noise explains; nothing
+        # is known to be new in the first block
+        fresh = 0.0
+        if self.last is not None:
+            last_ours, last_keep = self.last
+            change = disagreement(ours, last_ours, both_keep & last_keep)
+            fresh = h2(min(max(change - mismatch, 0.0), 0.5))
+        self.last = ours, both_keep
+
+        raw = ours[both_keep]
+        n_raw = len(raw)
+        out_len = int(n_raw * (fresh - self.efficiency * h2(mismatch)))
+        seed_bits = np.random.default_rng([self.seed, self.blocks]).integers(
+            0, 2, n_raw + max(out_len, 1) - 1, dtype=np.uint8
+        )
+        key = toeplitz_hash(raw, out_len, seed_bits)
+
+        self.blocks += 1
+        self.raw_bits += n_raw
+        self.mismatches += mismatch * n_raw
+        self.key_bits += len(key)
+        if len(key) == 0:
+            return None
+        return np.packbits(key).tobytes()
+
+    def stats(self):
+        """
+        :return: dict of packets, key blocks, raw and key bits, the mean bit disagreement, seconds
+                 spent extracting and key bits per second since the extractor was made
+        """
+        elapsed = time.monotonic() - self.started
+        return {
+            "packets": self.packets,
+            "blocks": self.blocks,
+            "raw_bits": self.raw_bits,
+            "key_bits": self.key_bits,
+            "disagreement": (
+                float(self.mismatches / self.raw_bits) if self.raw_bits else 0.0
+            ),
+            "seconds": self.seconds,
+            "key_bits_per_second": self.key_bits / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+def synth_csi(
+    nr, nc, num_tones, packets, coherence=SYNTH_COHERENCE, batch=256, seed=None
+):
+    """
+    Synthesized CSI of a fading channel, see CSI_Device_Sim.fading_channels
+    :return: generator of complex64 arrays shaped (packets, nr * nc, num_tones), batch at a time
+    """
+    channels = CSI_Device_Sim.fading_channels(
+        nr, nc, num_tones, coherence, np.random.default_rng(seed)
+    )
+    for first in range(0, packets, batch):
+        count = min(batch, packets - first)
+        data = np.empty((count, nr * nc, num_tones), dtype=np.complex64)
+        for i in range(count):
+            data[i] = next(channels)
+        yield data
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract secret key bits from CSI and measure how fast it keeps up"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--log", help="replay the ping packets of a CSI log")
+    source.add_argument(
+        "--device", help="read a CSI device live, e.g. the FIFO of CSI_Device_Sim.py"
+    )
+    source.add_argument(
+        "--synth", type=int, metavar="PACKETS", help="synthesize this many packets"
+    )
+    parser.add_argument(
+        "--nr", type=int, default=2, help="synthesized receive antennae"
+    )
+    parser.add_argument(
+        "--nc", type=int, default=2, help="synthesized transmit antennae"
+    )
+    parser.add_argument("--num-tones", type=int, default=56, help="synthesized tones")
+    parser.add_argument(
+        "--coherence",
+        type=int,
+        default=SYNTH_COHERENCE,
+        help="packets a synthesized channel lasts (default %d)" % SYNTH_COHERENCE,
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=CSI_Device_Sim.DEFAULT_RATE,
+        help="packets per second the key bits/second of synthesized CSI is given for",
+    )
+    parser.add_argument("--window", type=int, default=WINDOW, help="packets per window")
+    parser.add_argument(
+        "--hop", type=int, default=HOP, help="new packets per key block"
+    )
+    parser.add_argument(
+        "--levels", type=int, default=LEVELS, help="quantization levels, a power of 2"
+    )
+    parser.add_argument(
+        "--guard", type=float, default=GUARD, help="fraction of every level dropped"
+    )
+    parser.add_argument(
+        "--streams",
+        type=lambda text: tuple(int(stream) for stream in text.split(",")),
+        default=None,
+        help="comma separated streams to use (default all)",
+    )
+    parser.add_argument("--tone-step", type=int, default=1, help="use every Nth tone")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the hash matrices")
+    parser.add_argument("--key-out", help="append the key blocks to this file")
+    args = parser.parse_args()
+
+    extractor = KeyExtractor(
+        args.window,
+        args.hop,
+        args.levels,
+        args.guard,
+        args.streams,
+        args.tone_step,
+        args.seed,
+    )
+    key_file = open(args.key_out, "ab") if args.key_out is not None else None
+
+    first_time = last_time = None
+    if args.synth is not None:
+        batches = synth_csi(
+            args.nr, args.nc, args.num_tones, args.synth, args.coherence, seed=args.seed
+        )
+    else:
+        source = args.log
+        if args.device is not None:
+            source = CSI_Python_Parser.open_csi_device(args.device)
+            if source is None:
+                print("Couldn't open device: ", args.device)
+                return
+
+        def pings():
+            nonlocal first_time, last_time
+            for data, headers in CSI_Read_File.iter_csi(source):
+                times = CSI_Read_File.header_times(headers)
+                first_time = times[0] if first_time is None else first_time
+                last_time = times[-1]
+                ping = (
+                    headers["payload_len"] == CSI_Python_Parser.PING_PAYLOAD_SIZE
+                ) & (headers["csi_len"] > 0)
+                yield data[ping]
+
+        batches = pings()
+
+    print("Extracting key, CTRL-C to stop" if args.device else "Extracting key")
+    try:
+        for data in batches:
+            for block in extractor.add(data):
+                if key_file is not None:
+                    key_file.write(block)
+    except KeyboardInterrupt:
+        pass
+    if key_file is not None:
+        key_file.close()
+
+    stats = extractor.stats()
+    # see KeyExtractor, there is no other end here to compare with
+    print(
+        "Consecutive packets of %s CSI stand in for the two ends of the link: the disagreement"
+        " and key bits are estimates, not measured between two ends"
+        % ("synthesized" if args.synth is not None else "Alice's own")
+    )
+    print(
+        "Packets: %d, key blocks: %d, raw bits: %d, key bits: %d, disagreement: %.3f"
+        % (
+            stats["packets"],
+            stats["blocks"],
+            stats["raw_bits"],
+            stats["key_bits"],
+            stats["disagreement"],
+        )
+    )
+    if stats["packets"] == 0:
+        return
+    per_packet = stats["key_bits"] / stats["packets"]
+    capacity = stats["packets"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+    print(
+        "Key bits per packet: %.2f, keeps up with %.0f packets/s"
+        % (per_packet, capacity)
+    )
+    if args.synth is not None:
+        print(
+            "Key bits/second at %.0f packets/s: %.1f"
+            % (args.rate, per_packet * args.rate)
+        )
+    else:
+        span = (last_time - first_time) / np.timedelta64(1, "s")
+        if args.device is not None or span <= 0:
+            span = time.monotonic() - extractor.started
+        print("Key bits/second: %.1f" % (stats["key_bits"] / span))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+import mmap
+import os
+
+import numpy as np
+
+import CSI_Python_Parser
+import CSI_Read_File
+
+INDEX_SUFFIX = ".idx"  # sidecar index of a log is log_file_name + INDEX_SUFFIX
+
+# one entry of the sidecar index, stored back to back so new entries can simply be appended
+INDEX_DTYPE = np.dtype(
+    [
+        ("offset", "=i8"),
+        ("buf_len", "=u2"),
+        ("payload_len", "=u2"),
+        ("tfs_stamp", "=u8"),
+        ("time_stamp", "=M8[us]"),
+    ]
+)
+
+
+def index_records(raw, offsets, header_dtype):
+    """
+    Build sidecar index entries for the records at the given offsets
+    :param raw: contents of the log file as a uint8 numpy array
+    :param offsets: record byte offsets from find_records
+    :param header_dtype: header layout of the log, from log_layout
+    :return: numpy array of INDEX_DTYPE
+    """
+    headers = CSI_Read_File.read_headers(raw, offsets, header_dtype)
+    entries = np.empty(len(offsets), dtype=INDEX_DTYPE)
+    entries["offset"] = offsets
+    entries["buf_len"] = headers["buf_len"]
+    entries["payload_len"] = headers["payload_len"]
+    entries["tfs_stamp"] = headers["tfs_stamp"]
+    entries["time_stamp"] = CSI_Read_File.header_times(headers)
+    return entries
+
+
+class CSIRecord:
+    """
+    One record of a CSI log. The header, CSI and payload are memoryview slices of the mapped log
+    file, nothing is copied or decoded until it is asked for.
+    """
+
+    __slots__ = (
+        "offset",
+        "header_dtype",
+        "header_view",
+        "csi_view",
+        "payload_view",
+        "_header",
+        "_data",
+    )
+
+    def __init__(self, view, offset, header_dtype):
+        """
+        :param view: memoryview of the whole mapped log file
+        :param offset: byte offset of the record in the log file
+        :param header_dtype: header layout of the log, from log_layout
+        """
+        self.offset = offset
+        self.header_dtype = header_dtype
+        self._header = None
+        self._data = None
+
+        header_end = offset + header_dtype.itemsize
+        self.header_view = view[offset:header_end]
+
+        csi_end = header_end + self.csi_len
+        self.csi_view = view[header_end:csi_end]
+        self.payload_view = view[csi_end : csi_end + self.payload_len]
+
+    @property
+    def header(self):
+        """
+        :return: numpy record with the header fields, read straight from the map
+        """
+        if self._header is None:
+            self._header = np.frombuffer(self.header_view, dtype=self.header_dtype)[0]
+        return self._header
+
+    @property
+    def time_stamp(self):
+        """
+        :return: seconds since the epoch, or the ASCII time stamp string for older logs
+        """
+        time_stamp = self.header["time_stamp"]
+        if isinstance(time_stamp, bytes):
+            return time_stamp.decode("utf-8")
+        return time_stamp.astype(np.int64) / 1000000.0
+
+    @property
+    def data(self):
+        """
+        Decode the CSI data the first time it is accessed
+        :return: numpy array shaped (nr * nc, num_tones), None if the record has no CSI
+        """
+        if self._data is None and len(self.csi_view) > 0:
+            self._data = CSI_Python_Parser.record_CSI_data(
+                self.csi_view, self.nr, self.nc, self.num_tones, True
+            )
+        return self._data
+
+    def __getattr__(self, name):
+        # every other header field (tfs_stamp, nr, payload_len, ...) comes from the header record
+        if name in CSI_Python_Parser.CSI_STATUS_DTYPE.names or name == "buf_len":
+            return int(self.header[name])
+        raise AttributeError(name)
+
+    def release(self):
+        """
+        Release the memoryview slices so the log file can be unmapped
+        :return:
+        """
+        self.header_view.release()
+        self.csi_view.release()
+        self.payload_view.release()
+
+
+class CSILog:
+    """
+    Memory mapped reader for the log files CSI_Python_Parser.to_file writes. Record boundaries are
+    found from the buf_len prefixes only; records are handed out as CSIRecords.
+    With use_index the record offsets, time stamps and payload lengths are kept in a sidecar index
+    file, so opening the log again only walks the records appended since the index was last updated.
+    """
+
+    def __init__(self, file_name, use_index=False):
+        """
+        :param file_name: name of the log file to map
+        :param use_index: keep the sidecar index file_name + INDEX_SUFFIX up to date and use it
+        """
+        self.file_name = file_name
+        self.index_name = file_name + INDEX_SUFFIX if use_index else None
+        self._file = open(file_name, "rb")
+        self.first_offset, self.header_dtype = CSI_Read_File.log_layout(
+            self._file.read(len(CSI_Python_Parser.LOG_MAGIC))
+        )
+        self._mmap = None
+        self._view = None
+        self._by_payload = None
+        self.index = np.empty(0, dtype=INDEX_DTYPE)
+        if use_index:
+            self.index = self._load_index()
+        self.refresh()
+
+    @property
+    def offsets(self):
+        return self.index["offset"]
+
+    @property
+    def time_stamps(self):
+        return self.index["time_stamp"]
+
+    def refresh(self):
+        """
+        Map the log file again and find its records, picks up records appended since the last call.
+        CSIRecords handed out before keep the old map alive until they are dropped.
+        :return: number of records in the log
+        """
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return 0  # an empty file can not be mapped
+
+        self._view = memoryview(self._mmap)
+
+        # only walk what the index does not cover yet
+        if len(self.index) == 0:
+            self.first_offset, self.header_dtype = CSI_Read_File.log_layout(self._mmap)
+            start = self.first_offset
+        else:
+            last = self.index[-1]
+            prefix_len = CSI_Python_Parser.log_prefix_len(self.header_dtype)
+            start = int(last["offset"]) + prefix_len + int(last["buf_len"])
+
+        offsets = CSI_Read_File.find_records(self._mmap, start)
+        if len(offsets) > 0:
+            entries = index_records(self.raw, offsets, self.header_dtype)
+            self.index = np.concatenate((self.index, entries))
+            self._by_payload = None
+            if self.index_name is not None:
+                with open(self.index_name, "ab") as index_file:
+                    entries.tofile(index_file)
+        return len(self.index)
+
+    def _load_index(self):
+        """
+        Load the sidecar index, it is thrown away and rebuilt if it does not match the log anymore
+        :return: numpy array of INDEX_DTYPE
+        """
+        try:
+            index = np.fromfile(self.index_name, dtype=INDEX_DTYPE)
+            index_size = os.path.getsize(self.index_name)
+        except (IOError, ValueError):
+            index = np.empty(0, dtype=INDEX_DTYPE)
+            index_size = -1
+
+        if len(index) > 0 and not self._index_matches(index[-1]):
+            index = np.empty(0, dtype=INDEX_DTYPE)
+
+        # rewrite the index if it was stale, missing or its last entry was only partly written
+        if index_size != index.nbytes:
+            with open(self.index_name, "wb") as index_file:
+                index.tofile(index_file)
+        return index
+
+    def _index_matches(self, entry):
+        """
+        Check that the last index entry still describes a complete record of the log
+        :param entry: INDEX_DTYPE entry
+        :return: True if the log still has that record
+        """
+        offset = int(entry["offset"])
+        prefix_len = CSI_Python_Parser.log_prefix_len(self.header_dtype)
+        record_end = offset + prefix_len + int(entry["buf_len"])
+        if record_end > os.fstat(self._file.fileno()).st_size:
+            return False
+
+        self._file.seek(offset)
+        header = np.frombuffer(
+            self._file.read(self.header_dtype.itemsize), dtype=self.header_dtype
+        )[0]
+        return (
+            header["buf_len"] == entry["buf_len"]
+            and header["tfs_stamp"] == entry["tfs_stamp"]
+        )
+
+    def between(self, t0, t1):
+        """
+        Find the records received between two wall clock times (binary search, logs are in time
+        order)
+        :param t0: start time (datetime, numpy datetime64 or string), inclusive
+        :param t1: end time (datetime, numpy datetime64 or string), exclusive
+        :return: slice of record numbers, use log[slice] to get the records
+        """
+        time_stamps = self.time_stamps
+        start = np.searchsorted(time_stamps, np.datetime64(t0, "us"), side="left")
+        stop = np.searchsorted(time_stamps, np.datetime64(t1, "us"), side="left")
+        return slice(int(start), int(stop))
+
+    def with_payload_len(self, payload_len):
+        """
+        Find the records with a given payload length, e.g. PING_PAYLOAD_SIZE for the ping packets
+        :param payload_len: payload length in bytes
+        :return: numpy array of record numbers in log order
+        """
+        if self._by_payload is None:
+            # stable sort keeps the records of every payload length in log order
+            order = np.argsort(self.index["payload_len"], kind="stable")
+            self._by_payload = order, self.index["payload_len"][order]
+
+        order, payload_lens = self._by_payload
+        start = np.searchsorted(payload_lens, payload_len, side="left")
+        stop = np.searchsorted(payload_lens, payload_len, side="right")
+        return order[start:stop]
+
+    @property
+    def raw(self):
+        """
+        :return: the whole mapped log file as a uint8 numpy array (no copy)
+        """
+        if self._mmap is None:
+            return np.empty(0, dtype=np.uint8)
+        return np.frombuffer(self._mmap, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        """
+        :param i: record number, slice or array of record numbers
+        :return: CSIRecord, or a list of CSIRecords for a slice or array
+        """
+        if isinstance(i, (int, np.integer)):
+            return CSIRecord(self._view, int(self.offsets[i]), self.header_dtype)
+        return [
+            CSIRecord(self._view, int(offset), self.header_dtype)
+            for offset in self.offsets[i]
+        ]
+
+    def __iter__(self):
+        for offset in self.offsets:
+            yield CSIRecord(self._view, int(offset), self.header_dtype)
+
+    def _unmap(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()  # fails with BufferError while CSIRecords are still held
+            self._mmap = None
+
+    def close(self):
+        """
+        Unmap and close the log file, release any CSIRecords that are still held first
+        :return:
+        """
+        self._unmap()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,187 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import CSI_Python_Parser
+
+BATCH_SIZE = 1 << 20  # bytes collected before a batch goes to the writer thread
+MAX_BATCHES = 8  # batches in memory at once, records are dropped if all are full
+FLUSH_INTERVAL = 1.0  # seconds a partly filled batch waits before it is written
+FSYNC_POLICIES = ("never", "batch", "rotate")
+
+
+class CSILogWriter:
+    """
+    Writes a binary CSI log from a background thread. write() only copies the record into an
+    in-memory batch; whole batches go to disk with a single write call from the writer thread.
+    The log can be rotated into numbered files by size or by time, every file is a complete log.
+    """
+
+    def __init__(
+        self,
+        file_name,
+        batch_size=BATCH_SIZE,
+        flush_interval=FLUSH_INTERVAL,
+        fsync="never",
+        rotate_bytes=None,
+        rotate_seconds=None,
+        max_batches=MAX_BATCHES,
+    ):
+        """
+        :param file_name: name of the log file, rotated files are file_name.1, file_name.2, ...
+        :param batch_size: bytes collected before a batch is written
+        :param flush_interval: seconds before a partly filled batch is written anyway
+        :param fsync: "never", after every "batch", or when a file is finished ("rotate")
+        :param rotate_bytes: start a new file once the current one would grow past this, None never
+        :param rotate_seconds: start a new file after this many seconds, None never
+        :param max_batches: batches that may be in memory at once
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync must be one of " + ", ".join(FSYNC_POLICIES))
+
+        self.file_name = file_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+
+        self.file_num = 0
+        self.log_file = None
+        self.file_bytes = 0
+        self.file_started = 0.0
+        self._open_file()
+
+        # every batch has room for one more record than batch_size
+        record_max = (
+            CSI_Python_Parser.BINARY_LOG_PREFIX_STRUCT.size
+            + CSI_Python_Parser.BUFF_SIZE
+        )
+        batch_len = batch_size + record_max
+        self.free = deque(bytearray(batch_len) for _ in range(max_batches - 1))
+        self.current = bytearray(batch_len)
+        self.pos = 0
+        self.full = queue.Queue()
+
+        self.records = 0  # records accepted
+        self.dropped = 0  # records dropped because every batch was waiting on disk
+        self.bytes_written = 0
+        self.closed = False
+        self.lock = threading.RLock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _open_file(self):
+        name = self.file_name
+        if self.file_num > 0:
+            name = "%s.%d" % (self.file_name, self.file_num)
+        self.log_file = open(name, "wb", buffering=0)
+        CSI_Python_Parser.start_file(self.log_file)
+        self.file_bytes = len(CSI_Python_Parser.LOG_MAGIC)
+        self.file_started = time.monotonic()
+
+    def _rotate(self):
+        if self.fsync != "never":
+            os.fsync(self.log_file.fileno())
+        self.log_file.close()
+        self.file_num += 1
+        self._open_file()
+
+    def write(self, buffer, buf_len, time_stamp):
+        """
+        Add one record to the log, called from the receive loop
+        :param buffer: buffer read from CSI_dev (at least buf_len bytes)
+        :param buf_len: length of the buffer to log
+        :param time_stamp: when the buffer was read, seconds since the epoch
+        :return: False if the record was dropped
+        """
+        prefix = CSI_Python_Parser.BINARY_LOG_PREFIX_STRUCT
+        with self.lock:
+            if self.current is None:
+                self.current = self._take_free()
+                if self.current is None:
+                    self.dropped += 1
+                    return False
+
+            pos = self.pos
+            prefix.pack_into(self.current, pos, buf_len, int(time_stamp * 1000000))
+            start = pos + prefix.size
+            self.current[start : start + buf_len] = memoryview(buffer)[:buf_len]
+
+            # only count the record once it is complete, a signal handler may close mid-write
+            self.pos = start + buf_len
+            self.records += 1
+            if self.pos >= self.batch_size:
+                self._hand_off()
+        return True
+
+    def _take_free(self):
+        try:
+            return self.free.popleft()
+        except IndexError:
+            return None
+
+    def _hand_off(self):
+        # lock must be held
+        self.full.put((self.current, self.pos))
+        self.current = self._take_free()
+        self.pos = 0
+
+    def _run(self):
+        while True:
+            try:
+                batch, length = self.full.get(timeout=self.flush_interval)
+            except queue.Empty:
+                # never wait on the lock, the receive loop may hold it while a signal closes us
+                if self.lock.acquire(blocking=False):
+                    try:
+                        if self.pos > 0 and not self.closed:
+                            self._hand_off()
+                    finally:
+                        self.lock.release()
+                continue
+
+            if batch is None:
+                return
+            self._write_batch(batch, length)
+            self.free.append(batch)
+
+    def _write_batch(self, batch, length):
+        rotate = self.file_bytes > len(CSI_Python_Parser.LOG_MAGIC) and (
+            (
+                self.rotate_bytes is not None
+                and self.file_bytes + length > self.rotate_bytes
+            )
+            or (
+                self.rotate_seconds is not None
+                and time.monotonic() - self.file_started >= self.rotate_seconds
+            )
+        )
+        if rotate:
+            self._rotate()
+
+        self.log_file.write(memoryview(batch)[:length])
+        self.file_bytes += length
+        self.bytes_written += length
+        if self.fsync == "batch":
+            os.fsync(self.log_file.fileno())
+
+    def close(self):
+        """
+        Write out everything still in memory and close the log
+        :return:
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.pos > 0:
+                self._hand_off()
+            self.full.put((None, 0))
+
+        self.thread.join()
+        if self.fsync != "never":
+            os.fsync(self.log_file.fileno())
+        self.log_file.close()
@@ -0,0 +1,221 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUB_BUCKETS = 4  # histogram buckets per power of two, about 19% resolution
+MAX_BITS = 40  # largest value a histogram tells apart is 2^40 ns (about 18 minutes)
+REPORT_INTERVAL = 1.0  # seconds between JSON lines
+
+
+class Histogram:
+    """
+    Log-linear histogram of durations in nanoseconds. Recording is a few integer operations and one
+    list increment, so it can sit in the receive loop.
+    """
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * ((MAX_BITS + 1) * SUB_BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        """
+        :param ns: duration in nanoseconds
+        :return:
+        """
+        bits = ns.bit_length()
+        if bits > MAX_BITS:
+            bits = MAX_BITS
+        # the two bits below the top one pick the sub bucket
+        sub = (ns >> (bits - 3)) & 3 if bits > 2 else 0
+        self.counts[bits * SUB_BUCKETS + sub] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    @staticmethod
+    def _bucket_limit(bucket):
+        # largest value that falls into a bucket
+        bits, sub = divmod(bucket, SUB_BUCKETS)
+        if bits <= 2:
+            return (1 << bits) - 1
+        return ((SUB_BUCKETS + sub + 1) << (bits - 3)) - 1
+
+    def percentile(self, q):
+        """
+        :param q: percentile between 0 and 100
+        :return: upper limit of the bucket the percentile falls into, in nanoseconds
+        """
+        if self.count == 0:
+            return 0
+        rank = self.count * q / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self._bucket_limit(bucket), self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        :return: dict of count and mean/p50/p90/p99/max in microseconds
+        """
+        count = self.count
+        return {
+            "count": count,
+            "mean_us": self.total / count / 1000.0 if count else 0.0,
+            "p50_us": self.percentile(50) / 1000.0,
+            "p90_us": self.percentile(90) / 1000.0,
+            "p99_us": self.percentile(99) / 1000.0,
+            "max_us": self.max / 1000.0,
+        }
+
+
+class Metrics:
+    """
+    Counters, latency histograms and gauges of a run. Every counter and histogram should only be
+    updated from one thread; snapshots may be taken from any thread and are approximate while
+    packets are being handled.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def count(self, name, amount=1):
+        """
+        :param name: counter name, created the first time it is used
+        :param amount: how much to add
+        :return:
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def histogram(self, name):
+        """
+        :param name: histogram name, created the first time it is used
+        :return: Histogram, keep it to record without the lookup
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def gauge(self, name, read):
+        """
+        :param name: gauge name
+        :param read: function without arguments that returns the current value
+        :return:
+        """
+        self.gauges[name] = read
+
+    def snapshot(self):
+        """
+        :return: dict of everything measured so far, rates are per second since the start
+        """
+        elapsed = time.monotonic() - self.started
+        counters = dict(self.counters)
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as error:  # a gauge must not take the report down
+                gauges[name] = repr(error)
+        return {
+            "time": time.time(),
+            "elapsed": elapsed,
+            "counters": counters,
+            "rates": {
+                name: value / elapsed if elapsed > 0 else 0.0
+                for name, value in counters.items()
+            },
+            "gauges": gauges,
+            "histograms": {
+                name: histogram.snapshot()
+                for name, histogram in list(self.histograms.items())
+            },
+        }
+
+
+class JSONLinesReporter:
+    """
+    Writes a metrics snapshot as one JSON line every interval seconds from a background thread
+    """
+
+    def __init__(self, metrics, out_file, interval=REPORT_INTERVAL):
+        """
+        :param metrics: Metrics to report
+        :param out_file: opened text file (e.g. sys.stdout) to write the lines to
+        :param interval: seconds between lines
+        """
+        self.metrics = metrics
+        self.out_file = out_file
+        self.interval = interval
+        self._last_counters = {}
+        self._last_elapsed = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        snapshot = self.metrics.snapshot()
+        # rates over the last interval as well, the ones in the snapshot are since the start
+        interval = snapshot["elapsed"] - self._last_elapsed
+        snapshot["interval_rates"] = {
+            name: (value - self._last_counters.get(name, 0)) / interval
+            for name, value in snapshot["counters"].items()
+            if interval > 0
+        }
+        self._last_counters = snapshot["counters"]
+        self._last_elapsed = snapshot["elapsed"]
+
+        self.out_file.write(json.dumps(snapshot) + "\n")
+        self.out_file.flush()
+
+    def stop(self):
+        """
+        Stop the thread and write one last line
+        :return:
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.report()
+
+
+def serve_http(metrics, port, host="127.0.0.1"):
+    """
+    Serve metrics snapshots as JSON over HTTP from a background thread (any path, GET only)
+    :param metrics: Metrics to serve
+    :param port: TCP port, 0 picks a free one
+    :param host: address to listen on, local only by default
+    :return: the server, server.server_address has the port, server.shutdown() stops it
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(metrics.snapshot()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # keep requests out of Alice's output
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,244 @@
+import os
+import threading
+import time
+
+import CSI_Python_Parser
+
+RING_SLOTS = 1024  # number of BUFF_SIZE buffers in the ring
+READ_IDLE_SLEEP = 0.0001  # seconds the reader sleeps when CSI_dev had nothing to read
+
+
+class CSIRing:
+    """
+    Preallocated ring of fixed size buffers with one writer (the device reader) and any number of
+    consumers. Every consumer sees every buffer in order, a slot is only reused once all consumers
+    are done with it. When the ring is full the reader keeps draining CSI_dev but drops the packets.
+    """
+
+    def __init__(self, slots=RING_SLOTS, slot_size=CSI_Python_Parser.BUFF_SIZE):
+        """
+        :param slots: number of buffers in the ring
+        :param slot_size: size of each buffer in bytes
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buff = bytearray(slots * slot_size)
+        self.view = memoryview(self.buff)
+        self.counts = [0] * slots  # bytes read into each slot
+        self.time_stamps = [
+            0.0
+        ] * slots  # when each slot was read, seconds since the epoch
+
+        self.head = 0  # number of buffers written so far
+        self.tails = []  # next buffer number of each consumer
+        self.dropped = 0  # packets drained from CSI_dev while the ring was full
+        self.high_water = 0  # most buffers ever waiting for the slowest consumer
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def slot(self, idx):
+        """
+        :param idx: slot index
+        :return: memoryview of the slot's buffer
+        """
+        start = idx * self.slot_size
+        return self.view[start : start + self.slot_size]
+
+    def add_consumer(self):
+        """
+        :return: consumer id, it starts at the next buffer written
+        """
+        with self.cond:
+            self.tails.append(self.head)
+            return len(self.tails) - 1
+
+    def free_slot(self):
+        """
+        Writer only: find the slot the next buffer goes into
+        :return: slot index, None if the slowest consumer is a whole ring behind
+        """
+        depth = self.head - min(self.tails) if self.tails else 0
+        if depth >= self.slots:
+            return None
+        return self.head % self.slots
+
+    def commit(self, idx, cnt, time_stamp):
+        """
+        Writer only: hand the buffer in slot idx to the consumers
+        :param idx: slot index from free_slot
+        :param cnt: bytes read into the slot
+        :param time_stamp: when the buffer was read
+        :return:
+        """
+        self.counts[idx] = cnt
+        self.time_stamps[idx] = time_stamp
+        with self.cond:
+            self.head += 1
+            if self.tails:
+                self.high_water = max(self.high_water, self.head - min(self.tails))
+            self.cond.notify_all()
+
+    def get(self, consumer):
+        """
+        Wait for the next buffer of a consumer
+        :param consumer: consumer id from add_consumer
+        :return: (memoryview of the buffer, bytes in it, time stamp), None once the ring is closed
+                 and the consumer has seen every buffer
+        """
+        with self.cond:
+            while self.tails[consumer] >= self.head:
+                if self.closed:
+                    return None
+                self.cond.wait()
+            idx = self.tails[consumer] % self.slots
+        return self.slot(idx), self.counts[idx], self.time_stamps[idx]
+
+    def release(self, consumer):
+        """
+        Consumer is done with the buffer it got last, the slot may be reused
+        :param consumer: consumer id from add_consumer
+        :return:
+        """
+        with self.cond:
+            self.tails[consumer] += 1
+
+    def depth(self, consumer):
+        """
+        :param consumer: consumer id from add_consumer
+        :return: buffers waiting for the consumer
+        """
+        return self.head - self.tails[consumer]
+
+    def close(self):
+        """
+        Stop the ring, consumers still get every buffer written before this
+        :return:
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+def reader_loop(fd, ring, read_wait_time=None, device_drops=None):
+    """
+    Drain CSI_dev into the ring until the ring is closed
+    :param fd: opened CSI_dev file
+    :param ring: CSIRing to fill
+    :param read_wait_time: CSI_Metrics.Histogram of the time waited for every packet, or None
+    :param device_drops: CSI_Python_Parser.DeviceDrops every packet read is checked with, or None
+    :return:
+    """
+    scratch = bytearray(ring.slot_size)  # packets that are dropped are read here
+    wait_start = time.perf_counter_ns()
+    while not ring.closed:
+        idx = ring.free_slot()
+        try:
+            if idx is None:
+                cnt = os.readv(fd, [scratch])
+                if cnt > 0:
+                    if device_drops is not None:
+                        device_drops.check(scratch, cnt)
+                    ring.dropped += 1
+                    continue
+            else:
+                cnt = os.readv(fd, [ring.slot(idx)])
+        except BlockingIOError:
+            cnt = 0  # simulated device with nothing to read
+        except OSError:
+            break  # CSI_dev was closed under us while shutting down
+
+        if cnt > 0:
+            if device_drops is not None:
+                device_drops.check(ring.slot(idx), cnt)
+            ring.commit(idx, cnt, time.time())
+            if read_wait_time is not None:
+                now = time.perf_counter_ns()
+                read_wait_time.record(now - wait_start)
+                wait_start = now
+        else:
+            time.sleep(READ_IDLE_SLEEP)
+
+
+def consumer_loop(ring, consumer, handle_packet):
+    """
+    Hand every buffer of the ring to handle_packet, in order
+    :param ring: CSIRing to read from
+    :param consumer: consumer id from ring.add_consumer
+    :param handle_packet: function(buff, cnt, time_stamp)
+    :return:
+    """
+    while True:
+        item = ring.get(consumer)
+        if item is None:
+            return
+        buff, cnt, time_stamp = item
+        try:
+            handle_packet(buff, cnt, time_stamp)
+        finally:
+            ring.release(consumer)
+
+
+class CSIPipeline:
+    """
+    Runs a dedicated CSI_dev reader thread that fills a CSIRing, and one thread per consumer
+    (e.g. decide/send and logging) so a slow consumer does not hold up reading the device.
+    """
+
+    def __init__(
+        self, fd, consumers, slots=RING_SLOTS, metrics=None, device_drops=None
+    ):
+        """
+        :param fd: opened CSI_dev file
+        :param consumers: list of functions(buff, cnt, time_stamp), each runs in its own thread
+        :param slots: number of buffers in the ring
+        :param metrics: CSI_Metrics.Metrics to record the read wait time in, or None
+        :param device_drops: CSI_Python_Parser.DeviceDrops to estimate CSI_dev's drops with, or None
+        """
+        self.fd = fd
+        self.ring = CSIRing(slots)
+        read_wait_time = None
+        if metrics is not None:
+            read_wait_time = metrics.histogram("read_wait")
+        self.reader = threading.Thread(
+            target=reader_loop,
+            args=(fd, self.ring, read_wait_time, device_drops),
+            daemon=True,
+        )
+        self.consumers = []
+        for handle_packet in consumers:
+            consumer = self.ring.add_consumer()
+            self.consumers.append(
+                threading.Thread(
+                    target=consumer_loop,
+                    args=(self.ring, consumer, handle_packet),
+                    daemon=True,
+                )
+            )
+
+    def start(self):
+        self.reader.start()
+        for thread in self.consumers:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop reading and wait for the consumers to finish the buffers already read
+        :param timeout: seconds to wait for each consumer
+        :return:
+        """
+        self.ring.close()
+        self.reader.join(timeout)
+        for thread in self.consumers:
+            thread.join(timeout)
+
+    def stats(self):
+        """
+        :return: dict of packets read, dropped because the ring was full, and ring depth
+        """
+        ring = self.ring
+        return {
+            "read": ring.head,
+            "dropped": ring.dropped,
+            "depth": [ring.depth(consumer) for consumer in range(len(ring.tails))],
+            "high_water": ring.high_water,
+        }
@@ -1,35 +1,99 @@
 import matplotlib.pyplot as plt
 import numpy as np
 
+import CSI_Gating
+
+TONE_SPACING = 0.3125  # MHz between sub-carriers
+DB_LIMITS = (0, 60)  # dB axis of the stem plots, CSI is below 57 dB
+IQ_LIMIT = 512  # CSI values are 10 bit signed
+
+
+def tone_frequencies(num_tones):
+    """
+    :param num_tones: number of sub-carriers
+    :return: frequency offset of every sub-carrier from the centre in MHz
+    """
+    return (np.arange(num_tones) - num_tones // 2) * TONE_SPACING
+
+
+def stem_path(x, y, bottom=DB_LIMITS[0]):
+    """
+    All stems of a stem plot as one line, much faster to draw than a line per stem
+    :param x: stem positions
+    :param y: stem heights, same length as x
+    :param bottom: where the stems start
+    :return: x and y of the line: (x, bottom), (x, y), (nan, nan) for every stem
+    """
+    path = np.full((2, len(x), 3), np.nan)
+    path[0, :, 0] = path[0, :, 1] = x
+    path[1, :, 0] = bottom
+    path[1, :, 1] = y
+    return path.reshape(2, -1)
+
+
+def setup_stem_axes(ax, freqs):
+    """
+    Grid, labels and limits of a stem plot of dB magnitudes
+    :param ax: axes to set up
+    :param freqs: sub-carrier frequencies in MHz, from tone_frequencies
+    :return:
+    """
+    ax.yaxis.grid(color="gray", linestyle="dashed")
+    ax.xaxis.grid(color="gray", linestyle="dashed")
+    ax.set_xlabel("MHz")
+    ax.set_ylabel("dB")
+    ax.set_xlim(freqs[0] - 1, freqs[-1] + 1)
+    ax.set_ylim(*DB_LIMITS)
+
+
+def setup_complex_axes(ax):
+    """
+    Grid, labels and limits of a plot of CSI complex numbers on real/imaginary axis
+    :param ax: axes to set up
+    :return:
+    """
+    ax.set_axisbelow(True)
+    ax.yaxis.grid(color="gray", linestyle="dashed")
+    ax.xaxis.grid(color="gray", linestyle="dashed")
+    ax.set_ylabel("imag")
+    ax.set_xlabel("real")
+    ax.set_xlim(-IQ_LIMIT, IQ_LIMIT)
+    ax.set_ylim(-IQ_LIMIT, IQ_LIMIT)
+
 
 def draw_complex_plots(data):
     """
     Plots all the CSI complex numbers on real/imaginary axis
     Each color represents a different numpy array
-    :param data: list of numpy arrays containing CSI complex numbers
+    :param data: complex CSI shaped (streams, tones), or a list of numpy arrays
     :return:
     """
     fig = plt.figure()
     ax1 = fig.add_subplot(111)  # 111 is to create only one subplot that fills screen
-
-    # Turn on grid-lines and set axis labels
-    ax1.set_axisbelow(True)
-    ax1.yaxis.grid(color="gray", linestyle="dashed")
-    ax1.xaxis.grid(color="gray", linestyle="dashed")
-    ax1.set_ylabel("imag")
-    ax1.set_xlabel("real")
+    setup_complex_axes(ax1)
 
     # Plot each numpy array on the same subplot
     for i in range(0, len(data)):
-        ax1.scatter(
-            x=[x.real for x in data[i]], y=[x.imag for x in data[i]], label=str(i)
-        )
+        ax1.scatter(x=np.real(data[i]), y=np.imag(data[i]), label=str(i))
 
     plt.legend(loc="lower left")
+    plt.show()
+
 
-    # set real and imaginary axis limits (MAX should not go above 512)
-    plt.xlim(-500, 500)
-    plt.ylim(-500, 500)
+def draw_stem_grid(mags, rows, cols):
+    """
+    Stem plots of the dB magnitudes of every stream, one subplot each
+    :param mags: dB magnitudes shaped (streams, tones), e.g. from CSI_Gating.dB_per_array
+    :param rows: subplot rows
+    :param cols: subplot columns
+    :return:
+    """
+    freqs = tone_frequencies(mags.shape[1])
+    fig = plt.figure()
+    for i in range(0, len(mags)):
+        ax1 = fig.add_subplot(rows, cols, i + 1)
+        setup_stem_axes(ax1, freqs)
+        ax1.stem(freqs, mags[i])
     plt.show()
 
 
@@ -39,76 +103,16 @@ def draw_four_stem_plots(data):
     :param data: four sets of CSI data
     :return:
     """
-    mags = []
-    for i in range(0, 4):
-        mag = []
-        for j in range(0, len(data[i])):
-            mag.append(20 * np.log10(np.abs(data[i][j])))
-        mags.append(mag)
-
-    space = range(0, len(data[i]))
-    fig = plt.figure()
-    ax1 = fig.add_subplot(221)
-    ax1.yaxis.grid(color="gray", linestyle="dashed")
-    ax1.xaxis.grid(color="gray", linestyle="dashed")
-    ax1.set_xlabel("")  # TODO figure out what X axis label is
-    ax1.set_ylabel("dB")
-    ax1.stem(space, mags[0], use_line_collection=True)
-
-    ax1 = fig.add_subplot(222)
-    ax1.yaxis.grid(color="gray", linestyle="dashed")
-    ax1.xaxis.grid(color="gray", linestyle="dashed")
-    ax1.set_xlabel("")  # TODO figure out what X axis label is
-    ax1.set_ylabel("dB")
-    ax1.stem(space, mags[1], use_line_collection=True)
-
-    ax1 = fig.add_subplot(223)
-    ax1.yaxis.grid(color="gray", linestyle="dashed")
-    ax1.xaxis.grid(color="gray", linestyle="dashed")
-    ax1.set_xlabel("")  # TODO figure out what X axis label is
-    ax1.set_ylabel("dB")
-    ax1.stem(space, mags[2], use_line_collection=True)
-
-    ax1 = fig.add_subplot(224)
-    ax1.yaxis.grid(color="gray", linestyle="dashed")
-    ax1.xaxis.grid(color="gray", linestyle="dashed")
-    ax1.set_xlabel("")  # TODO figure out what X axis label is
-    ax1.set_ylabel("dB")
-    ax1.stem(space, mags[3], use_line_collection=True)
-    plt.show()
+    draw_stem_grid(CSI_Gating.dB_per_array(np.asarray(data)[:4], np.float32), 2, 2)
 
 
 def draw_two_stem_plots(data):
     """
-        Plot Stem plots of standardized CSI data when there are two sets
-        :param data: two sets of CSI data
-        :return:
-        """
-    mags = []
-    for i in range(0, 2):
-        mag = []
-        for j in range(0, len(data[i])):
-            mag.append(20 * np.log10(np.abs(data[i][j])))
-        mags.append(mag)
-
-    space = np.linspace(
-        -1 * len(data[0]) / 2 * 0.3125, (len(data[0]) / 2 - 1) * 0.3125, len(data[0])
-    )
-    fig = plt.figure()
-    ax1 = fig.add_subplot(211)
-    ax1.yaxis.grid(color="gray", linestyle="dashed")
-    ax1.xaxis.grid(color="gray", linestyle="dashed")
-    ax1.set_xlabel("")  # TODO figure out what X axis label is
-    ax1.set_ylabel("dB")
-    ax1.stem(space, mags[0], use_line_collection=True)
-
-    ax1 = fig.add_subplot(212)
-    ax1.yaxis.grid(color="gray", linestyle="dashed")
-    ax1.xaxis.grid(color="gray", linestyle="dashed")
-    ax1.set_xlabel("")  # TODO figure out what X axis label is
-    ax1.set_ylabel("dB")
-    ax1.stem(space, mags[1], use_line_collection=True)
-    plt.show()
+    Plot Stem plots of standardized CSI data when there are two sets
+    :param data: two sets of CSI data
+    :return:
+    """
+    draw_stem_grid(CSI_Gating.dB_per_array(np.asarray(data)[:2], np.float32), 2, 1)
 
 
 def draw_stem_plots(info, num_tones):
@@ -117,23 +121,5 @@ def draw_stem_plots(info, num_tones):
     :param info: numpy array of complex numbers
     :return:
     """
-    mag = []
-    for i in range(0, num_tones):
-        mag.append(20 * np.log10(np.abs(info[i])))
-
-    space = np.linspace(
-        -1 * num_tones / 2 * 0.3125, (num_tones / 2 - 1) * 0.3125, num_tones
-    )
-
-    fig = plt.figure()
-    ax1 = fig.add_subplot(111)  # 111 is to create only one subplot that fills screen
-
-    # Turn on grid-lines and set axis labels
-    ax1.set_axisbelow(True)
-    ax1.yaxis.grid(color="gray", linestyle="dashed")
-    ax1.xaxis.grid(color="gray", linestyle="dashed")
-    ax1.set_xlabel("")  # TODO figure out what X axis label is
-    ax1.set_ylabel("dB")
-    ax1.stem(space, mag, use_line_collection=True)
-
-    plt.show()
\ No newline at end of file
+    data = np.asarray(info)[np.newaxis, :num_tones]
+    draw_stem_grid(CSI_Gating.dB_per_array(data, np.float32), 1, 1)
@@ -1,15 +1,20 @@
+import argparse
 import os
 import struct
 import sys
-import socket
 import signal
-from datetime import datetime
+import stat
+import time
+from collections import deque
 
 import numpy as np
 
-from CSI_Class import *
-import CSI_Plot
+import CSI_Gating
+import CSI_Metrics
+import CSI_Sender
+from CSI_Gating import dB_per_array
 
+CSI_DEVICE = "/dev/CSI_dev"  # character device of the CSI kernel module
 BUFF_SIZE = 4096  # amount of bytes to read from buffer
 CSI_ST_LEN = 23  # length of CSI state in buffer (bytes)
 BIT_RESOLUTION = 10  # bit resolution for the CSI data
@@ -22,15 +27,73 @@ DB_THRESHOLD = 20
 
 PING_PAYLOAD_SIZE = 766
 PACKET_SIZE = 1024
-
-
-def open_csi_device():
+POOL_SIZE = 64  # buffers kept by a CSIBufferPool
+
+TIME_STAMP_LEN = 26  # length of the ASCII time stamp in front of buffers in older logs
+LOG_MAGIC = b"CSILOG02"  # logs with binary time stamps start with this, older do not
+
+# layout of the CSI status at the start of every buffer read from CSI_dev
+CSI_STATUS_DTYPE = np.dtype(
+    [
+        ("tfs_stamp", "=u8"),
+        ("csi_len", "=u2"),
+        ("channel", "=u2"),
+        ("phyerr", "u1"),
+        ("noise", "u1"),
+        ("rate", "u1"),
+        ("chan_bw", "u1"),
+        ("num_tones", "u1"),
+        ("nr", "u1"),
+        ("nc", "u1"),
+        ("rssi", "u1"),
+        ("rssi_0", "u1"),
+        ("rssi_1", "u1"),
+        ("rssi_2", "u1"),
+        ("payload_len", "=u2"),
+    ]
+)
+
+# layout of the record header of older logs: buf_len, ASCII local time stamp and then the CSI status
+LOG_HEADER_DTYPE = np.dtype(
+    [("buf_len", "=u2"), ("time_stamp", "S%d" % TIME_STAMP_LEN)]
+    + CSI_STATUS_DTYPE.descr
+)
+LOG_HEADER_LEN = LOG_HEADER_DTYPE.itemsize
+
+# layout of the record header to_file writes: buf_len, UTC time stamp in microseconds, CSI status
+BINARY_LOG_HEADER_DTYPE = np.dtype(
+    [("buf_len", "=u2"), ("time_stamp", "=M8[us]")] + CSI_STATUS_DTYPE.descr
+)
+# buf_len and time stamp in front of every buffer in a binary log
+BINARY_LOG_PREFIX_STRUCT = struct.Struct("=Hq")
+
+# whole CSI status unpacked in one go, same layout as CSI_STATUS_DTYPE
+CSI_STATUS_STRUCT = struct.Struct("=QHHBBBBBBBBBBBH")
+TWO_BYTE_STRUCT = struct.Struct(NATIVE_UNSIGNED_SHORT)
+CSI_LEN_OFFSET = CSI_STATUS_DTYPE.fields["csi_len"][1]
+PAYLOAD_LEN_OFFSET = CSI_STATUS_DTYPE.fields["payload_len"][1]
+
+# the payload is the received 802.11 frame, its MAC header holds a little-endian sequence control
+SEQ_CTRL_OFFSET = 22
+SEQ_CTRL_STRUCT = struct.Struct("<H")
+SEQ_MODULO = 4096  # 802.11 sequence numbers are 12 bit
+
+# shifts and mask used to pull four 10 bit values out of every 40 bit group of CSI data
+_GROUP_SHIFTS = np.arange(4, dtype=np.uint64) * np.uint64(BIT_RESOLUTION)
+_BIT_MASK = np.uint64((1 << BIT_RESOLUTION) - 1)
+
+
+def open_csi_device(device=CSI_DEVICE):
     """
     Open and return file buffer to read CSI data from.
     /dev/CSI_dev may need be given read and write permissions
+    :param device: path of the CSI device, or of a FIFO fed by CSI_Device_Sim.py
     """
     try:
-        fd = os.open("/dev/CSI_dev", os.O_RDWR)
+        fd = os.open(device, os.O_RDWR)
+        if stat.S_ISFIFO(os.fstat(fd).st_mode):
+            # like CSI_dev, reads return nothing when it is empty
+            os.set_blocking(fd, False)
         return fd
     except FileNotFoundError:
         print("Failed to open the device....")
@@ -45,47 +108,151 @@ def close_csi_device(fileName):
     os.close(fileName)
 
 
-def read_csi_data(fd, BUFFSIZE):
+class CSIStatus:
+    """
+    Meta data (and optionally CSI data) of one received packet
+    """
+
+    __slots__ = CSI_STATUS_DTYPE.names + ("buf_len", "time_stamp", "data")
+
+    def __init__(
+        self,
+        tfs_stamp=0,
+        csi_len=0,
+        channel=0,
+        phyerr=0,
+        noise=0,
+        rate=0,
+        chan_bw=0,
+        num_tones=0,
+        nr=0,
+        nc=0,
+        rssi=0,
+        rssi_0=0,
+        rssi_1=0,
+        rssi_2=0,
+        payload_len=0,
+        buf_len=0,
+        time_stamp=0.0,
+        data=None,
+    ):
+        self.tfs_stamp = tfs_stamp
+        self.csi_len = csi_len
+        self.channel = channel
+        self.phyerr = phyerr
+        self.noise = noise
+        self.rate = rate
+        self.chan_bw = chan_bw
+        self.num_tones = num_tones
+        self.nr = nr
+        self.nc = nc
+        self.rssi = rssi
+        self.rssi_0 = rssi_0
+        self.rssi_1 = rssi_1
+        self.rssi_2 = rssi_2
+        self.payload_len = payload_len
+        self.buf_len = buf_len
+        self.time_stamp = time_stamp
+        self.data = data
+
+
+class CSIBufferPool:
+    """
+    Recycles BUFF_SIZE byte buffers so reading CSI_dev does not allocate a new buffer per packet
+    """
+
+    def __init__(self, count=POOL_SIZE, size=BUFF_SIZE):
+        """
+        :param count: number of buffers to preallocate
+        :param size: size of each buffer in bytes
+        """
+        self.size = size
+        self.free = deque(bytearray(size) for _ in range(count))
+        self.misses = 0  # buffers allocated because the pool was empty
+
+    def acquire(self):
+        """
+        :return: a free buffer, a new one if every buffer is in use
+        """
+        try:
+            return self.free.pop()
+        except IndexError:
+            self.misses += 1
+            return bytearray(self.size)
+
+    def release(self, buff):
+        """
+        Give a buffer back once nothing uses its contents anymore
+        :param buff: buffer from acquire
+        :return:
+        """
+        self.free.append(buff)
+
+
+class DeviceDrops:
+    """
+    Estimates the pings CSI_dev dropped before Alice read them from the gaps in their 802.11
+    sequence numbers. CSI_dev has no drop counter of its own, so this is the closest there is;
+    anything else Bob transmits uses sequence numbers too and makes the estimate a little high.
+    """
+
+    def __init__(self):
+        self.dropped = 0
+        self.last_seq = None
+
+    def check(self, buff, cnt):
+        """
+        :param buff: buffer read from CSI_dev
+        :param cnt: how many bytes are in the buffer
+        :return:
+        """
+        if (
+            TWO_BYTE_STRUCT.unpack_from(buff, PAYLOAD_LEN_OFFSET)[0]
+            != PING_PAYLOAD_SIZE
+        ):
+            return
+        csi_len = TWO_BYTE_STRUCT.unpack_from(buff, CSI_LEN_OFFSET)[0]
+        offset = CSI_STATUS_STRUCT.size + csi_len + SEQ_CTRL_OFFSET
+        if offset + 2 > cnt:
+            return
+        seq = SEQ_CTRL_STRUCT.unpack_from(buff, offset)[0] >> 4
+        if self.last_seq is not None:
+            gap = (seq - self.last_seq - 1) % SEQ_MODULO
+            # a retry repeats the last number, Bob restarting jumps
+            if gap < SEQ_MODULO // 2:
+                self.dropped += gap
+        self.last_seq = seq
+
+
+def read_csi_data(fd, BUFFSIZE, info_array=None):
     """
     Read CSI status and CSI data from file buffer to our own buffer
     :param fd: opened file buffer
     :param BUFFSIZE: size to read from file buffer
+    :param info_array: buffer to read into (e.g. from a CSIBufferPool), a new one if None
     :return: how many bytes were read from file buffer, our buffer (buffer contains bytes)
     """
-    info_array = bytearray(BUFFSIZE)
-    cnt = os.readv(fd, [info_array])
+    if info_array is None:
+        info_array = bytearray(BUFFSIZE)
+    try:
+        cnt = os.readv(fd, [info_array])
+    except BlockingIOError:
+        cnt = 0  # simulated device with nothing to read
     return cnt, info_array
 
 
 def record_status(buff, cnt):
     """
     Retrieve meta data from buffer about received packet
-    :param buff: buffer to read from
+    :param buff: buffer to read from (bytearray or memoryview, nothing is copied)
     :param cnt: how many bytes are in the buffer
-    :return: csi_object full of meta/status data
-    """
-    one_byte = struct.Struct(NATIVE_UNSIGNED_CHAR)
-    two_byte = struct.Struct(NATIVE_UNSIGNED_SHORT)
-
-    csi_object = CSI()
-    csi_object.time_stamp = datetime.now(tz=None).__str__()
-    csi_object.tfs_stamp = struct.unpack("=Q", buff[0:8])[0]
-    csi_object.csi_len = two_byte.unpack(buff[8:10])[0]
-    csi_object.channel = two_byte.unpack(buff[10:12])[0]
-    csi_object.buf_len = two_byte.unpack(buff[cnt - 2 : cnt])[0]
-    csi_object.payload_len = two_byte.unpack(buff[CSI_ST_LEN : CSI_ST_LEN + 2])[0]
-    csi_object.phyerr = one_byte.unpack(buff[12:13])[0]
-    csi_object.noise = one_byte.unpack(buff[13:14])[0]
-    csi_object.rate = one_byte.unpack(buff[14:15])[0]
-    csi_object.chan_bw = one_byte.unpack(buff[15:16])[0]
-    csi_object.num_tones = one_byte.unpack(buff[16:17])[0]
-    csi_object.nr = one_byte.unpack(buff[17:18])[0]
-    csi_object.nc = one_byte.unpack(buff[18:19])[0]
-    csi_object.rssi = one_byte.unpack(buff[19:20])[0]
-    csi_object.rssi_0 = one_byte.unpack(buff[20:21])[0]
-    csi_object.rssi_1 = one_byte.unpack(buff[21:22])[0]
-    csi_object.rssi_2 = one_byte.unpack(buff[22:23])[0]
-    return csi_object
+    :return: csi_object full of meta/status data, time_stamp in seconds since the epoch
+    """
+    return CSIStatus(
+        *CSI_STATUS_STRUCT.unpack_from(buff, 0),
+        buf_len=TWO_BYTE_STRUCT.unpack_from(buff, cnt - 2)[0],
+        time_stamp=time.time()
+    )
 
 
 def bit_convert(data, max_bit):
@@ -101,6 +268,57 @@ def bit_convert(data, max_bit):
     return data
 
 
+def unpack_CSI_bits(raw, n_values):
+    """
+    Unpack a stream of little-endian packed 10 bit signed values.
+    Every 5 bytes hold exactly 4 values, so the stream is split into 40 bit groups and each group is
+    shifted apart at once instead of walking the stream 16 bits at a time.
+    :param raw: uint8 numpy array, the last axis is the packed stream (leading axes are packets)
+    :param n_values: how many 10 bit values to unpack from each stream
+    :return: int16 numpy array with the same leading axes as raw and n_values on the last axis
+    """
+    n_groups = (n_values + 3) // 4
+    n_bytes = n_groups * 5
+
+    # pad (or trim) every stream to a whole number of 5 byte groups
+    if raw.shape[-1] < n_bytes:
+        pad = [(0, 0)] * (raw.ndim - 1) + [(0, n_bytes - raw.shape[-1])]
+        raw = np.pad(raw, pad, mode="constant")
+    raw = raw[..., :n_bytes]
+
+    groups = raw.reshape(raw.shape[:-1] + (n_groups, 5)).astype(np.uint64)
+    words = groups[..., 0]
+    for byte_idx in range(1, 5):
+        words |= groups[..., byte_idx] << np.uint64(8 * byte_idx)
+
+    values = (words[..., np.newaxis] >> _GROUP_SHIFTS) & _BIT_MASK
+    values = values.reshape(raw.shape[:-1] + (n_groups * 4,))[..., :n_values]
+    values = values.astype(np.int16)
+
+    # same as bit_convert: subtract 2^BIT_RESOLUTION when the sign bit is set
+    values -= (values & (1 << (BIT_RESOLUTION - 1))) << 1
+    return values
+
+
+def decode_CSI_data(raw, nr, nc, num_tones):
+    """
+    Decode packed CSI data of one or more packets that share nr, nc and num_tones
+    :param raw: uint8 numpy array, the last axis is the packed CSI data (leading axes are packets)
+    :param nr: number of receiving antennae
+    :param nc: number of transmitting antennae
+    :param num_tones: number of sub-carriers
+    :return: complex64 numpy array shaped (..., nr * nc, num_tones), row nc_idx * nr + nr_idx
+    """
+    values = unpack_CSI_bits(raw, 2 * nr * nc * num_tones)
+
+    # values are ordered tone -> transmitter -> receiver -> (imag, real)
+    values = values.reshape(raw.shape[:-1] + (num_tones, nc * nr, 2))
+    data = np.empty(values.shape[:-1], dtype=np.complex64)
+    data.real = values[..., 1]
+    data.imag = values[..., 0]
+    return np.ascontiguousarray(np.swapaxes(data, -1, -2))
+
+
 def record_CSI_data(buff, nr, nc, num_tones, from_file):
     """
     Read CSI data from buffer
@@ -109,95 +327,42 @@ def record_CSI_data(buff, nr, nc, num_tones, from_file):
     :param nc: number of transmitting antennae
     :param nr: number of receiving antennae
     :param from_file: reading from a file instead of kernel?
-    :return: csi_data divided into different groups
+    :return: csi_data divided into different groups, numpy array shaped (nr * nc, num_tones)
     """
-
-    # list of numpy arrays to hold CSI data
-    data = []
-    for x in range(0, nr * nc):
-        data.append(np.empty(num_tones, dtype=np.complex))
-
     index = CSI_ST_LEN + 2  # starting index
     if from_file:
         index = 0  # if reading from a file start at the beginning of given buffer
 
-    bits_left = 16
-    bit_mask = (1 << BIT_RESOLUTION) - 1  # mask to select BIT_RESOLUTION number of bits
-
-    # grab 2 bytes(16bits) from current spot in buffer
-    h_data = struct.unpack("=H", buff[index : index + 2])[0]
-    index += 2
-    current_data = h_data & ((1 << 16) - 1)
-
-    # loop for each sub-carrier
-    for tone_idx in range(0, num_tones):
-
-        # loop for each transmitter antenna
-        for nc_idx in range(0, nc):
-
-            # loop for each receiving antenna
-            for nr_idx in range(0, nr):
-
-                # Check to see if more bits are needed in current data
-                if (bits_left - BIT_RESOLUTION) < 0:
-                    # grab 2 bytes(16bits) from current spot in buffer
-                    h_data = struct.unpack("=H", buff[index : index + 2])[0]
-                    index += 2
-                    current_data += h_data << bits_left
-                    bits_left += 16
-
-                # grab lowest 10 bits and process
-                imag = current_data & bit_mask
-                imag = bit_convert(imag, BIT_RESOLUTION)  # check sign bit
-
-                bits_left -= BIT_RESOLUTION
-                current_data >>= BIT_RESOLUTION
-
-                # Check to see if more bits are needed in current data
-                if (bits_left - BIT_RESOLUTION) < 0:
-                    # grab 2 bytes(16bits) from current spot in buffer
-                    h_data = struct.unpack("=H", buff[index : index + 2])[0]
-                    index += 2
-                    current_data += h_data << bits_left
-                    bits_left += 16
-
-                # grab lowest 10 bits and process
-                real = current_data & bit_mask
-                real = bit_convert(real, BIT_RESOLUTION)
-
-                bits_left -= BIT_RESOLUTION
-                current_data >>= BIT_RESOLUTION
-
-                # create complex pair and put in list of numpy arrays
-                complex_pair = complex(real, imag)
-                data[nc_idx * nr + nr_idx][tone_idx] = complex_pair
-    return data
-
-
-def dB_per_array(npArray):
-    dB_array = np.empty(npArray.size)
-    for i in range(npArray.size):
-        dB_array[i] = 20 * np.log10(np.abs(npArray[i]))
-    return dB_array
+    raw = np.frombuffer(buff, dtype=np.uint8, offset=index)
+    return decode_CSI_data(raw, nr, nc, num_tones)
 
 
 def process_CSI(CSI_data_list, range_threshold):
     """
     Process the CSI data
-    :param CSI_data_list: list of numpy arrays
+    :param CSI_data_list: numpy array shaped (streams, tones), or list of numpy arrays
     :param range_threshold: range in desired units
-    :return:
+    :return: numpy array with a boolean for each set of subcarriers
     """
-    csi_data_sets = len(CSI_data_list)
-    sets_state = [None] * csi_data_sets
+    data = np.asarray(CSI_data_list)
+    return CSI_Gating.db_range(data, None, range_threshold, np.arange(len(data)))
 
-    # access each individual numpy array
-    for data_set in range(csi_data_sets):
-        subcarriers_db = dB_per_array(CSI_data_list[data_set])
-        set_range = np.amax(subcarriers_db) - np.amin(subcarriers_db)
-        sets_state[data_set] = set_range <= range_threshold
 
-    return sets_state  # contains a boolean for each set of subcarriers
+def log_prefix_len(header_dtype):
+    """
+    :param header_dtype: LOG_HEADER_DTYPE or BINARY_LOG_HEADER_DTYPE
+    :return: length of the buf_len and time stamp in front of every buffer in that kind of log
+    """
+    return header_dtype.itemsize - CSI_STATUS_DTYPE.itemsize
+
+
+def start_file(opened_file):
+    """
+    Write the start of a new log to opened_file, must come before the first to_file
+    :param opened_file: already opened, empty file
+    :return:
+    """
+    opened_file.write(LOG_MAGIC)
 
 
 def to_file(opened_file, buffer, buf_len, time_stamp):
@@ -206,20 +371,173 @@ def to_file(opened_file, buffer, buf_len, time_stamp):
     :param opened_file: already opened file
     :param buffer: data to be written
     :param buf_len: length of the buffer
-    :param time_stamp: absolute time stamp of received packet
+    :param time_stamp: absolute time stamp of received packet, seconds since the epoch
     :return:
     """
-    opened_file.write(struct.pack("=H", buf_len))
-    opened_file.write(time_stamp.encode("utf-8"))
+    opened_file.write(BINARY_LOG_PREFIX_STRUCT.pack(buf_len, int(time_stamp * 1000000)))
 
     opened_file.write(buffer)
 
 
+class PacketHandler:
+    """
+    What Alice does with every packet read from CSI_dev: decode its status and (for pings) its CSI,
+    gate it, queue a chunk of the payload to send, extract key bits and log it. main runs it on
+    the device, CSI_Benchmark.py runs the same code against a simulated one.
+    """
+
+    def __init__(
+        self,
+        gate,
+        sender,
+        metrics,
+        log=None,
+        store=False,
+        key_extractor=None,
+        key_file=None,
+        verbose=False,
+    ):
+        """
+        :param gate: CSI_Gating.CSIGate a ping has to pass before a chunk is sent
+        :param sender: CSI_Sender.CSISender
+        :param metrics: CSI_Metrics.Metrics to count and time the packets in
+        :param log: CSI_Log_Writer.CSILogWriter or CSI_Store.CSIStoreWriter, None to not log
+        :param store: log is a CSIStoreWriter
+        :param key_extractor: CSI_Key.KeyExtractor the CSI of the pings goes to, None for none
+        :param key_file: opened binary file the key blocks are appended to
+        :param verbose: print every packet that is sent
+        """
+        self.gate = gate
+        self.sender = sender
+        self.metrics = metrics
+        self.log = log
+        self.store = store
+        self.key_extractor = key_extractor
+        self.key_file = key_file
+        self.verbose = verbose
+        self.packet_count = 0  # packets sent
+        self.message_count = 1
+        self.device_drops = DeviceDrops()
+        metrics.gauge("device_dropped_estimate", lambda: self.device_drops.dropped)
+
+        # latency histograms (nanoseconds), see CSI_Metrics.py
+        self.decode_time = metrics.histogram("decode")
+        self.gate_time = metrics.histogram("gate")
+        self.send_time = metrics.histogram("send")
+        self.log_time = metrics.histogram("log_write")
+        if key_extractor is not None:
+            self.key_time = metrics.histogram("key")
+
+    def decide_packet(self, buff, cnt, time_stamp):
+        """
+        Get the meta data and CSI of a received packet and send a packet if the CSI passes
+        :param buff: buffer read from CSI_dev
+        :param cnt: how many bytes are in the buffer
+        :param time_stamp: when the buffer was read, None to stamp it now
+        :return: csi_object of the packet
+        """
+        start = time.perf_counter_ns()
+        self.metrics.count("seen")
+        csi_object = record_status(buff, cnt)  # Get meta data of received packet
+        if time_stamp is not None:
+            csi_object.time_stamp = time_stamp
+
+        if csi_object.payload_len == PING_PAYLOAD_SIZE:
+            csi_object.data = record_CSI_data(  # Get CSI data of received packet
+                buff, csi_object.nr, csi_object.nc, csi_object.num_tones, False
+            )
+            decoded = time.perf_counter_ns()
+            self.decode_time.record(decoded - start)
+            self.metrics.count("ping")
+
+            passed = self.gate(csi_object)
+            gated = time.perf_counter_ns()
+            self.gate_time.record(gated - decoded)
+
+            if passed:
+                self.metrics.count("gated")
+                if self.sender.send():
+                    self.send_time.record(time.perf_counter_ns() - gated)
+                    self.packet_count += 1
+                    self.metrics.count("sent")
+                    if self.verbose:
+                        print("packet ", self.packet_count, " sent")
+
+            if self.key_extractor is not None:
+                keyed = time.perf_counter_ns()
+                for block in self.key_extractor.add_packet(csi_object.data):
+                    self.key_file.write(block)
+                self.key_time.record(time.perf_counter_ns() - keyed)
+
+        self.message_count += 1
+        return csi_object
+
+    def log_packet(self, buff, cnt, time_stamp, csi_object=None):
+        """
+        Write a received packet to the log file or store
+        :param buff: buffer read from CSI_dev
+        :param cnt: how many bytes are in the buffer
+        :param time_stamp: when the buffer was read
+        :param csi_object: csi_object of the packet if decide_packet already made it
+        :return:
+        """
+        start = time.perf_counter_ns()
+        if csi_object is None:
+            csi_object = record_status(buff, cnt)
+            csi_object.time_stamp = time_stamp
+
+        if self.store:
+            if csi_object.data is None and csi_object.csi_len > 0:
+                csi_object.data = record_CSI_data(
+                    buff, csi_object.nr, csi_object.nc, csi_object.num_tones, False
+                )
+            self.log.append(csi_object, csi_object.data)
+        else:
+            self.log.write(buff, csi_object.buf_len, csi_object.time_stamp)
+        self.log_time.record(time.perf_counter_ns() - start)
+
+    def receive_loop(self, fd, seconds=None):
+        """
+        Alice's sequential loop: read CSI_dev, decide and log every packet
+        :param fd: CSI device from open_csi_device
+        :param seconds: return after this many seconds, None to loop until the process is signalled
+        :return: number of packets read
+        """
+        pool = CSIBufferPool()
+        read_wait_time = self.metrics.histogram("read_wait")
+        self.metrics.gauge("pool_misses", lambda: pool.misses)
+        end = None if seconds is None else time.monotonic() + seconds
+        packets = 0
+
+        wait_start = time.perf_counter_ns()
+        while end is None or time.monotonic() < end:
+
+            buff = pool.acquire()
+            # Get buffer from CSI_dev file
+            cnt, buff = read_csi_data(fd, BUFF_SIZE, buff)
+
+            # Wait until bytes were actually read from buffer
+            if cnt > 0:
+                read_wait_time.record(time.perf_counter_ns() - wait_start)
+                self.device_drops.check(buff, cnt)
+                csi_object = self.decide_packet(buff, cnt, None)
+
+                if self.log is not None:
+                    self.log_packet(buff, cnt, csi_object.time_stamp, csi_object)
+                packets += 1
+                wait_start = time.perf_counter_ns()
+
+            pool.release(buff)
+        return packets
+
+
 def main():
     """
     Main fucntion that loops until signaled to exit
     :return:
     """
+    # CSI_Store, CSI_Log_Writer, CSI_Key and CSI_Pipeline import this module, so they are only
+    # imported below when they are needed
 
     def handler(signal_received, frame):
         """
@@ -229,76 +547,333 @@ def main():
         :return:
         """
         # Handle any cleanup here
-        close_csi_device(fd)
+        if pipeline is not None:
+            pipeline.stop()  # let the threads finish the packets already read
+            print("Pipeline stats:", pipeline.stats())
         if log_enabled:
+            # records dropped because every write batch was waiting on disk, next to the ring drops
             file_name.close()
+            print("Log records:", file_name.records, "dropped:", file_name.dropped)
+        close_csi_device(fd)
+        sender.close()  # send what is still queued
+        print(
+            "Datagrams sent:",
+            sender.datagrams,
+            "chunks dropped:",
+            sender.dropped,
+            "send errors:",
+            sender.send_errors,
+        )
+        if key_extractor is not None:
+            key_file.close()
+            # consecutive packets of Alice's own CSI stand in for the two ends of the link
+            print("Key (estimated from consecutive pings):", key_extractor.stats())
+        if reporter is not None:
+            reporter.stop()
+        print("Packets:", metrics.counters)
+        print(
+            "Dropped by CSI_dev (estimated from ping sequence number gaps):",
+            packet_handler.device_drops.dropped,
+        )
+        for name, histogram in metrics.histograms.items():
+            print("%-10s %s" % (name, histogram.snapshot()))
         print(" SIGINT or CTRL-C or ALARM detected. Exiting gracefully!")
-        print("Packets sent in", SECONDS_TO_RUN, "seconds is: ", packet_count)
-        print("Sending byte rate is:", packet_count * PACKET_SIZE / SECONDS_TO_RUN, "bytes/second")
+        seconds_run = time.monotonic() - run_start
+        packet_count = packet_handler.packet_count
+        print("Packets sent in", round(seconds_run, 3), "seconds is: ", packet_count)
+        print(
+            "Sending byte rate is:",
+            packet_count * args.chunk_size / seconds_run,
+            "bytes/second",
+        )
         exit(0)
 
+    parser = argparse.ArgumentParser(description="Alice: read CSI, decide and send")
+    parser.add_argument(
+        "log_file_name", nargs="?", help="log the CSI data to this file"
+    )
+    parser.add_argument(
+        "--seconds",
+        type=int,
+        default=SECONDS_TO_RUN,
+        help="seconds to run before exiting, 0 to run until interrupted (default %d)"
+        % SECONDS_TO_RUN,
+    )
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        help="log decoded CSI to a store directory (see CSI_Store.py) instead of a raw log",
+    )
+    parser.add_argument(
+        "--compress", action="store_true", help="compress the chunks of the store"
+    )
+    parser.add_argument(
+        "--log-flush-interval",
+        type=float,
+        default=None,
+        help="seconds before logged packets are written even if the write batch is not full"
+        " (default 1 for a log, 10 for a store)",
+    )
+    parser.add_argument(
+        "--log-fsync",
+        choices=["never", "batch", "rotate"],
+        default="never",
+        help="fsync the log never, after every write batch, or when a log file is finished",
+    )
+    parser.add_argument(
+        "--log-rotate-mb",
+        type=float,
+        default=None,
+        help="start a new log file (log_file_name.1, .2, ...) when it would grow past this",
+    )
+    parser.add_argument(
+        "--log-rotate-seconds",
+        type=float,
+        default=None,
+        help="start a new log file after this many seconds",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="read CSI_dev in its own thread into a ring, decide and log in separate threads",
+    )
+    parser.add_argument(
+        "--ring-slots",
+        type=int,
+        default=1024,
+        help="number of 4096 byte buffers in the pipeline ring",
+    )
+    parser.add_argument(
+        "--device",
+        default=CSI_DEVICE,
+        help="CSI device to read, e.g. the FIFO of CSI_Device_Sim.py (default %s)"
+        % CSI_DEVICE,
+    )
+    parser.add_argument(
+        "--gate",
+        type=CSI_Gating.parse_criterion,
+        action="append",
+        metavar="NAME=THRESHOLD",
+        help="CSI criterion a stream has to pass before a packet is sent, can be given more than "
+        "once: range, variance or spread (dB, at most) or rssi (at least); default range=%d"
+        % DB_THRESHOLD,
+    )
+    parser.add_argument(
+        "--gate-combine",
+        type=CSI_Gating.parse_combine,
+        default="all",
+        help="streams that have to pass: all, any or a number of streams",
+    )
+    parser.add_argument(
+        "--gate-streams",
+        type=CSI_Gating.parse_streams,
+        default=(0, 1),
+        help="comma separated streams the gate looks at, or all (default 0,1)",
+    )
+    parser.add_argument(
+        "--payload",
+        default=CSI_Sender.PAYLOAD_FILE,
+        help="file to send to Bob (default %s)" % CSI_Sender.PAYLOAD_FILE,
+    )
+    parser.add_argument(
+        "--dest",
+        type=CSI_Sender.parse_destination,
+        action="append",
+        metavar="HOST:PORT",
+        help="where to send the payload, can be given more than once (default %s:%d)"
+        % CSI_Sender.DESTINATION,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=PACKET_SIZE,
+        help="payload bytes sent per gated packet",
+    )
+    parser.add_argument(
+        "--payload-end",
+        choices=CSI_Sender.PAYLOAD_END_POLICIES,
+        default="stop",
+        help="when the payload is used up, stop sending or wrap around to its start",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="send every chunk this many times",
+    )
+    parser.add_argument(
+        "--no-framing",
+        action="store_true",
+        help="send the bare payload without the sequence number header (for older Bobs)",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print every packet that is sent (slows down the receive loop)",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        metavar="FILE",
+        help="write counters and latencies as JSON lines to FILE (- for stdout)",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=CSI_Metrics.REPORT_INTERVAL,
+        help="seconds between JSON lines",
+    )
+    parser.add_argument(
+        "--key",
+        metavar="FILE",
+        help="also extract secret key bits from the CSI of the pings and append them to FILE",
+    )
+    parser.add_argument(
+        "--key-hop",
+        type=int,
+        default=None,
+        help="pings per key block, about the channel's coherence time (see CSI_Key.py)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="serve counters and latencies as JSON on http://127.0.0.1:PORT/",
+    )
+    args = parser.parse_args()
+
+    if args.gate is None:
+        args.gate = [(CSI_Gating.db_range, DB_THRESHOLD)]
+    gate = CSI_Gating.CSIGate(args.gate, args.gate_combine, args.gate_streams)
+
     log_enabled = False
+    store_enabled = False
     file_name = ""
 
-    if len(sys.argv) == 2:
+    if args.log_file_name is not None:
         try:
-            file_name = open(sys.argv[1], "wb")
+            if args.store:
+                import CSI_Store
+
+                file_name = CSI_Store.CSIStoreWriter(
+                    args.log_file_name,
+                    compress=args.compress,
+                    flush_interval=args.log_flush_interval or CSI_Store.FLUSH_INTERVAL,
+                )
+                store_enabled = True
+            else:
+                import CSI_Log_Writer
+
+                rotate_bytes = None
+                if args.log_rotate_mb is not None:
+                    rotate_bytes = int(args.log_rotate_mb * 1000000)
+                file_name = CSI_Log_Writer.CSILogWriter(
+                    args.log_file_name,
+                    flush_interval=args.log_flush_interval
+                    or CSI_Log_Writer.FLUSH_INTERVAL,
+                    fsync=args.log_fsync,
+                    rotate_bytes=rotate_bytes,
+                    rotate_seconds=args.log_rotate_seconds,
+                )
         except IOError:
-            print("Couldn't open file: ", sys.argv[1])
+            print("Couldn't open file: ", args.log_file_name)
             return
 
         log_enabled = True
-        print("Logging enabled and opened: ", sys.argv[1])
+        print("Logging enabled and opened: ", args.log_file_name)
 
-    if len(sys.argv) > 2:
-        print("To many input arguments!")
+    # counters and latency histograms (nanoseconds) of the receive loop, see CSI_Metrics.py
+    metrics = CSI_Metrics.Metrics()
+    if log_enabled:
+        metrics.gauge("log_records", lambda: file_name.records)
+        metrics.gauge("log_dropped", lambda: file_name.dropped)
+
+    try:
+        payload = CSI_Sender.load_payload(args.payload)
+    except IOError:
+        print("Couldn't open file: ", args.payload)
         return
+    try:
+        sender = CSI_Sender.CSISender(
+            payload,
+            args.dest or [CSI_Sender.DESTINATION],
+            args.chunk_size,
+            args.payload_end,
+            args.repeat,
+            framing=not args.no_framing,
+        )
+    except ValueError as error:
+        print(error)
+        return
+    metrics.gauge("send_queue", sender.depth)
+    metrics.gauge("send_dropped", lambda: sender.dropped + sender.exhausted)
+    metrics.gauge("datagrams_sent", lambda: sender.datagrams)
+
+    key_extractor = None
+    key_file = None
+    if args.key is not None:
+        import CSI_Key
+
+        try:
+            key_file = open(args.key, "ab")
+        except IOError:
+            print("Couldn't open file: ", args.key)
+            return
+        key_extractor = CSI_Key.KeyExtractor(hop=args.key_hop or CSI_Key.HOP)
+        metrics.gauge("key_bits", lambda: key_extractor.key_bits)
 
     # Open CSI device and set CTRL-C interrupt and alarm handler
-    fd = open_csi_device()
+    fd = open_csi_device(args.device)
+    pipeline = None
+    reporter = None
+    packet_handler = PacketHandler(
+        gate,
+        sender,
+        metrics,
+        file_name if log_enabled else None,
+        store_enabled,
+        key_extractor,
+        key_file,
+        args.verbose,
+    )
     signal.signal(signal.SIGINT, handler)
     signal.signal(signal.SIGALRM, handler)
-    message_count = 1
 
-    alice_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    pay_file = open("scripture_payload.txt", "rb")
-    packet_count = 0
+    if args.pipeline:
+        import CSI_Pipeline
 
-    signal.alarm(SECONDS_TO_RUN)
+        # the reader thread drains CSI_dev, deciding and logging each run in their own thread
+        consumers = [packet_handler.decide_packet]
+        if log_enabled:
+            consumers.append(packet_handler.log_packet)
+        pipeline = CSI_Pipeline.CSIPipeline(
+            fd, consumers, args.ring_slots, metrics, packet_handler.device_drops
+        )
+        metrics.gauge("ring_depth", lambda: max(pipeline.stats()["depth"]))
+        metrics.gauge("ring_high_water", lambda: pipeline.ring.high_water)
+        metrics.gauge("ring_dropped", lambda: pipeline.ring.dropped)
+
+    if args.metrics_json is not None:
+        metrics_file = sys.stdout
+        if args.metrics_json != "-":
+            metrics_file = open(args.metrics_json, "w")
+        reporter = CSI_Metrics.JSONLinesReporter(
+            metrics, metrics_file, args.metrics_interval
+        )
+        reporter.start()
+    if args.metrics_port is not None:
+        CSI_Metrics.serve_http(metrics, args.metrics_port)
+        print("Metrics on http://127.0.0.1:%d/" % args.metrics_port)
+
+    signal.alarm(args.seconds)  # 0 sets no alarm
+    run_start = time.monotonic()
 
     print("Starting to parse!")
-    while True:
-
-        cnt, buff = read_csi_data(fd, BUFF_SIZE)  # Get buffer from CSI_dev file
-
-        # Wait until bytes were actually read from buffer
-        if cnt > 0:
-
-            csi_object = record_status(buff, cnt)  # Get meta data of received packet
+    if pipeline is not None:
+        pipeline.start()
+        while True:
+            signal.pause()
 
-            if csi_object.payload_len == PING_PAYLOAD_SIZE:
-                csi_object.data = record_CSI_data(  # Get CSI data of received packet
-                    buff, csi_object.nr, csi_object.nc, csi_object.num_tones, False
-                )
-
-                compute_flags = process_CSI(csi_object.data, DB_THRESHOLD)
-
-                if compute_flags[0] and compute_flags[1]:
-                    packet_count += 1
-                    alice_sock.sendto(pay_file.read(1024), ("10.10.0.3", 5005))
-                    print("packet ", packet_count, " sent")
-
-            # TODO finish what happens to the data (processing and setting a boolean) and set up way to write to a file
-            # print(message_count, "th msg : payload_len is: ", csi_object.payload_len)
-            message_count += 1
-
-            if log_enabled:
-                to_file(
-                    file_name,
-                    buff[0 : csi_object.buf_len],
-                    csi_object.buf_len,
-                    csi_object.time_stamp,
-                )
+    packet_handler.receive_loop(fd)
 
 
 if __name__ == "__main__":
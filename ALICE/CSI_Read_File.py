@@ -1,9 +1,20 @@
-import CSI_Class
+# CSI_Dashboard and CSI_Log import this module in turn, so they are only used inside functions
+import CSI_Dashboard
+import CSI_Log
 import CSI_Python_Parser
-import CSI_Plot
 import struct
 import os
 import sys
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+# log bytes gathered at a time when decoding many records, so the byte indices and unpacking
+# temporaries (several times the size of what they gather) stay small however long the log is
+GATHER_BYTES = 1 << 20
+# seconds iter_csi sleeps when the live device is empty, so an idle device does not busy a core
+DEVICE_POLL = 0.001
 
 
 def parse_info(file_name):
@@ -26,18 +37,30 @@ def parse_info(file_name):
     csi_packet_info = []
     cur = 0
 
+    # logs with binary time stamps start with LOG_MAGIC, older logs start right with a record
+    binary = f.read(len(CSI_Python_Parser.LOG_MAGIC)) == CSI_Python_Parser.LOG_MAGIC
+    if binary:
+        cur = len(CSI_Python_Parser.LOG_MAGIC)
+    else:
+        f.seek(0)
+
     one_byte = struct.Struct("=B")
     two_byte = struct.Struct("=H")
 
     while cur < (len_of_file - 4):  # loop until the end of the file is reached
 
-        cur_csi_obj = CSI_Class.CSI()  # Create new CSI obj to fill
+        cur_csi_obj = CSI_Python_Parser.CSIStatus()  # Create new CSI obj to fill
 
         # read all the meta data from the current
         cur_csi_obj.buf_len = two_byte.unpack(f.read(2))[0]
 
-        time_stamp = f.read(26)
-        cur_csi_obj.time_stamp = time_stamp.decode("utf-8")
+        if binary:
+            cur_csi_obj.time_stamp = struct.unpack("=q", f.read(8))[0] / 1000000.0
+            cur += 8
+        else:
+            time_stamp = f.read(26)
+            cur_csi_obj.time_stamp = time_stamp.decode("utf-8")
+            cur += 26
 
         tfs_stamp = f.read(8)
         cur_csi_obj.tfs_stamp = struct.unpack("=Q", tfs_stamp)[0]
@@ -70,7 +93,7 @@ def parse_info(file_name):
 
         cur_csi_obj.payload_len = two_byte.unpack(f.read(2))[0]
 
-        cur += 53
+        cur += 27
 
         # Check to see if there is any CSI data and if so read it from the file
         if cur_csi_obj.csi_len > 0:
@@ -92,6 +115,243 @@ def parse_info(file_name):
     return csi_packet_info
 
 
+def log_layout(buff):
+    """
+    Tell a log with binary time stamps from an older log with ASCII time stamps
+    :param buff: start of the log file (at least len(LOG_MAGIC) bytes unless the file is shorter)
+    :return: (byte offset of the first record, LOG_HEADER_DTYPE or BINARY_LOG_HEADER_DTYPE)
+    """
+    magic = CSI_Python_Parser.LOG_MAGIC
+    if bytes(buff[: len(magic)]) == magic:
+        return len(magic), CSI_Python_Parser.BINARY_LOG_HEADER_DTYPE
+    return 0, CSI_Python_Parser.LOG_HEADER_DTYPE
+
+
+def header_times(headers):
+    """
+    :param headers: record headers from read_headers
+    :return: time stamps of the records as numpy datetime64[us]; UTC for logs with binary time
+             stamps, local time for older logs
+    """
+    time_stamps = headers["time_stamp"]
+    if time_stamps.dtype.kind == "M":
+        return time_stamps.astype("M8[us]")
+    return time_stamps.astype("U").astype("M8[us]")
+
+
+def find_records(buff, start=None):
+    """
+    Walk a CSI log by its buf_len prefixes and find where every complete record starts
+    :param buff: contents of the log file (bytes, mmap or uint8 numpy array)
+    :param start: byte offset of the first record to walk from, None for the start of the log
+    :return: numpy array of record byte offsets, a trailing partial record is left out
+    """
+    two_byte = struct.Struct("=H")
+    len_of_file = len(buff)
+    first, header_dtype = log_layout(buff)
+    prefix_len = CSI_Python_Parser.log_prefix_len(header_dtype)
+
+    offsets = []
+    cur = first if start is None else start
+    while cur + header_dtype.itemsize <= len_of_file:
+        buf_len = two_byte.unpack_from(buff, cur)[0]
+        if cur + prefix_len + buf_len > len_of_file:
+            break  # record was cut off while it was being written
+        offsets.append(cur)
+        cur += prefix_len + buf_len
+    return np.array(offsets, dtype=np.int64)
+
+
+def read_headers(raw, offsets, header_dtype):
+    """
+    Gather the record headers at the given offsets into one structured array
+    :param raw: contents of the log file as a uint8 numpy array
+    :param offsets: record byte offsets from find_records
+    :param header_dtype: header layout of the log, from log_layout
+    :return: numpy array of header_dtype, one entry per record
+    """
+    headers = np.empty(len(offsets), dtype=header_dtype)
+    byte_idx = np.arange(header_dtype.itemsize)
+    step = max(1, GATHER_BYTES // header_dtype.itemsize)
+    for start in range(0, len(offsets), step):
+        header_idx = offsets[start : start + step, np.newaxis] + byte_idx
+        headers[start : start + step] = raw[header_idx].view(header_dtype)[:, 0]
+    return headers
+
+
+def decode_records(raw, offsets, headers):
+    """
+    Decode the CSI data of many records, vectorized per nr/nc/num_tones combination in blocks of
+    about GATHER_BYTES of packed CSI
+    :param raw: contents of the log file as a uint8 numpy array
+    :param offsets: record byte offsets from find_records
+    :param headers: record headers from read_headers
+    :return: complex64 numpy array shaped (n_packets, nr * nc, num_tones), sized for the largest
+             combination in the log; packets without CSI or with fewer antennae/tones are zero
+             filled
+    """
+    has_csi = headers["csi_len"] > 0
+    configs = np.unique(headers[["nr", "nc", "num_tones"]][has_csi])
+
+    max_streams = max([int(c["nr"]) * int(c["nc"]) for c in configs] or [0])
+    max_tones = max([int(c["num_tones"]) for c in configs] or [0])
+    data = np.zeros((len(offsets), max_streams, max_tones), dtype=np.complex64)
+
+    for config in configs:
+        nr = int(config["nr"])
+        nc = int(config["nc"])
+        num_tones = int(config["num_tones"])
+        sel = np.flatnonzero(
+            has_csi
+            & (headers["nr"] == nr)
+            & (headers["nc"] == nc)
+            & (headers["num_tones"] == num_tones)
+        )
+
+        # gather the packed CSI of the selected records a block at a time, zero past each
+        # record's csi_len
+        n_bytes = (2 * nr * nc * num_tones * CSI_Python_Parser.BIT_RESOLUTION + 7) // 8
+        byte_idx = np.arange(n_bytes)
+        step = max(1, GATHER_BYTES // n_bytes)
+        for start in range(0, len(sel), step):
+            block = sel[start : start + step]
+            valid = byte_idx < headers["csi_len"][block, np.newaxis]
+            csi_idx = offsets[block, np.newaxis] + headers.dtype.itemsize + byte_idx
+            csi_raw = raw[np.where(valid, csi_idx, 0)]
+            csi_raw[~valid] = 0
+            data[block, : nr * nc, :num_tones] = CSI_Python_Parser.decode_CSI_data(
+                csi_raw, nr, nc, num_tones
+            )
+    return data
+
+
+def parse_info_bulk(file_name):
+    """
+    Open the CSI log file and decode all of it at once instead of one CSI object per packet
+    :param file_name: name of the file to be opened and read
+    :return: (complex64 array shaped (n_packets, nr * nc, num_tones), structured array of headers)
+    """
+
+    # try to read the file, if it fails exit the program
+    try:
+        raw = np.fromfile(file_name, dtype=np.uint8)
+    except IOError:
+        print("Couldn't open file!")
+        sys.exit()
+
+    offsets = find_records(raw)
+    headers = read_headers(raw, offsets, log_layout(raw)[1])
+    data = decode_records(raw, offsets, headers)
+    return data, headers
+
+
+def _read_log_record(log_file, view, prefix_len):
+    """
+    Read the next record of a log file into view, laid out exactly as in the file
+    :param log_file: log file opened "rb"
+    :param view: writable memoryview with room for one record
+    :param prefix_len: length of buf_len and time stamp in front of the buffer, see log_prefix_len
+    :return: length of the record, 0 at the end of the file or at a partly written record
+    """
+    if log_file.readinto(view[0:2]) < 2:
+        return 0
+    buf_len = struct.unpack_from("=H", view, 0)[0]
+    if buf_len > CSI_Python_Parser.BUFF_SIZE:
+        return 0  # not a record boundary, the rest of the log can not be trusted
+    if log_file.readinto(view[2 : prefix_len + buf_len]) < prefix_len - 2 + buf_len:
+        return 0
+    return prefix_len + buf_len
+
+
+def _read_device_record(fd, view):
+    """
+    Read the next packet of the CSI device into view, laid out as a binary log record (see to_file)
+    :param fd: opened CSI device
+    :param view: writable memoryview with room for one record
+    :return: length of the record, 0 if the device had nothing to read
+    """
+    prefix_len = CSI_Python_Parser.BINARY_LOG_PREFIX_STRUCT.size
+    try:
+        cnt = os.readv(fd, [view[prefix_len:]])
+    except BlockingIOError:
+        return 0  # simulated device with nothing to read
+    if cnt <= 0:
+        return 0
+    buf_len = struct.unpack_from("=H", view, prefix_len + cnt - 2)[0]
+    CSI_Python_Parser.BINARY_LOG_PREFIX_STRUCT.pack_into(
+        view, 0, buf_len, int(time.time() * 1000000)
+    )
+    return prefix_len + buf_len
+
+
+def iter_csi(source, batch=256, max_wait=0.1, poll=DEVICE_POLL):
+    """
+    Decode CSI in batches from a log file or from the live CSI device, using the same memory no
+    matter how long the log or the run is. Nothing is read until the next batch is asked for, so a
+    slow consumer holds back the reader instead of having packets pile up in memory.
+    :param source: name of a log file, or the file descriptor returned by open_csi_device
+    :param batch: number of packets per batch
+    :param max_wait: live device only, hand out a partial batch after this many seconds
+    :param poll: live device only, seconds to sleep when it is empty; 0 keeps reading without a
+                 break, for when the packets matter more than a core spent on an idle device
+    :return: generator of (complex64 array shaped (packets, nr * nc, num_tones), structured array
+             of headers); the array is sized for the largest nr/nc/num_tones within each batch
+    """
+    record_max = 2 + CSI_Python_Parser.TIME_STAMP_LEN + CSI_Python_Parser.BUFF_SIZE
+    batch_buff = bytearray(batch * record_max)
+    view = memoryview(batch_buff)
+    raw = np.frombuffer(batch_buff, dtype=np.uint8)
+    offsets = np.zeros(batch, dtype=np.int64)
+
+    live = isinstance(source, int)
+    log_file = None
+    header_dtype = CSI_Python_Parser.BINARY_LOG_HEADER_DTYPE
+    if not live:
+        log_file = open(source, "rb")
+        magic = log_file.read(len(CSI_Python_Parser.LOG_MAGIC))
+        first, header_dtype = log_layout(magic)
+        log_file.seek(first)
+    prefix_len = CSI_Python_Parser.log_prefix_len(header_dtype)
+
+    try:
+        while True:
+            count = 0
+            cur = 0
+            started = None  # when the first packet of the batch came in
+            while count < batch:
+                if live:
+                    record_len = _read_device_record(
+                        source, view[cur : cur + record_max]
+                    )
+                    if record_len == 0:
+                        if count > 0 and time.monotonic() - started >= max_wait:
+                            break
+                        if poll > 0:
+                            time.sleep(poll)
+                        continue
+                else:
+                    record_len = _read_log_record(
+                        log_file, view[cur : cur + record_max], prefix_len
+                    )
+                    if record_len == 0:
+                        break
+
+                if count == 0:
+                    started = time.monotonic()
+                offsets[count] = cur
+                count += 1
+                cur += record_len
+
+            if count > 0:
+                headers = read_headers(raw, offsets[:count], header_dtype)
+                yield decode_records(raw, offsets[:count], headers), headers
+            if not live and count < batch:
+                return
+    finally:
+        if log_file is not None:
+            log_file.close()
+
+
 def main():
     if len(sys.argv) < 2:
         print("Provide file name to be processed")
@@ -101,18 +361,20 @@ def main():
         return
     file_name = sys.argv[1]
 
-    csi_data = parse_info(file_name)
-
-    # TODO: if info needs to be processed, do so right here
+    # only the record boundaries are needed to count the packets, nothing is decoded
+    with CSI_Log.CSILog(file_name) as log:
+        num_packets = len(log)
 
-    print("num packets: ", len(csi_data))
-    for i in range(0, 10):
-        if len(csi_data[i].data) == 2:
-            CSI_Plot.draw_two_stem_plots(csi_data[i].data)
-        elif len(csi_data[i].data) == 4:
-            CSI_Plot.draw_four_stem_plots(csi_data[i].data)
+    print("num packets: ", num_packets)
+    # replay the whole log in the dashboard instead of a blocking window per packet
+    feed = CSI_Dashboard.CSIFeed(
+        CSI_Dashboard.paced(iter_csi(file_name, CSI_Dashboard.BATCH), 1.0)
+    )
+    if CSI_Dashboard.run_dashboard(feed) is not None:
+        plt.show()
 
     print("done")
 
+
 if __name__ == "__main__":
     main()
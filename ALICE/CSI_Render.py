@@ -0,0 +1,441 @@
+import argparse
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
+
+import CSI_Gating
+import CSI_Log
+import CSI_Plot
+import CSI_Read_File
+
+PLOTS = ("stems", "constellation", "waterfall")
+FORMATS = ("png", "svg")
+WINDOW = 256  # packets in every waterfall image
+FRAMES_PER_TASK = 32  # images a worker renders in a row with the same figure
+FIG_SIZE = (8, 6)  # inches
+DPI = 100
+PNG_COMPRESSION = 1  # zlib level, 1 writes several times faster than the default 6
+
+# set by render_log before the pool is forked: the workers inherit the mapped log, so only packet
+# numbers go to them and only image counts come back
+_log = None
+# per process: the renderers made so far, by (plot, streams, tones), reused for every frame
+_renderers = {}
+
+
+class PlotRenderer:
+    """
+    One figure drawn again and again, headless on the Agg canvas. Axes, ticks and labels are drawn
+    once and kept as the background; every frame only puts new data in the animated artists, draws
+    them over the background and writes the canvas out. SVG has no canvas to reuse and is drawn in
+    full (still with the same figure and artists).
+    """
+
+    def __init__(self, num_streams, num_tones):
+        """
+        :param num_streams: streams (nr * nc) of the CSI drawn
+        :param num_tones: sub-carriers of the CSI drawn
+        """
+        self.fig = Figure(figsize=FIG_SIZE, dpi=DPI)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.title = self.fig.suptitle("", animated=True)
+        self.artists = [self.title]
+        self.layout(num_streams, num_tones)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    def layout(self, num_streams, num_tones):
+        """
+        Make the axes and the animated artists, in subclasses
+        """
+        raise NotImplementedError
+
+    def update(self, values):
+        """
+        Put the values of the next frame in the artists, in subclasses
+        """
+        raise NotImplementedError
+
+    def render(self, values, title, file_name, fmt="png"):
+        """
+        :param values: what update takes
+        :param title: title of the image
+        :param file_name: image file to write
+        :param fmt: "png" or "svg"
+        :return:
+        """
+        self.update(values)
+        self.title.set_text(title)
+        if fmt != "png":
+            self.fig.savefig(file_name, format=fmt)
+            return
+        self.canvas.restore_region(self.background)
+        for artist in self.artists:
+            self.fig.draw_artist(artist)
+        imsave(
+            file_name,
+            np.asarray(self.canvas.buffer_rgba()),
+            format="png",
+            dpi=DPI,
+            pil_kwargs={"compress_level": PNG_COMPRESSION},
+        )
+
+
+class StemRenderer(PlotRenderer):
+    """
+    Stem plots of the dB magnitudes of one packet, one subplot per stream
+    """
+
+    def layout(self, num_streams, num_tones):
+        self.freqs = CSI_Plot.tone_frequencies(num_tones)
+        cols = math.ceil(math.sqrt(num_streams))
+        rows = math.ceil(num_streams / cols)
+        self.stems = []
+        self.heads = []
+        for stream in range(num_streams):
+            ax = self.fig.add_subplot(rows, cols, stream + 1)
+            CSI_Plot.setup_stem_axes(ax, self.freqs)
+            ax.set_title("stream %d" % stream, fontsize="small")
+            self.stems.append(ax.plot([], [], color="C0", animated=True)[0])
+            self.heads.append(
+                ax.plot([], [], "o", color="C0", markersize=3, animated=True)[0]
+            )
+        self.fig.tight_layout(rect=(0, 0, 1, 0.95))
+        self.artists += self.stems + self.heads
+
+    def update(self, values):
+        """
+        :param values: dB magnitudes shaped (streams, tones), e.g. from CSI_Gating.dB_per_array
+        """
+        for stream, mags in enumerate(values):
+            self.stems[stream].set_data(*CSI_Plot.stem_path(self.freqs, mags))
+            self.heads[stream].set_data(self.freqs, mags)
+
+
+class ConstellationRenderer(PlotRenderer):
+    """
+    The CSI complex numbers of one packet on real/imaginary axis, a colour per stream
+    """
+
+    def layout(self, num_streams, num_tones):
+        ax = self.fig.add_subplot(111)
+        CSI_Plot.setup_complex_axes(ax)
+        ax.set_aspect("equal")
+        self.points = [
+            ax.plot([], [], ".", label=str(stream), animated=True)[0]
+            for stream in range(num_streams)
+        ]
+        ax.legend(handles=self.points, loc="lower left")
+        self.artists += self.points
+
+    def update(self, values):
+        """
+        :param values: complex CSI shaped (streams, tones)
+        """
+        for stream, data in enumerate(values):
+            self.points[stream].set_data(data.real, data.imag)
+
+
+class WaterfallRenderer(PlotRenderer):
+    """
+    dB magnitudes of every sub-carrier of one stream over a window of packets, first packet on top
+    """
+
+    def __init__(self, num_streams, num_tones, window=WINDOW):
+        """
+        :param window: packets in every image
+        """
+        self.window = window
+        super().__init__(num_streams, num_tones)
+
+    def layout(self, num_streams, num_tones):
+        freqs = CSI_Plot.tone_frequencies(num_tones)
+        half = CSI_Plot.TONE_SPACING / 2
+        ax = self.fig.add_subplot(111)
+        ax.set_xlabel("MHz")
+        ax.set_ylabel("packets after the first")
+        self.image = ax.imshow(
+            np.full((self.window, num_tones), np.nan, np.float32),
+            aspect="auto",
+            interpolation="none",
+            extent=(freqs[0] - half, freqs[-1] + half, self.window, 0),
+            vmin=CSI_Plot.DB_LIMITS[0],
+            vmax=CSI_Plot.DB_LIMITS[1],
+            animated=True,
+        )
+        self.fig.colorbar(self.image, ax=ax, label="dB")
+        self.artists.append(self.image)
+
+    def update(self, values):
+        """
+        :param values: dB magnitudes shaped (packets, tones), at most window packets
+        """
+        rows = np.full(self.image.get_array().shape, np.nan, np.float32)
+        rows[: len(values)] = values
+        self.image.set_data(rows)
+
+
+def get_renderer(plot, num_streams, num_tones, window=WINDOW):
+    """
+    :return: the renderer of this process for the plot and CSI shape, made the first time
+    """
+    key = (plot, num_streams, num_tones, window)
+    if key not in _renderers:
+        if plot == "stems":
+            _renderers[key] = StemRenderer(num_streams, num_tones)
+        elif plot == "constellation":
+            _renderers[key] = ConstellationRenderer(num_streams, num_tones)
+        else:
+            _renderers[key] = WaterfallRenderer(num_streams, num_tones, window)
+    return _renderers[key]
+
+
+def parse_range(text):
+    """
+    :param text: FIRST:END, either may be left out for the start or the end
+    :return: (first, end), None for a left out end
+    """
+    first, sep, end = text.partition(":")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected FIRST:END, not %r" % text)
+    try:
+        return (
+            float(first) if first else 0.0,
+            float(end) if end else None,
+        )
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected numbers in %r" % text)
+
+
+def select_packets(headers, packet_ranges=None, time_ranges=None):
+    """
+    :param headers: record headers of the log, from read_headers
+    :param packet_ranges: list of (first, end) record numbers, end excluded
+    :param time_ranges: list of (first, end) seconds after the first record
+    :return: list of the stretches of the log in any of the ranges (the whole log if no range is
+             given), each a sorted array of its record numbers that have CSI
+    """
+    count = len(headers)
+    selected = np.zeros(count, dtype=bool)
+    if not packet_ranges and not time_ranges:
+        selected[:] = True
+    for first, end in packet_ranges or ():
+        selected[int(first) : count if end is None else int(end)] = True
+    if time_ranges and count > 0:
+        times = CSI_Read_File.header_times(headers)
+        seconds = (times - times[0]) / np.timedelta64(1, "s")
+        for first, end in time_ranges:
+            end = np.inf if end is None else end
+            selected |= (seconds >= first) & (seconds < end)
+    # where selected stretches start and end
+    edges = np.flatnonzero(np.diff(selected, prepend=False, append=False))
+    has_csi = headers["csi_len"] > 0
+    return [
+        first + np.flatnonzero(has_csi[first:end])
+        for first, end in zip(edges[::2], edges[1::2])
+    ]
+
+
+def plan_frames(plot, packets, every=1, window=WINDOW):
+    """
+    :param plot: one of PLOTS
+    :param packets: selected stretches of record numbers, from select_packets
+    :param every: stems and constellation: draw only every this many selected packets
+    :param window: waterfall: packets per image, a window does not go past its stretch
+    :return: list of frames, each an array of the record numbers drawn in one image
+    """
+    if plot == "waterfall":
+        return [
+            stretch[i : i + window]
+            for stretch in packets
+            for i in range(0, len(stretch), window)
+        ]
+    packets = np.concatenate(packets) if packets else np.zeros(0, np.int64)
+    return [packets[i : i + 1] for i in range(0, len(packets), every)]
+
+
+def _render_frames(task):
+    """
+    Decode and draw the frames of one task in this process, with the same renderers throughout
+    :param task: (plot, list of frames, waterfall window and stream, output directory, format)
+    :return: number of images written
+    """
+    plot, frames, window, stream, out_dir, fmt = task
+    log, headers = _log
+    for packets in frames:
+        data = CSI_Read_File.decode_records(
+            log.raw, log.offsets[packets], headers[packets]
+        )
+        first = headers[packets[0]]
+        num_streams = int(first["nr"]) * int(first["nc"])
+        num_tones = int(first["num_tones"])
+        if plot == "waterfall":
+            stream_num = min(stream, data.shape[1] - 1)
+            values = CSI_Gating.dB_per_array(
+                data[:, stream_num, :num_tones], np.float32
+            )
+            title = "stream %d, packets %d to %d" % (
+                stream_num,
+                packets[0],
+                packets[-1],
+            )
+            name = "%s_%07d-%07d" % (plot, packets[0], packets[-1])
+        else:
+            values = data[0, :num_streams, :num_tones]
+            if plot == "stems":
+                values = CSI_Gating.dB_per_array(values, np.float32)
+            time_stamp = CSI_Read_File.header_times(headers[packets[:1]])[0]
+            title = "packet %d, %s" % (packets[0], time_stamp)
+            name = "%s_%07d" % (plot, packets[0])
+        renderer = get_renderer(plot, num_streams, num_tones, window)
+        renderer.render(values, title, os.path.join(out_dir, name + "." + fmt), fmt)
+    return len(frames)
+
+
+def render_log(
+    file_name,
+    out_dir,
+    plots=PLOTS,
+    packet_ranges=None,
+    time_ranges=None,
+    every=1,
+    window=WINDOW,
+    stream=0,
+    fmt="png",
+    workers=None,
+):
+    """
+    Render plots of the packets of a log to image files with a pool of worker processes. The
+    frames are split into tasks of FRAMES_PER_TASK images, every worker keeps its figures for all
+    the tasks it gets, and workers are forked so they share the mapped log instead of copies.
+    :param file_name: log file
+    :param out_dir: directory the images are written to, PLOT_PACKET.FORMAT
+    :param plots: which of PLOTS to render
+    :param packet_ranges: record numbers to draw, see select_packets; None and no time_ranges for
+                          every packet with CSI
+    :param time_ranges: seconds after the first record to draw, see select_packets
+    :param every: stems and constellation: draw only every this many packets
+    :param window: waterfall: packets per image
+    :param stream: waterfall: stream drawn
+    :param fmt: "png" or "svg"
+    :param workers: number of worker processes, None for one per CPU, 1 to render in this process
+    :return: number of images written and number of packets selected
+    """
+    global _log
+
+    log = CSI_Log.CSILog(file_name)
+    headers = CSI_Read_File.read_headers(log.raw, log.offsets, log.header_dtype)
+    packets = select_packets(headers, packet_ranges, time_ranges)
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = []
+    for plot in plots:
+        frames = plan_frames(plot, packets, every, window)
+        for i in range(0, len(frames), FRAMES_PER_TASK):
+            tasks.append(
+                (plot, frames[i : i + FRAMES_PER_TASK], window, stream, out_dir, fmt)
+            )
+
+    workers = workers or os.cpu_count() or 1
+    _log = (log, headers)
+    try:
+        if workers == 1 or len(tasks) <= 1:
+            images = sum(map(_render_frames, tasks))
+        else:
+            # fork, so the workers share the mapped log
+            context = multiprocessing.get_context("fork")
+            with context.Pool(min(workers, len(tasks))) as pool:
+                images = sum(pool.imap_unordered(_render_frames, tasks))
+    finally:
+        _log = None
+        log.close()
+    return images, sum(len(stretch) for stretch in packets)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render stem, constellation and waterfall plots of a CSI log to image files"
+    )
+    parser.add_argument("log", help="log file")
+    parser.add_argument("out_dir", help="directory the images are written to")
+    parser.add_argument(
+        "--plots",
+        default=",".join(PLOTS),
+        help="comma separated plots to render (default %s)" % ",".join(PLOTS),
+    )
+    parser.add_argument(
+        "--packets",
+        type=parse_range,
+        action="append",
+        metavar="FIRST:END",
+        help="record numbers to draw, END excluded, can be given more than once",
+    )
+    parser.add_argument(
+        "--time",
+        type=parse_range,
+        action="append",
+        metavar="FIRST:END",
+        help="seconds after the first record to draw, can be given more than once",
+    )
+    parser.add_argument(
+        "--every",
+        type=int,
+        default=1,
+        help="stems and constellation of every this many packets (default 1)",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=WINDOW,
+        help="packets per waterfall image (default %d)" % WINDOW,
+    )
+    parser.add_argument(
+        "--stream", type=int, default=0, help="stream of the waterfall (default 0)"
+    )
+    parser.add_argument("--format", choices=FORMATS, default="png")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="worker processes (default one per CPU, 1 for none)",
+    )
+    args = parser.parse_args()
+
+    plots = [plot for plot in args.plots.split(",") if plot]
+    for plot in plots:
+        if plot not in PLOTS:
+            print("Unknown plot:", plot)
+            sys.exit(1)
+
+    start = time.monotonic()
+    try:
+        images, packets = render_log(
+            args.log,
+            args.out_dir,
+            plots,
+            args.packets,
+            args.time,
+            args.every,
+            args.window,
+            args.stream,
+            args.format,
+            args.workers,
+        )
+    except IOError as error:
+        print("Couldn't open file!", error.filename)
+        sys.exit(1)
+    elapsed = time.monotonic() - start
+    print(
+        "%d images of %d packets in %.2f seconds (%.0f images/s)"
+        % (images, packets, elapsed, images / elapsed if elapsed > 0 else 0.0)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import mmap
+import os
+import select
+import socket
+import sys
+import threading
+
+# framing shared with Bob lives in COMMON
+COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "COMMON")
+sys.path.append(COMMON_DIR)
+import Framing
+
+PAYLOAD_FILE = "scripture_payload.txt"
+DESTINATION = ("10.10.0.3", 5005)  # Bob
+CHUNK_SIZE = 1024  # payload bytes per gated packet (PACKET_SIZE in CSI_Python_Parser)
+SEND_QUEUE = 4096  # chunks waiting for the sender thread before new ones are dropped
+SEND_BUFFER = 1 << 22  # SO_SNDBUF asked for, bytes
+PAYLOAD_END_POLICIES = ("stop", "wrap")
+
+
+def load_payload(file_name=PAYLOAD_FILE):
+    """
+    Map the payload file into memory so sending never reads the disk
+    :param file_name: file to send
+    :return: read only buffer with the whole file
+    """
+    with open(file_name, "rb") as payload_file:
+        try:
+            return mmap.mmap(payload_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b""  # an empty file can not be mapped
+
+
+def parse_destination(text):
+    """
+    :param text: HOST:PORT
+    :return: (host, port)
+    """
+    host, _, port = text.rpartition(":")
+    return host, int(port)
+
+
+class CSISender:
+    """
+    Sends the payload in sequence numbered chunks, one chunk every time the CSI passes the gate.
+    send() only counts the request; a sender thread sends every requested chunk from the mapped
+    payload on a non-blocking socket, draining as many as are waiting in one go, so the receive loop
+    never waits on the network or the disk.
+    """
+
+    def __init__(
+        self,
+        payload,
+        destinations=(DESTINATION,),
+        chunk_size=CHUNK_SIZE,
+        payload_end="stop",
+        repeat=1,
+        queue_len=SEND_QUEUE,
+        framing=True,
+    ):
+        """
+        :param payload: buffer to send, e.g. from load_payload
+        :param destinations: list of (host, port), every chunk is sent to each of them
+        :param chunk_size: payload bytes per chunk, the last chunk may be shorter
+        :param payload_end: "stop" sending or "wrap" around to the first chunk when the payload is
+                            used up; sequence numbers keep counting up either way
+        :param repeat: times every chunk is sent, more than 1 to make up for lost packets
+        :param queue_len: chunks that may wait to be sent before new ones are dropped
+        :param framing: put a Framing header (session, sequence number, offset, send time) in front
+                        of every chunk, False sends the bare payload like older versions; a framed
+                        payload can be at most Framing.MAX_PAYLOAD_LEN bytes
+        """
+        if payload_end not in PAYLOAD_END_POLICIES:
+            raise ValueError(
+                "payload_end must be one of " + ", ".join(PAYLOAD_END_POLICIES)
+            )
+        if framing and len(payload) > Framing.MAX_PAYLOAD_LEN:
+            raise ValueError(
+                "a framed payload can be at most %d bytes, Bob does not reassemble larger ones"
+                % Framing.MAX_PAYLOAD_LEN
+            )
+        self.payload = memoryview(payload)
+        self.destinations = list(destinations)
+        self.chunk_size = chunk_size
+        self.n_chunks = (len(self.payload) + chunk_size - 1) // chunk_size
+        self.payload_end = payload_end
+        self.repeat = repeat
+        self.queue_len = queue_len
+        self.framing = framing
+        self.session = Framing.new_session()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        self.sock.setblocking(False)
+
+        self.requested = 0  # chunks asked for, the next one gets this sequence number
+        self.done = 0  # chunks the sender thread has finished
+        self.dropped = 0  # chunks not queued because the queue was full
+        self.exhausted = 0  # chunks not queued because the payload was used up
+        self.datagrams = 0  # datagrams sent
+        self.send_errors = 0  # datagrams the socket refused
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def chunk(self, seq):
+        """
+        :param seq: sequence number of a chunk
+        :return: (byte offset in the payload, memoryview of the chunk)
+        """
+        offset = (seq % self.n_chunks) * self.chunk_size
+        return offset, self.payload[offset : offset + self.chunk_size]
+
+    def send(self):
+        """
+        Queue the next chunk, called when the CSI passes the gate
+        :return: False if the chunk was not queued (payload used up or queue full)
+        """
+        with self.cond:
+            if self.n_chunks == 0 or (
+                self.payload_end == "stop" and self.requested >= self.n_chunks
+            ):
+                self.exhausted += 1
+                return False
+            if self.requested - self.done >= self.queue_len:
+                self.dropped += 1
+                return False
+            self.requested += 1
+            self.cond.notify()
+        return True
+
+    def depth(self):
+        """
+        :return: chunks waiting to be sent
+        """
+        return self.requested - self.done
+
+    def _sendto(self, buffers, destination):
+        while True:
+            try:
+                self.sock.sendmsg(buffers, (), 0, destination)
+                self.datagrams += 1
+                return
+            except BlockingIOError:
+                select.select([], [self.sock], [])  # socket buffer full, wait for room
+            except OSError:
+                self.send_errors += 1  # e.g. no route to Bob, keep going
+                return
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.done == self.requested and not self.closed:
+                    self.cond.wait()
+                if self.done == self.requested:
+                    return
+                first, last = self.done, self.requested
+
+            # send everything that was queued while the lock was not held
+            for seq in range(first, last):
+                buffers = self.frame(seq)
+                for _ in range(self.repeat):
+                    for destination in self.destinations:
+                        self._sendto(buffers, destination)
+            with self.cond:
+                self.done = last
+
+    def frame(self, seq):
+        """
+        :param seq: sequence number of a chunk
+        :return: list of buffers that make up the datagram of the chunk (sent without copying)
+        """
+        offset, chunk = self.chunk(seq)
+        if not self.framing:
+            return [chunk]
+        flags = Framing.FLAG_WRAPPED if seq >= self.n_chunks else 0
+        header = Framing.pack_header(
+            self.session, seq, offset, len(self.payload), flags
+        )
+        return [header, chunk]
+
+    def close(self):
+        """
+        Send the chunks still queued and close the socket
+        :return:
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self.sock.close()
@@ -0,0 +1,401 @@
+import os
+import queue
+import sys
+import threading
+
+import numpy as np
+
+import CSI_Log
+import CSI_Python_Parser
+import CSI_Read_File
+
+CHUNK_SIZE = 4096  # packets per chunk
+MAX_CHUNKS = 3  # chunks in memory, packets are dropped while all wait on disk
+FLUSH_INTERVAL = 10.0  # seconds a partly filled chunk waits before it is written
+MAX_STREAMS = 9  # largest nr * nc the writer has room for (3x3)
+MAX_TONES = 114  # largest num_tones the writer has room for
+
+# header columns, all fixed width; every field that fits is stored as int16
+STORE_COLUMNS = [("tfs_stamp", np.uint64), ("time_stamp", "M8[us]")] + [
+    (name, np.int16)
+    for name in CSI_Python_Parser.CSI_STATUS_DTYPE.names
+    if name != "tfs_stamp"
+]
+DATA_COLUMN = "data"  # complex64 CSI, shaped (packets, nr * nc, num_tones)
+
+
+def _chunk_name(store_dir, chunk_num, compress):
+    name = os.path.join(store_dir, "chunk_%08d" % chunk_num)
+    if compress:
+        return name + ".npz"
+    return name
+
+
+def write_chunk(store_dir, chunk_num, columns, compress):
+    """
+    Write one chunk of columns to the store. The chunk is written under a temporary name and renamed
+    when it is complete, so readers never see a partly written chunk.
+    :param store_dir: store directory
+    :param chunk_num: number of the chunk, chunks are read back in this order
+    :param columns: dict of column name to numpy array, all with the same number of packets
+    :param compress: write one compressed .npz file instead of a directory of .npy files
+    :return:
+    """
+    name = _chunk_name(store_dir, chunk_num, compress)
+    tmp_name = os.path.join(store_dir, ".tmp_" + os.path.basename(name))
+
+    if compress:
+        with open(tmp_name, "wb") as chunk_file:
+            np.savez_compressed(chunk_file, **columns)
+    else:
+        os.mkdir(tmp_name)
+        for column, values in columns.items():
+            np.save(os.path.join(tmp_name, column + ".npy"), values)
+
+    os.rename(tmp_name, name)
+
+
+def list_chunks(store_dir):
+    """
+    :param store_dir: store directory
+    :return: sorted list of the complete chunks in the store
+    """
+    names = [name for name in os.listdir(store_dir) if name.startswith("chunk_")]
+    return [os.path.join(store_dir, name) for name in sorted(names)]
+
+
+def load_chunk(chunk_name, mmap=True):
+    """
+    Load one chunk of the store
+    :param chunk_name: chunk path from list_chunks
+    :param mmap: memory map uncompressed columns instead of reading them
+    :return: dict of column name to numpy array
+    """
+    if chunk_name.endswith(".npz"):
+        with np.load(chunk_name) as chunk:
+            return {column: chunk[column] for column in chunk.files}
+
+    mmap_mode = "r" if mmap else None
+    columns = {}
+    for file_name in os.listdir(chunk_name):
+        column = os.path.splitext(file_name)[0]
+        columns[column] = np.load(
+            os.path.join(chunk_name, file_name), mmap_mode=mmap_mode
+        )
+    return columns
+
+
+class StoreView:
+    """
+    All chunks of a store as one sequence of packets without copying them: the chunks stay as they
+    were loaded (memory mapped when uncompressed) and only the packets asked for are gathered.
+    Chunks can hold different antenna/tone counts, gathered CSI is padded to the largest.
+    """
+
+    def __init__(self, chunks):
+        """
+        :param chunks: list of dicts of column name to numpy array, from load_chunk, in store order
+        """
+        self.chunks = chunks
+        lengths = [len(chunk[DATA_COLUMN]) for chunk in chunks]
+        self.starts = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        self.streams = max([chunk[DATA_COLUMN].shape[1] for chunk in chunks] or [0])
+        self.tones = max([chunk[DATA_COLUMN].shape[2] for chunk in chunks] or [0])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def _locate(self, rows):
+        # packet numbers to (packet numbers as an array, chunk of every packet)
+        packets = np.atleast_1d(np.arange(len(self))[rows])
+        return packets, np.searchsorted(self.starts, packets, side="right") - 1
+
+    def data(self, rows=slice(None)):
+        """
+        :param rows: packet number, slice or array of packet numbers (or booleans)
+        :return: complex64 CSI of those packets shaped (packets, streams, tones)
+        """
+        packets, chunk_nums = self._locate(rows)
+        data = np.zeros((len(packets), self.streams, self.tones), dtype=np.complex64)
+        for chunk_num in np.unique(chunk_nums):
+            sel = chunk_nums == chunk_num
+            chunk_data = self.chunks[chunk_num][DATA_COLUMN]
+            local = packets[sel] - self.starts[chunk_num]
+            data[sel, : chunk_data.shape[1], : chunk_data.shape[2]] = chunk_data[local]
+        return data
+
+    def column(self, column, rows=slice(None)):
+        """
+        :param column: header column name, see STORE_COLUMNS
+        :param rows: packet number, slice or array of packet numbers (or booleans)
+        :return: values of the column for those packets
+        """
+        packets, chunk_nums = self._locate(rows)
+        values = np.empty(len(packets), dtype=dict(STORE_COLUMNS)[column])
+        for chunk_num in np.unique(chunk_nums):
+            sel = chunk_nums == chunk_num
+            local = packets[sel] - self.starts[chunk_num]
+            values[sel] = self.chunks[chunk_num][column][local]
+        return values
+
+    def __getitem__(self, rows):
+        """
+        :return: (CSI of the packets, dict of their header columns), see data and column
+        """
+        return self.data(rows), {
+            column: self.column(column, rows) for column, _ in STORE_COLUMNS
+        }
+
+    def iter_chunks(self):
+        """
+        :return: generator of (CSI, dict of header columns) of every chunk as loaded, not copied
+        """
+        for chunk in self.chunks:
+            header = {column: chunk[column] for column, _ in STORE_COLUMNS}
+            yield chunk[DATA_COLUMN], header
+
+    def concatenate(self):
+        """
+        :return: (CSI of every packet, dict of every header column), copied into single arrays
+        """
+        return self[:]
+
+
+def load_store(store_dir, mmap=True):
+    """
+    Load a whole store, see StoreView
+    :param store_dir: store directory
+    :param mmap: memory map uncompressed columns instead of reading them
+    :return: StoreView of every complete chunk
+    """
+    return StoreView([load_chunk(name, mmap) for name in list_chunks(store_dir)])
+
+
+class _Chunk:
+    # room for one chunk: the CSI and every header column, reused once the chunk is on disk
+    __slots__ = ("data", "columns", "count", "streams", "tones")
+
+    def __init__(self, chunk_size):
+        self.data = np.zeros((chunk_size, MAX_STREAMS, MAX_TONES), dtype=np.complex64)
+        self.columns = {
+            column: np.zeros(chunk_size, dtype=dtype) for column, dtype in STORE_COLUMNS
+        }
+        self.count = 0
+        self.streams = 0  # largest nr * nc in the chunk
+        self.tones = 0  # largest num_tones in the chunk
+
+
+class CSIStoreWriter:
+    """
+    Appends decoded packets to a store directory from a background thread. append() only copies
+    the packet into an in-memory chunk; full chunks, and partly filled ones every flush_interval
+    seconds, are written by the writer thread, so compressing a chunk never holds up the receive
+    loop. Readers can load the store at any time and see every chunk written so far.
+    """
+
+    def __init__(
+        self,
+        store_dir,
+        chunk_size=CHUNK_SIZE,
+        compress=False,
+        flush_interval=FLUSH_INTERVAL,
+        max_chunks=MAX_CHUNKS,
+    ):
+        """
+        :param store_dir: store directory, created if needed; existing chunks are appended to
+        :param chunk_size: packets per chunk
+        :param compress: write compressed .npz chunks
+        :param flush_interval: seconds before a partly filled chunk is written anyway
+        :param max_chunks: chunks that may be in memory at once
+        """
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self.store_dir = store_dir
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.chunk_num = len(list_chunks(store_dir))
+
+        self.free = queue.Queue()
+        for _ in range(max_chunks - 1):
+            self.free.put(_Chunk(chunk_size))
+        self.current = _Chunk(chunk_size)
+        self.full = queue.Queue()
+
+        self.records = 0  # packets accepted
+        self.dropped = 0  # packets dropped because every chunk was waiting on disk
+        self.closed = False
+        self.lock = threading.RLock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, csi_object, data):
+        """
+        Add one packet to the current chunk, called from the receive loop
+        :param csi_object: object with the header fields of the packet (see record_status)
+        :param data: decoded CSI shaped (nr * nc, num_tones), None if the packet has none
+        :return: False if the packet was dropped
+        """
+        with self.lock:
+            chunk = self.current
+            if chunk is None:
+                chunk = self.current = self._take_free(block=False)
+                if chunk is None:
+                    self.dropped += 1
+                    return False
+
+            row = chunk.count
+            for column, values in chunk.columns.items():
+                if column != "time_stamp":
+                    values[row] = getattr(csi_object, column)
+
+            time_stamp = csi_object.time_stamp
+            if not isinstance(time_stamp, str):
+                # seconds since the epoch, older logs have ASCII time stamps numpy parses itself
+                time_stamp = np.datetime64(int(time_stamp * 1000000), "us")
+            chunk.columns["time_stamp"][row] = time_stamp
+            # the row still holds a packet of an earlier chunk, maybe with more antennae or tones
+            chunk.data[row] = 0
+            if data is not None:
+                chunk.data[row, : data.shape[0], : data.shape[1]] = data
+                chunk.streams = max(chunk.streams, data.shape[0])
+                chunk.tones = max(chunk.tones, data.shape[1])
+
+            # only count the packet once it is complete, a signal handler may close mid-append
+            chunk.count += 1
+            self.records += 1
+            if chunk.count == self.chunk_size:
+                self._hand_off()
+        return True
+
+    def append_many(self, data, header):
+        """
+        Add many decoded packets at once, waits for a free chunk instead of dropping packets
+        :param data: complex array shaped (packets, nr * nc, num_tones)
+        :param header: structured array or dict with a column for every STORE_COLUMNS name
+        :return:
+        """
+        start = 0
+        with self.lock:
+            while start < len(data):
+                if self.current is None:
+                    self.current = self._take_free(block=True)
+                chunk = self.current
+                chunk.streams = max(chunk.streams, data.shape[1])
+                chunk.tones = max(chunk.tones, data.shape[2])
+                stop = min(len(data), start + self.chunk_size - chunk.count)
+                rows = slice(chunk.count, chunk.count + stop - start)
+                for column, values in chunk.columns.items():
+                    values[rows] = header[column][start:stop]
+                chunk.data[rows] = 0
+                chunk.data[rows, : data.shape[1], : data.shape[2]] = data[start:stop]
+
+                chunk.count += stop - start
+                self.records += stop - start
+                start = stop
+                if chunk.count == self.chunk_size:
+                    self._hand_off()
+
+    def _take_free(self, block):
+        try:
+            return self.free.get(block)
+        except queue.Empty:
+            return None
+
+    def _hand_off(self):
+        # lock must be held
+        self.full.put(self.current)
+        self.current = self._take_free(block=False)
+
+    def flush(self):
+        """
+        Hand the packets of the current chunk to the writer thread, even if it is not full
+        :return:
+        """
+        with self.lock:
+            if self.current is not None and self.current.count > 0:
+                self._hand_off()
+
+    def _run(self):
+        while True:
+            try:
+                chunk = self.full.get(timeout=self.flush_interval)
+            except queue.Empty:
+                # never wait on the lock, the receive loop may hold it while a signal closes us
+                if self.lock.acquire(blocking=False):
+                    try:
+                        if not self.closed:
+                            self.flush()
+                    finally:
+                        self.lock.release()
+                continue
+
+            if chunk is None:
+                return
+            self._write_chunk(chunk)
+            chunk.count = chunk.streams = chunk.tones = 0
+            self.free.put(chunk)
+
+    def _write_chunk(self, chunk):
+        # only keep the antennae and tones that were actually used
+        count = chunk.count
+        columns = {column: values[:count] for column, values in chunk.columns.items()}
+        columns[DATA_COLUMN] = chunk.data[:count, : chunk.streams, : chunk.tones]
+        write_chunk(self.store_dir, self.chunk_num, columns, self.compress)
+        self.chunk_num += 1
+
+    def close(self):
+        """
+        Write out everything still in memory and wait until it is on disk
+        :return:
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.flush()
+            self.full.put(None)
+        self.thread.join()
+
+
+def convert_log(log_file_name, store_dir, chunk_size=CHUNK_SIZE, compress=False):
+    """
+    Convert a raw log written by to_file into a store
+    :param log_file_name: raw CSI log
+    :param store_dir: store directory to write
+    :param chunk_size: packets per chunk
+    :param compress: write compressed .npz chunks
+    :return: number of packets converted
+    """
+    writer = CSIStoreWriter(store_dir, chunk_size, compress)
+    with CSI_Log.CSILog(log_file_name) as log:
+        raw = log.raw
+        for start in range(0, len(log), chunk_size):
+            offsets = log.offsets[start : start + chunk_size]
+            headers = CSI_Read_File.read_headers(raw, offsets, log.header_dtype)
+
+            header = {column: headers[column] for column, _ in STORE_COLUMNS}
+            header["time_stamp"] = CSI_Read_File.header_times(headers)
+            writer.append_many(
+                CSI_Read_File.decode_records(raw, offsets, headers), header
+            )
+        count = len(log)
+        del raw
+    writer.close()
+    return count
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Provide the log file to convert and the store directory to write")
+        return
+    if len(sys.argv) > 4 or (len(sys.argv) == 4 and sys.argv[3] != "compress"):
+        print("To many arguments")
+        return
+
+    count = convert_log(sys.argv[1], sys.argv[2], compress=len(sys.argv) == 4)
+    print("converted packets: ", count)
+
+
+if __name__ == "__main__":
+    main()
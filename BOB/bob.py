@@ -3,46 +3,243 @@ import fcntl
 import time
 import struct
 import os
+import sys
+import argparse
+import selectors
+import threading
+import queue
+import json
 from signal import signal, SIGINT
 
+# framing shared with Alice lives in COMMON
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "COMMON"))
+import Framing
+
+BUFFER_SIZE = 65535 # large enough for any datagram, framed chunks are longer than 1024 bytes
+RCVBUF_SIZE = 8 * 1024 * 1024 # socket receive buffer asked for, the kernel caps it at net.core.rmem_max
+BATCH_SIZE = 256 # most datagrams drained from the socket before the batch is handed to the writer
+WRITE_BUFFER = 1024 * 1024 # bytes the output file collects before writing to disk
+OUTPUT_DIR = "/home/icelab2/Documents"
+ALICE_IP = "10.10.0.1" # Alice is the AP
+DEFAULT_PORT = 5005
+PING_INTERVAL = 0.2 # seconds between pings
+PING_SIZE = 698 # bytes after the ICMP or UDP header, makes the payload Alice sees 766 bytes long
+PROBE_TYPES = ('icmp', 'udp')
+PROBE_PORT = 9 # UDP probes go to the discard port, Alice only needs to receive them
+ICMP_ECHO_REQUEST = 8
+MAX_CATCH_UP = 0.01 # seconds, late probes are sent right away up to this far behind and skipped after
+
+
+def checksum(data):
+	# internet checksum of ICMP
+	if len(data) % 2:
+		data += b'\0'
+	total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+	while total >> 16:
+		total = (total & 0xFFFF) + (total >> 16)
+	return ~total & 0xFFFF
+
+
+def openIcmpSocket():
+	# ping sockets work without root where net.ipv4.ping_group_range allows it, raw sockets need root
+	try:
+		return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+	except PermissionError:
+		return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+
+
+class ProbeSender:
+	"""
+	Sends the packets Alice measures the CSI of (ICMP echo requests like ping, or UDP datagrams of the
+	same size), from a background thread in place of the ping program. Probe n is due at
+	start + n * interval, so timing errors never add up. Late probes are sent right away; when the
+	thread falls more than MAX_CATCH_UP (or a whole interval) behind, the missed probes are skipped
+	instead of sent in a burst.
+	"""
+
+	def __init__(self, target, interval=PING_INTERVAL, size=PING_SIZE, probeType='icmp', port=PROBE_PORT):
+		self.target = target
+		self.interval = interval
+		self.probeType = probeType
+		self.port = port
+		self.payload = bytes(size)
+		if probeType == 'icmp':
+			self.sock = openIcmpSocket()
+		else:
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.ident = os.getpid() & 0xFFFF
+
+		self.sent = 0
+		self.skipped = 0 # probes left out because they were too late
+		self.errors = 0 # probes the socket refused
+		self.maxLate = 0.0 # most seconds a probe went out after it was due
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self._run, daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def packet(self, seq):
+		if self.probeType == 'udp':
+			return self.payload
+		# the kernel fills in the identifier and checksum itself on ping sockets
+		header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, self.ident, seq & 0xFFFF)
+		header = header[:2] + struct.pack('!H', checksum(header + self.payload)) + header[4:]
+		return header + self.payload
+
+	def _run(self):
+		start = time.monotonic()
+		n = 0
+		while True:
+			due = start + n * self.interval
+			delay = due - time.monotonic()
+			if self.stopped.wait(delay if delay > 0 else 0):
+				return
+			late = time.monotonic() - due
+			if late > max(self.interval, MAX_CATCH_UP):
+				missed = int(late / self.interval)
+				self.skipped += missed
+				n += missed
+				late -= missed * self.interval
+			self.maxLate = max(self.maxLate, late)
+			try:
+				self.sock.sendto(self.packet(n), (self.target, self.port))
+				self.sent += 1
+			except OSError:
+				self.errors += 1 # e.g. no route to Alice yet, keep going
+			n += 1
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+		self.sock.close()
+
+	def stats(self):
+		return {"sent": self.sent, "skipped": self.skipped, "errors": self.errors, "max_late": self.maxLate}
+
+
+class OutputWriter:
+	"""
+	Writes received text from a background thread, so the receive loop never waits on the disk or
+	the terminal. Whole batches are handed over and the file is written in large chunks.
+	"""
+
+	def __init__(self, fileName, echo):
+		self.file = open(fileName, 'wb', buffering=WRITE_BUFFER)
+		self.echo = echo
+		self.queue = queue.SimpleQueue()
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def write(self, data):
+		self.queue.put(data)
+
+	def _run(self):
+		while True:
+			data = self.queue.get()
+			if data is None:
+				return
+			self.file.write(data)
+			if self.echo:
+				# chunks can split multi byte characters
+				sys.stdout.write(data.decode(errors='replace'))
+				sys.stdout.flush()
+
+	def close(self):
+		# write out everything still queued
+		self.queue.put(None)
+		self.thread.join()
+		self.file.close()
+
+
 def main():
+	parser = argparse.ArgumentParser(description="Bob: receive Alice's payload")
+	parser.add_argument('--echo', action='store_true', help='print the received text to the terminal (slow)')
+	parser.add_argument('--rcvbuf', type=int, default=RCVBUF_SIZE, help='socket receive buffer in bytes')
+	parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='most datagrams received in one go')
+	parser.add_argument('--interface', default='wlan0', help='listen on the address of this interface (default wlan0)')
+	parser.add_argument('--ip', help='listen on this address instead of the one of --interface')
+	parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='UDP port to listen on (default %d)' % DEFAULT_PORT)
+	parser.add_argument('--output-dir', default=OUTPUT_DIR, help='directory for the received messages (default %s)' % OUTPUT_DIR)
+	parser.add_argument('--ping-target', default=ALICE_IP, help='address to ping (default Alice, %s)' % ALICE_IP)
+	parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL, help='seconds between pings, e.g. 0.001 for 1000 a second')
+	parser.add_argument('--ping-size', type=int, default=PING_SIZE, help='bytes after the ICMP/UDP header (default %d)' % PING_SIZE)
+	parser.add_argument('--probe', choices=PROBE_TYPES, default='icmp', help='send ICMP echo requests like ping (default) or UDP datagrams')
+	parser.add_argument('--probe-port', type=int, default=PROBE_PORT, help='port UDP probes are sent to (default %d)' % PROBE_PORT)
+	parser.add_argument('--no-ping', action='store_true', help='do not ping, e.g. when Alice reads a simulated CSI device')
+	parser.add_argument('--report-json', help='write the session counts and reports to this JSON file on exit')
+	args = parser.parse_args()
+
 	packetCounter = 0
+	byteCounter = 0
 	start = 0
 	end = 0
-	exitMsg = updateExitMsg(packetCounter, start, end)
+	exitMsg = updateExitMsg(packetCounter, byteCounter, start, end)
 
-	# Run the ping command as a background process
-	# Flags -i (interval) -s (byte payload to send) -a (audible confirmation)
-	print('Starting to Ping Server for CSI Data')
-	os.system('nohup ping -s 698 -i 0.2 -a 10.10.0.1 > ping_data.txt &')
-	time.sleep(0.1) # Wait for nohup to finish init
-	# Output current processes to make sure that it ran appropriately
-	print('\nOutput the current background processes:')
-	os.system('ps T')
+	# Puts framed chunks back together and keeps loss/reordering/latency counts per session
+	receiver = Framing.Receiver()
+
+	# Ping Alice from a thread of this process, so the rate is not limited to ping's 5 a second
+	# and nothing but this Bob's pings stop on exit
+	prober = None
+	if not args.no_ping:
+		print('Starting to Ping Server for CSI Data')
+		try:
+			prober = ProbeSender(args.ping_target, args.ping_interval, args.ping_size, args.probe, args.probe_port)
+			prober.start()
+			print('Sending {} probes to {} every {} seconds'.format(args.probe, args.ping_target, args.ping_interval))
+		except OSError as error:
+			print('Could not open the probe socket:', error)
 
 	# Open file to save received messages to 
 	nameOfFile = "receivedMessage"
-	fileName = os.path.join("/home/icelab2/Documents", nameOfFile + ".txt")
-	myFile = open(fileName, 'w')
+	fileName = os.path.join(args.output_dir, nameOfFile + ".txt")
+	myFile = OutputWriter(fileName, args.echo)
 
 	# Define the handler in the function, so that it inherets the main variables
-	def handler(*args):
+	def handler(*_):
 		print ("\n\nCTRL-C detected. Attempting Graceful Exit ")
 
 		#Handle the clean up
 		print ("Closing [ " + nameOfFile + ".txt ] output file")
 		myFile.close()
+
+		# Save the reassembled payload of every session and report how it arrived
+		for session in receiver.sessions.values():
+			sessionFile = os.path.join(os.path.dirname(fileName), "{}_{:08x}.txt".format(nameOfFile, session.session))
+			with open(sessionFile, 'wb') as f:
+				f.write(session.payload)
+			print(sessionReport(session.report()))
+			print("\t\tReassembled payload saved to " + sessionFile)
+		if receiver.unframed > 0:
+			print("Packets without a frame header: {}".format(receiver.unframed))
+		if receiver.rejected > 0:
+			print("Packets not reassembled (payload too long or too many sessions): {}".format(receiver.rejected))
 		
-		print('Killing background ping to server')
-		os.system('pkill -f ping')
+		if prober is not None:
+			print('Stopping the pings to the server')
+			prober.stop()
+			print("Probes sent: {sent}, skipped: {skipped}, errors: {errors}, most late: {max_late:.6f} seconds".format(**prober.stats()))
 		
-		print(updateExitMsg(packetCounter, start, end) + "\n")
+		print(updateExitMsg(packetCounter, byteCounter, start, end) + "\n")
+
+		if args.report_json is not None:
+			with open(args.report_json, 'w') as f:
+				json.dump({
+					"packets": packetCounter,
+					"bytes": byteCounter,
+					"elapsed": end - start,
+					"unframed": receiver.unframed,
+					"rejected": receiver.rejected,
+					"sessions": [session.report() for session in receiver.sessions.values()],
+					"probes": prober.stats() if prober is not None else None,
+				}, f, indent=2)
 		
 		exit(0)
 		
 	# Set IP address and port
-	UDP_IP = get_ip_address('wlan0')
-	UDP_PORT = 5005
+	UDP_IP = args.ip or get_ip_address(args.interface)
+	UDP_PORT = args.port
 	
 	# Signal process to handle exit gracefully
 	signal(SIGINT, handler)
@@ -51,24 +248,40 @@ def main():
 	print ("\nYour Computer IP Address is:", UDP_IP)
 	print ("Your Open Port is:", UDP_PORT)
 	
-	# Open socket to listen on
+	# Open socket to listen on, with a large receive buffer so bursts are not dropped
 	sock = socket.socket(socket.AF_INET, # Internet
 		             socket.SOCK_DGRAM) # UDP
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, args.rcvbuf)
+	print ("Socket receive buffer:", sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), "bytes")
 	sock.bind((UDP_IP, UDP_PORT))
+	print ("Listening on {}:{}".format(UDP_IP, UDP_PORT))
+	sock.setblocking(False)
+	selector = selectors.DefaultSelector()
+	selector.register(sock, selectors.EVENT_READ)
 
-	# Listen and record packets from socket
+	# Listen and record packets from socket: wait until there is something to read, then drain up
+	# to a batch of datagrams without waiting again and hand their text to the writer in one go
+	recvBuffer = bytearray(BUFFER_SIZE)
+	recvView = memoryview(recvBuffer)
 	while True:
-	    data, addr = sock.recvfrom(1024) # buffer size is 1024 bytes
-	    if packetCounter == 0:
-	    	 start = time.time()
-	    print (data.decode())	
-	    myFile.write(str(data.decode()))
-
-	    # Update the exit message
-	    packetCounter += 1
-	    end = time.time()
-	    #exitMsg = updateExitMsg(packetCounter, start, end)
-	    
+		selector.select()
+		batch = []
+		for _ in range(args.batch):
+			try:
+				nbytes, addr = sock.recvfrom_into(recvBuffer)
+			except BlockingIOError:
+				break
+			end = time.time()
+			if packetCounter == 0:
+				start = end
+			session, chunk = receiver.receive(recvView[:nbytes], addr, end) # strips the frame header, if any
+			batch.append(bytes(chunk))
+
+			# Update the exit message
+			packetCounter += 1
+			byteCounter += len(chunk)
+		if batch:
+			myFile.write(b"".join(batch))
 
 	
 def get_ip_address(ifname):
@@ -81,13 +294,13 @@ def get_ip_address(ifname):
 		)[20:24])
 
 
-def updateExitMsg(packetCounter, start, end):
+def updateExitMsg(packetCounter, byteCounter, start, end):
 	capture = "Packets Captured: {}".format(packetCounter)
 	elapsedTime = end - start
 	msgTime = "Elapsed time: " + time.strftime("%H:%M:%S", time.gmtime(elapsedTime))
-	# Calculate Transmission Rate
-	if packetCounter > 0:
-		rr = (packetCounter * 1024) / elapsedTime
+	# Calculate Transmission Rate from the payload bytes actually received
+	if packetCounter > 0 and elapsedTime > 0:
+		rr = byteCounter / elapsedTime
 		rx = (rr * 8) / 1000
 		msgTime   = "Elapsed time: " + time.strftime("%H:%M:%S", time.gmtime(elapsedTime))
 		rxRate    = "RxRate: {} Bytes/Second".format(rr)
@@ -99,6 +312,23 @@ def updateExitMsg(packetCounter, start, end):
 	return "Session info:\t" + capture + "\n\t\t" + msgTime + "\n\t\t" + rxRate + "\n\t\t" + bps
 
 
+def sessionReport(report):
+	def ms(value):
+		return "-" if value is None else "{:.3f}".format(value)
+
+	lines = [
+		"Session {:08x}:".format(report["session"]),
+		"Packets: {} unique, {} duplicates, {} reordered, {} lost ({:.2%})".format(
+			report["unique"], report["duplicates"], report["reordered"], report["lost"], report["loss_rate"]),
+		"Goodput: {:.1f} Bytes/Second over {:.2f} seconds".format(report["goodput"], report["elapsed"]),
+		"Payload: {} of {} bytes received".format(report["payload_covered"], report["payload_len"]),
+		# one way, only meaningful when Alice's and Bob's clocks are synchronized
+		"Latency ms: p50 {} p90 {} p99 {} max {}".format(
+			ms(report["latency_ms_p50"]), ms(report["latency_ms_p90"]), ms(report["latency_ms_p99"]), ms(report["latency_ms_max"])),
+	]
+	return "\n\t\t".join(lines)
+
+
 #Start the Main Function
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,259 @@
+import random
+import struct
+import time
+
+MAGIC = b"CF"
+VERSION = 1
+
+# magic, version, flags, session, sequence number, offset of the chunk in the payload,
+# payload length, send time in microseconds since the epoch (network byte order)
+HEADER_STRUCT = struct.Struct("!2sBBIIIIq")
+HEADER_LEN = HEADER_STRUCT.size
+
+FLAG_WRAPPED = 1  # the sender went around the payload at least once before this chunk
+
+MAX_SEQ_TRACKED = 1 << 24  # sequence numbers a session checks for duplicates
+# the header is not authenticated and every session allocates its payload length twice, so both
+# are capped: a larger payload_len or a session past MAX_SESSIONS is not reassembled
+MAX_PAYLOAD_LEN = 1 << 24
+MAX_SESSIONS = 8
+LATENCY_SAMPLES = 4096  # latencies a session keeps for its percentiles
+
+
+def new_session():
+    """
+    :return: random session id, tells Bob runs of the same sender apart
+    """
+    return random.getrandbits(32)
+
+
+def pack_header(session, seq, offset, payload_len, flags=0, send_time=None):
+    """
+    :param session: session id from new_session
+    :param seq: sequence number of the chunk, counts up from 0 for every chunk sent
+    :param offset: byte offset of the chunk in the payload
+    :param payload_len: length of the whole payload in bytes
+    :param flags: FLAG_* bits
+    :param send_time: seconds since the epoch, None for now
+    :return: header bytes to send in front of the chunk
+    """
+    if send_time is None:
+        send_time = time.time()
+    return HEADER_STRUCT.pack(
+        MAGIC,
+        VERSION,
+        flags,
+        session,
+        seq & 0xFFFFFFFF,
+        offset,
+        payload_len,
+        int(send_time * 1000000),
+    )
+
+
+def parse_header(datagram):
+    """
+    :param datagram: received bytes
+    :return: (session, seq, offset, payload_len, flags, send_time in seconds), None if the datagram
+             has no header (e.g. sent by an older Alice)
+    """
+    if len(datagram) < HEADER_LEN or bytes(datagram[:2]) != MAGIC:
+        return None
+    magic, version, flags, session, seq, offset, payload_len, send_us = (
+        HEADER_STRUCT.unpack_from(datagram)
+    )
+    if version != VERSION:
+        return None
+    return session, seq, offset, payload_len, flags, send_us / 1000000.0
+
+
+def percentiles(values, qs=(50, 90, 99)):
+    """
+    :param values: list of numbers
+    :param qs: percentiles to find
+    :return: list with the value at each percentile (nearest rank), None if there are no values
+    """
+    if not values:
+        return [None for _ in qs]
+    values = sorted(values)
+    return [values[min(len(values) - 1, int(len(values) * q / 100.0))] for q in qs]
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000.0
+
+
+class Session:
+    """
+    Receiving end of one sender session: puts the chunks back into a preallocated payload buffer and
+    keeps count of duplicates, reordering and loss.
+    """
+
+    def __init__(self, session, payload_len):
+        """
+        :param session: session id from the header
+        :param payload_len: length of the whole payload, from the header
+        """
+        self.session = session
+        self.payload = bytearray(payload_len)
+        self.covered = 0  # payload bytes received at least once
+        self._covered_at = bytearray(payload_len)  # 1 for every byte received
+
+        # 1 for every sequence number received, from first_seq on
+        self.seen = bytearray()
+        self.first_seq = None  # lowest sequence number seen
+        self.untracked = 0  # chunks too far from first_seq to check for duplicates
+        self.max_seq = -1
+        self.frames = 0
+        self.unique = 0
+        self.duplicates = 0
+        self.reordered = 0  # arrived after a chunk with a higher sequence number
+        self.bytes = 0  # unique payload bytes
+        self.first_time = None
+        self.last_time = None
+        # receive time - send time of unique chunks in seconds, a uniform sample of at most
+        # LATENCY_SAMPLES of them
+        self.latencies = []
+        self.max_latency = None
+
+    def add(self, seq, offset, chunk, send_time, recv_time):
+        """
+        Take in one chunk
+        :param seq: sequence number from the header
+        :param offset: payload offset from the header
+        :param chunk: payload bytes after the header
+        :param send_time: send time from the header, seconds since the epoch
+        :param recv_time: when the datagram was received, seconds since the epoch
+        :return: False if it was a duplicate
+        """
+        self.frames += 1
+        if self.first_time is None:
+            self.first_time = recv_time
+            self.first_seq = seq
+        self.last_time = recv_time
+
+        index = seq - self.first_seq
+        if index < 0 and len(self.seen) - index <= MAX_SEQ_TRACKED:
+            # a chunk sent before the first one received, rebase the window on it
+            self.seen[0:0] = bytes(-index)
+            self.first_seq = seq
+            index = 0
+        if 0 <= index < MAX_SEQ_TRACKED:
+            if index >= len(self.seen):
+                self.seen.extend(bytes(max(index + 1 - len(self.seen), len(self.seen))))
+            if self.seen[index]:
+                self.duplicates += 1
+                return False
+            self.seen[index] = 1
+        else:
+            self.untracked += 1
+
+        self.unique += 1
+        if seq < self.max_seq:
+            self.reordered += 1
+        else:
+            self.max_seq = seq
+        self.bytes += len(chunk)
+        self._sample_latency(recv_time - send_time)
+
+        end = min(offset + len(chunk), len(self.payload))
+        if offset < end:
+            self.payload[offset:end] = chunk[: end - offset]
+            covered = self._covered_at[offset:end].count(0)
+            if covered:
+                self.covered += covered
+                self._covered_at[offset:end] = b"\x01" * (end - offset)
+        return True
+
+    def _sample_latency(self, latency):
+        if self.max_latency is None or latency > self.max_latency:
+            self.max_latency = latency
+        # reservoir sampling: the unique-th latency replaces a random one with probability
+        # LATENCY_SAMPLES / unique
+        if len(self.latencies) < LATENCY_SAMPLES:
+            self.latencies.append(latency)
+        else:
+            slot = random.randrange(self.unique)
+            if slot < LATENCY_SAMPLES:
+                self.latencies[slot] = latency
+
+    def lost(self):
+        """
+        :return: chunks never received between the first and the highest sequence number seen
+        """
+        if self.first_seq is None:
+            return 0
+        # untracked chunks may be duplicates or lie outside the window, so this can go below 0
+        return max(0, self.max_seq - self.first_seq + 1 - self.unique)
+
+    def report(self):
+        """
+        :return: dict of the session counts, goodput in bytes/second and latency percentiles in ms
+        """
+        elapsed = 0.0
+        if self.first_time is not None:
+            elapsed = self.last_time - self.first_time
+        expected = self.unique + self.lost()
+        p50, p90, p99 = percentiles(self.latencies)
+        return {
+            "session": self.session,
+            "frames": self.frames,
+            "unique": self.unique,
+            "duplicates": self.duplicates,
+            "untracked": self.untracked,
+            "reordered": self.reordered,
+            "lost": self.lost(),
+            "loss_rate": self.lost() / expected if expected else 0.0,
+            "bytes": self.bytes,
+            "elapsed": elapsed,
+            "goodput": self.bytes / elapsed if elapsed > 0 else 0.0,
+            "payload_len": len(self.payload),
+            "payload_covered": self.covered,
+            "latency_ms_p50": _ms(p50),
+            "latency_ms_p90": _ms(p90),
+            "latency_ms_p99": _ms(p99),
+            "latency_ms_max": _ms(self.max_latency),
+        }
+
+
+class Receiver:
+    """
+    Keeps a Session for every (sender address, session id) seen
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS):
+        """
+        :param max_sessions: sessions reassembled at most, datagrams of further ones are rejected
+        """
+        self.sessions = {}
+        self.max_sessions = max_sessions
+        self.unframed = 0  # datagrams without a header
+        # datagrams with a payload_len over MAX_PAYLOAD_LEN or of a session too many
+        self.rejected = 0
+
+    def receive(self, datagram, addr, recv_time=None):
+        """
+        :param datagram: received bytes (or memoryview)
+        :param addr: sender address
+        :param recv_time: when it was received, None for now
+        :return: (Session, payload chunk), (None, datagram) if it had no header, or (None, payload
+                 chunk) if it was rejected
+        """
+        header = parse_header(datagram)
+        if header is None:
+            self.unframed += 1
+            return None, datagram
+        if recv_time is None:
+            recv_time = time.time()
+
+        session_id, seq, offset, payload_len, flags, send_time = header
+        key = (addr, session_id)
+        session = self.sessions.get(key)
+        chunk = datagram[HEADER_LEN:]
+        if session is None:
+            if payload_len > MAX_PAYLOAD_LEN or len(self.sessions) >= self.max_sessions:
+                self.rejected += 1
+                return None, chunk
+            session = self.sessions[key] = Session(session_id, payload_len)
+        session.add(seq, offset, chunk, send_time, recv_time)
+        return session, chunk
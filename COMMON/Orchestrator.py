@@ -0,0 +1,619 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import shlex
+import signal
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ALICE_SCRIPT = os.path.join(ROOT_DIR, "ALICE", "CSI_Python_Parser.py")
+SIM_SCRIPT = os.path.join(ROOT_DIR, "ALICE", "CSI_Device_Sim.py")
+BOB_SCRIPT = os.path.join(ROOT_DIR, "BOB", "bob.py")
+EVE_SCRIPT = os.path.join(ROOT_DIR, "EVE", "Packet_Sniff.py")
+
+SIM_DEVICE = "sim"  # --device value that runs a simulated CSI_dev for every run
+ALICE_IP = "10.10.0.1"  # addresses inside the network namespaces, same as in the lab
+BOB_IP = "10.10.0.3"
+LOCAL_IP = "127.0.0.1"
+PORT = 5005  # Bob's port, local runs count up from it
+
+# values a run uses for the parameters that are not swept
+DEFAULTS = {
+    "db_threshold": 20,  # DB_THRESHOLD in CSI_Python_Parser
+    "ping_interval": 0.2,  # seconds, Bob's ping or the simulated packet spacing
+    "chunk_size": 1024,  # payload bytes Alice sends per gated packet
+    "payload_bytes": 1 << 20,  # size of the payload file written for the run
+}
+
+# lines a role prints once it is ready for the next one to start
+ALICE_READY = "Starting to parse!"
+BOB_READY = "Listening on"
+SIM_READY = "Sending"
+EVE_READY = "Processing capture"
+READY_TIMEOUT = 30.0  # seconds a role may take to get ready
+STOP_TIMEOUT = 10.0  # seconds a role may take to exit after SIGINT before it is killed
+LINGER = 1.0  # seconds Bob keeps listening after Alice stopped, for datagrams in flight
+
+
+def parse_sweep(text):
+    """
+    :param text: NAME=V1,V2,..., NAME one of DEFAULTS
+    :return: (name, list of values)
+    """
+    name, _, values = text.partition("=")
+    if name not in DEFAULTS:
+        raise argparse.ArgumentTypeError(
+            "unknown parameter %s, use one of %s" % (name, ", ".join(DEFAULTS))
+        )
+    kind = type(DEFAULTS[name])
+    try:
+        return name, [kind(value) for value in values.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("bad value in " + text)
+
+
+def sweep_params(sweeps, repeat=1):
+    """
+    :param sweeps: list of (name, values) from parse_sweep
+    :param repeat: runs per combination
+    :return: list of parameter dicts, one per run, every combination of the swept values
+    """
+    names = [name for name, _ in sweeps]
+    runs = []
+    for values in itertools.product(*(values for _, values in sweeps)):
+        params = dict(DEFAULTS)
+        params.update(zip(names, values))
+        runs.extend(dict(params) for _ in range(repeat))
+    return runs
+
+
+def write_payload(file_name, size):
+    """
+    Write a text payload of numbered lines, so what Bob gets back is easy to check by eye
+    :param file_name: file to write
+    :param size: bytes
+    :return:
+    """
+    line = "%08d In the beginning was the Word, and the Word was with God.\n"
+    lines = []
+    written = 0
+    while written < size:
+        lines.append(line % len(lines))
+        written += len(lines[-1])
+    with open(file_name, "w") as payload_file:
+        payload_file.write("".join(lines)[:size])
+
+
+async def _run_ip(*args):
+    process = await asyncio.create_subprocess_exec(
+        "ip",
+        *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, error = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError("ip %s: %s" % (" ".join(args), error.decode().strip()))
+
+
+class NetnsPair:
+    """
+    Two network namespaces, Alice's and Bob's, joined by a veth pair. Every run gets its own pair,
+    so all runs can use the lab addresses and port at the same time. Needs root.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: unique name, at most 14 characters (interface names are limited to 15)
+        """
+        self.alice = name + "a"
+        self.bob = name + "b"
+
+    async def setup(self):
+        await _run_ip("netns", "add", self.alice)
+        await _run_ip("netns", "add", self.bob)
+        await _run_ip(
+            "link", "add", self.alice, "type", "veth", "peer", "name", self.bob
+        )
+        for namespace, ip in ((self.alice, ALICE_IP), (self.bob, BOB_IP)):
+            await _run_ip("link", "set", namespace, "netns", namespace)
+            await _run_ip("-n", namespace, "addr", "add", ip + "/24", "dev", namespace)
+            await _run_ip("-n", namespace, "link", "set", namespace, "up")
+            await _run_ip("-n", namespace, "link", "set", "lo", "up")
+
+    async def teardown(self):
+        # deleting a namespace deletes its end of the veth pair and with it the other end
+        for namespace in (self.alice, self.bob):
+            try:
+                await _run_ip("netns", "del", namespace)
+            except RuntimeError:
+                pass
+
+
+class Role:
+    """
+    One process of a run: Alice, Bob, Eve or the simulated CSI_dev. Its output is written to
+    NAME.log in the run directory and kept, and start() can wait for the line that says it is ready.
+    """
+
+    def __init__(self, name, command, run_dir, namespace=None):
+        """
+        :param name: name of the role, also the name of its log
+        :param command: argument list
+        :param run_dir: working directory of the process
+        :param namespace: network namespace to run it in, None for the current one
+        """
+        self.name = name
+        self.command = list(command)
+        if namespace is not None:
+            self.command = ["ip", "netns", "exec", namespace] + self.command
+        self.run_dir = run_dir
+        self.lines = []
+        self.process = None
+        self.returncode = None
+        self._ready = None
+        self._ready_event = asyncio.Event()
+        self._pump_task = None
+
+    async def start(self, ready=None, timeout=READY_TIMEOUT):
+        """
+        :param ready: start of the line the process prints when it is ready, None to not wait
+        :param timeout: seconds to wait for it
+        :return:
+        """
+        self._ready = ready
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command,
+            cwd=self.run_dir,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=dict(os.environ, PYTHONUNBUFFERED="1"),
+            start_new_session=True,  # a CTRL-C of the orchestrator only reaches it through stop()
+        )
+        self._pump_task = asyncio.ensure_future(self._pump())
+        if ready is None:
+            return
+        ready_wait = asyncio.ensure_future(self._ready_event.wait())
+        await asyncio.wait(
+            [ready_wait, self._pump_task],
+            timeout=timeout,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if not self._ready_event.is_set():
+            ready_wait.cancel()
+            if self._pump_task.done():
+                raise RuntimeError(
+                    "%s exited with %s, see %s.log"
+                    % (self.name, self.returncode, self.name)
+                )
+            raise RuntimeError(
+                "%s was not ready after %.0f seconds, see %s.log"
+                % (self.name, timeout, self.name)
+            )
+
+    async def _pump(self):
+        with open(os.path.join(self.run_dir, self.name + ".log"), "w") as log_file:
+            async for raw_line in self.process.stdout:
+                line = raw_line.decode(errors="replace").rstrip("\n")
+                log_file.write(line + "\n")
+                self.lines.append(line)
+                if self._ready is not None and line.startswith(self._ready):
+                    self._ready_event.set()
+        self.returncode = await self.process.wait()
+
+    def find(self, prefix):
+        """
+        :param prefix: start of a line
+        :return: the last line of the output that starts with prefix, None if there is none
+        """
+        for line in reversed(self.lines):
+            if line.startswith(prefix):
+                return line
+        return None
+
+    async def wait(self):
+        """
+        Wait for the process to exit by itself
+        :return: exit code
+        """
+        await self._pump_task
+        return self.returncode
+
+    async def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Send SIGINT, the roles exit gracefully on it, and kill the process if it does not exit
+        :param timeout: seconds to wait before killing it
+        :return: exit code
+        """
+        if self.process is None:
+            return None
+        if self.process.returncode is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(asyncio.shield(self._pump_task), timeout)
+            except asyncio.TimeoutError:
+                self.process.kill()
+        await self._pump_task
+        return self.returncode
+
+
+def _last_json_line(file_name):
+    try:
+        with open(file_name) as json_file:
+            lines = json_file.read().splitlines()
+    except IOError:
+        return None
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        return None  # empty, or the last line was cut short
+
+
+def _numbers(line):
+    # numbers in a line such as "Packets sent: 10 dropped: 0"
+    if line is None:
+        return []
+    return [float(word) for word in line.replace(",", " ").split() if _is_number(word)]
+
+
+def _is_number(word):
+    try:
+        float(word)
+        return True
+    except ValueError:
+        return False
+
+
+def collect(run_dir, roles):
+    """
+    Gather what the roles of a finished run measured
+    :param run_dir: run directory
+    :param roles: dict of role name to Role
+    :return: dict per role
+    """
+    results = {}
+    metrics = _last_json_line(os.path.join(run_dir, "alice_metrics.jsonl"))
+    if metrics is not None:
+        results["alice"] = {
+            "counters": metrics["counters"],
+            "gauges": metrics["gauges"],
+            "elapsed": metrics["elapsed"],
+            "histograms": metrics["histograms"],
+        }
+    try:
+        with open(os.path.join(run_dir, "bob.json")) as bob_file:
+            results["bob"] = json.load(bob_file)
+    except IOError:
+        pass
+    if "sim" in roles:
+        sent = _numbers(roles["sim"].find("Packets sent:"))
+        if sent:
+            results["sim"] = {"sent": int(sent[0]), "dropped": int(sent[1])}
+    eve = _last_json_line(os.path.join(run_dir, "eve_stats.jsonl"))
+    if eve is not None:
+        results["eve"] = {
+            "packets": eve["received"],
+            "bytes": eve["bytes"],
+            "frames": eve["frames"],
+            "dedup": eve["dedup"],
+        }
+    results["returncodes"] = {name: role.returncode for name, role in roles.items()}
+    return results
+
+
+async def run_one(index, params, options):
+    """
+    Run Alice, Bob and optionally Eve (and the simulated device) once with one set of parameters.
+    Bob starts first, then Eve, then Alice and finally the device, each once the one before is
+    ready; after options.duration seconds they are stopped the other way round.
+    :param index: number of the run, names its directory and (local runs) Bob's port
+    :param params: parameter dict, see DEFAULTS
+    :param options: parsed command line
+    :return: result dict of the run
+    """
+    run_dir = os.path.abspath(os.path.join(options.out, "run_%03d" % index))
+    result = {"run": index, "params": params, "dir": run_dir, "error": None}
+    roles = {}
+    order = []
+    netns = None
+
+    async def start(name, command, namespace, ready, extra):
+        role = roles[name] = Role(
+            name, command + shlex.split(extra), run_dir, namespace
+        )
+        order.append(role)
+        await role.start(ready)
+
+    try:
+        os.makedirs(run_dir, exist_ok=True)
+        with open(os.path.join(run_dir, "params.json"), "w") as params_file:
+            json.dump(params, params_file, indent=2)
+
+        payload = options.payload
+        if payload is None:
+            payload = os.path.join(run_dir, "payload.txt")
+            write_payload(payload, params["payload_bytes"])
+
+        simulated = options.device == SIM_DEVICE
+        device = options.device
+        if simulated:
+            device = os.path.join(run_dir, "CSI_dev")
+            if not os.path.exists(device):
+                os.mkfifo(device)
+
+        alice_ns = bob_ns = None
+        if options.netns:
+            netns = NetnsPair("%s%d" % (options.netns_prefix, index))
+            alice_ns, bob_ns = netns.alice, netns.bob
+            alice_ip, bob_ip, port = ALICE_IP, BOB_IP, PORT
+        else:
+            alice_ip = bob_ip = LOCAL_IP
+            port = options.port + index
+
+        python = [sys.executable, "-u"]
+        bob_command = python + [
+            BOB_SCRIPT,
+            "--ip",
+            bob_ip,
+            "--port",
+            str(port),
+            "--output-dir",
+            run_dir,
+            "--report-json",
+            os.path.join(run_dir, "bob.json"),
+        ]
+        if simulated:
+            bob_command.append("--no-ping")  # the simulated device makes up the pings
+        else:
+            bob_command += [
+                "--ping-target",
+                alice_ip,
+                "--ping-interval",
+                str(params["ping_interval"]),
+            ]
+        alice_command = python + [
+            ALICE_SCRIPT,
+            "--device",
+            device,
+            "--seconds",
+            "0",
+            "--gate",
+            "range=%s" % params["db_threshold"],
+            "--chunk-size",
+            str(params["chunk_size"]),
+            "--payload",
+            payload,
+            "--dest",
+            "%s:%d" % (bob_ip, port),
+            "--metrics-json",
+            os.path.join(run_dir, "alice_metrics.jsonl"),
+        ]
+        sim_command = python + [
+            SIM_SCRIPT,
+            "--fifo",
+            device,
+            "--rate",
+            str(1.0 / params["ping_interval"]),
+            "--seed",
+            str(index),
+        ]
+
+        if netns is not None:
+            await netns.setup()
+        await start("bob", bob_command, bob_ns, BOB_READY, options.bob_args)
+        if options.eve_interface is not None:
+            # in namespaces Eve listens on Alice's end of the veth pair
+            interface = alice_ns or options.eve_interface
+            eve_command = python + [
+                EVE_SCRIPT,
+                "--live",
+                interface,
+                "eve_output.txt",
+                "--port",
+                str(port),
+                "--stats-json",
+                "eve_stats.jsonl",
+            ]
+            await start("eve", eve_command, alice_ns, EVE_READY, "")
+        await start("alice", alice_command, alice_ns, ALICE_READY, options.alice_args)
+        if simulated:
+            await start("sim", sim_command, None, SIM_READY, options.sim_args)
+
+        started = time.time()
+        await asyncio.sleep(options.duration)
+        result["elapsed"] = time.time() - started
+
+        # stop the device first so Alice is not sending when she stops, then give the datagrams
+        # in flight time to reach Bob
+        for role in reversed(order):
+            if role.name == "bob":
+                await asyncio.sleep(LINGER)
+            await role.stop()
+    except Exception as error:
+        result["error"] = str(error)
+    finally:
+        for role in reversed(order):
+            await role.stop()
+        if netns is not None:
+            await netns.teardown()
+
+    if not os.path.isdir(run_dir):
+        return result  # could not even make the run directory
+    result.update(collect(run_dir, roles))
+    with open(os.path.join(run_dir, "result.json"), "w") as result_file:
+        json.dump(result, result_file, indent=2)
+    return result
+
+
+def error_result(index, params, error):
+    """
+    :param index: number of the run
+    :param params: parameter dict of the run
+    :param error: exception the run ended with
+    :return: result dict of a run that did not finish
+    """
+    return {"run": index, "params": params, "error": str(error) or repr(error)}
+
+
+def summary_line(result):
+    """
+    :param result: result dict from run_one
+    :return: one line with the parameters and the main counts of the run
+    """
+    params = " ".join("%s=%s" % item for item in sorted(result["params"].items()))
+    if result["error"] is not None:
+        return "run %03d %s  ERROR %s" % (result["run"], params, result["error"])
+    counters = result.get("alice", {}).get("counters", {})
+    sessions = result.get("bob", {}).get("sessions", [])
+    line = "run %03d %s  device %s  alice seen %d gated %d sent %d  bob %d packets" % (
+        result["run"],
+        params,
+        result.get("sim", {}).get("sent", "-"),
+        counters.get("seen", 0),
+        counters.get("gated", 0),
+        counters.get("sent", 0),
+        result.get("bob", {}).get("packets", 0),
+    )
+    for session in sessions:
+        line += "  loss %.2f%% goodput %.0f B/s payload %d/%d" % (
+            session["loss_rate"] * 100,
+            session["goodput"],
+            session["payload_covered"],
+            session["payload_len"],
+        )
+    if "eve" in result:
+        line += "  eve %d packets" % result["eve"]["packets"]
+    return line
+
+
+async def orchestrate(runs, options):
+    """
+    Run every parameter set, options.parallel of them at a time
+    :param runs: list of parameter dicts
+    :param options: parsed command line
+    :return: list of result dicts in run order
+    """
+    limit = asyncio.Semaphore(options.parallel)
+    results_file = open(os.path.join(options.out, "results.jsonl"), "a")
+
+    async def limited(index, params):
+        async with limit:
+            print("run %03d started: %s" % (index, params))
+            try:
+                result = await run_one(index, params, options)
+            except Exception as error:
+                result = error_result(index, params, error)
+            results_file.write(json.dumps(result) + "\n")
+            results_file.flush()
+            print(summary_line(result))
+            return result
+
+    try:
+        # return_exceptions, so when interrupted gather waits until every run has stopped its
+        # roles and removed its namespaces
+        results = await asyncio.gather(
+            *(limited(index, params) for index, params in enumerate(runs)),
+            return_exceptions=True,
+        )
+    finally:
+        results_file.close()
+    # a run that was cancelled still gets a result, so it is summarized as an error
+    for index, result in enumerate(results):
+        if isinstance(result, BaseException):
+            results[index] = error_result(index, runs[index], result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run Alice, Bob and Eve together, once or as parameter sweeps"
+    )
+    parser.add_argument(
+        "--sweep",
+        type=parse_sweep,
+        action="append",
+        default=[],
+        metavar="NAME=V1,V2,...",
+        help="values of a parameter to run with, give it more than once to run every "
+        "combination: %s" % ", ".join(DEFAULTS),
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs per parameter combination"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="seconds every run lasts"
+    )
+    parser.add_argument("--parallel", type=int, default=1, help="runs at the same time")
+    parser.add_argument(
+        "--out", default="runs", help="directory for the run directories and results"
+    )
+    parser.add_argument(
+        "--device",
+        default=SIM_DEVICE,
+        help="CSI device for Alice, %s (default) for a simulated one per run"
+        % SIM_DEVICE,
+    )
+    parser.add_argument(
+        "--netns",
+        action="store_true",
+        help="run Alice and Bob of every run in their own network namespaces (needs root)",
+    )
+    parser.add_argument(
+        "--netns-prefix",
+        default="csi%d_" % (os.getpid() % 100000),
+        help="start of the namespace names",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=PORT,
+        help="Bob's port, runs without --netns use PORT + run number",
+    )
+    parser.add_argument(
+        "--payload",
+        help="file Alice sends (default a payload_bytes sized text per run)",
+    )
+    parser.add_argument(
+        "--eve-interface",
+        help="also run Eve (Packet_Sniff.py --live) capturing on this interface",
+    )
+    parser.add_argument("--alice-args", default="", help="more arguments for Alice")
+    parser.add_argument("--bob-args", default="", help="more arguments for Bob")
+    parser.add_argument(
+        "--sim-args", default="", help="more arguments for CSI_Device_Sim.py"
+    )
+    options = parser.parse_args()
+
+    if options.device != SIM_DEVICE and options.parallel > 1:
+        parser.error("runs on a real CSI device can not run in parallel")
+    if options.eve_interface is not None and not options.netns and options.parallel > 1:
+        parser.error("Eve would capture every run at once, use --netns or --parallel 1")
+
+    runs = sweep_params(options.sweep, options.repeat)
+    os.makedirs(options.out, exist_ok=True)
+    print(
+        "%d runs of %.0f seconds, %d at a time"
+        % (len(runs), options.duration, options.parallel)
+    )
+    try:
+        results = asyncio.run(orchestrate(runs, options))
+    except KeyboardInterrupt:
+        print(
+            "Interrupted, results so far are in",
+            os.path.join(options.out, "results.jsonl"),
+        )
+        return
+
+    print("\nSummary:")
+    for result in results:
+        print(summary_line(result))
+    if any(result["error"] is not None for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
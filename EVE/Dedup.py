@@ -0,0 +1,101 @@
+from array import array
+
+SEQ_MODULO = 4096  # 802.11 sequence numbers are 12 bits
+WINDOW = 1024  # sequence numbers remembered per stream, power of 2 below 2048
+COUNTS = ("frames", "unique", "duplicates", "gaps", "out_of_order", "resyncs")
+
+
+class _Stream:
+    # sequence state of one (transmitter, TID): the newest sequence number and, for the WINDOW
+    # sequence numbers up to it, a bit per fragment number seen
+    __slots__ = ("newest", "fragments", "counts")
+
+    def __init__(self, window):
+        self.newest = None
+        self.fragments = array("H", bytes(2 * window))
+        self.counts = dict.fromkeys(COUNTS, 0)
+
+
+class Deduplicator:
+    """
+    Drops retransmitted 802.11 frames. Every (transmitter, TID) keeps a sliding window of the last
+    WINDOW sequence numbers with one bit per fragment, so a frame is known to be a duplicate in a
+    constant number of steps however far apart the copies arrive, across the wrap from 4095 to 0
+    and with any number of transmitters. Sequence numbers skipped when the window moves on count as
+    gaps until they turn up late (out of order).
+    """
+
+    def __init__(self, window=WINDOW):
+        """
+        :param window: sequence numbers remembered per stream, a power of 2 below 2048
+        """
+        if window & (window - 1) or not 0 < window < SEQ_MODULO // 2:
+            raise ValueError("window must be a power of 2 below %d" % (SEQ_MODULO // 2))
+        self.window = window
+        self.streams = {}
+
+    def accept(self, transmitter, tid, seq, frag=0):
+        """
+        :param transmitter: transmitter address of the frame
+        :param tid: traffic identifier (QoS data), 0 otherwise
+        :param seq: sequence number, 0 to 4095
+        :param frag: fragment number, 0 to 15
+        :return: True the first time a (seq, frag) is seen, False for a duplicate
+        """
+        key = (transmitter, tid)
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = _Stream(self.window)
+        counts = stream.counts
+        counts["frames"] += 1
+        mask = self.window - 1
+        bit = 1 << frag
+
+        if stream.newest is None:
+            stream.newest = seq
+        ahead = (seq - stream.newest) % SEQ_MODULO
+        if 0 < ahead < SEQ_MODULO // 2:
+            # newer: forget the sequence numbers that fall out of the window
+            if ahead >= self.window:
+                stream.fragments = array("H", bytes(2 * self.window))
+            else:
+                for skipped in range(stream.newest + 1, stream.newest + ahead + 1):
+                    stream.fragments[skipped & mask] = 0
+            counts["gaps"] += ahead - 1
+            stream.newest = seq
+        elif ahead != 0:
+            behind = SEQ_MODULO - ahead
+            if behind >= self.window:
+                # too old to be a retransmission, the transmitter started over
+                counts["resyncs"] += 1
+                stream.fragments = array("H", bytes(2 * self.window))
+                stream.newest = seq
+            elif not stream.fragments[seq & mask]:
+                counts["out_of_order"] += 1
+                if counts["gaps"] > 0:  # not if it came before the stream's first frame
+                    counts["gaps"] -= 1
+
+        if stream.fragments[seq & mask] & bit:
+            counts["duplicates"] += 1
+            return False
+        stream.fragments[seq & mask] |= bit
+        counts["unique"] += 1
+        return True
+
+    def stats(self):
+        """
+        :return: dict of the counts over all streams (frames, unique, duplicates, gaps,
+                 out_of_order, resyncs) and the number of streams
+        """
+        total = dict.fromkeys(COUNTS, 0)
+        for stream in self.streams.values():
+            for name, value in stream.counts.items():
+                total[name] += value
+        total["streams"] = len(self.streams)
+        return total
+
+    def stream_stats(self):
+        """
+        :return: dict of (transmitter, tid) to the counts of that stream
+        """
+        return {key: dict(stream.counts) for key, stream in self.streams.items()}
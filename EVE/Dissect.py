@@ -0,0 +1,123 @@
+import collections
+import struct
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101  # bare IPv4
+LINKTYPE_IEEE802_11 = 105
+LINKTYPE_LINUX_SLL = 113  # tshark -i any
+LINKTYPE_IEEE802_11_RADIOTAP = 127  # monitor mode
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = 0x8100
+LLC_SNAP = b"\xaa\xaa\x03\x00\x00\x00"  # in front of IP in 802.11 data frames
+IPPROTO_UDP = 17
+
+# 802.11 frame control
+TYPE_DATA = 2
+SUBTYPE_QOS = 0x8
+SUBTYPE_NO_DATA = 0x4  # null function frames
+FLAG_TO_DS = 0x01
+FLAG_FROM_DS = 0x02
+FLAG_RETRY = 0x08
+FLAG_PROTECTED = 0x40
+FLAG_ORDER = 0x80  # QoS data frames carry an HT control field
+
+# transmitter, tid and seq/frag/retry are None for frames that were not captured as 802.11;
+# src to payload are None for 802.11 data frames without a UDP datagram that can be read
+NO_WLAN = (None, None, None, None, None)
+NO_UDP = (None, None, None, None, None)
+UDPPacket = collections.namedtuple(
+    "UDPPacket",
+    "transmitter tid seq frag retry src dst sport dport payload",
+)
+
+
+def _udp(frame, offset, wlan):
+    # IPv4 and UDP header starting at offset, wlan is (transmitter, tid, seq, frag, retry)
+    if len(frame) < offset + 20 or frame[offset] >> 4 != 4:
+        return None
+    ihl = (frame[offset] & 0x0F) * 4
+    flags_fragment = struct.unpack_from("!H", frame, offset + 6)[0]
+    if frame[offset + 9] != IPPROTO_UDP or flags_fragment & 0x3FFF:
+        return None  # not UDP, or an IP fragment
+    src = frame[offset + 12 : offset + 16]
+    dst = frame[offset + 16 : offset + 20]
+    offset += ihl
+    if len(frame) < offset + 8:
+        return None
+    sport, dport, length = struct.unpack_from("!HHH", frame, offset)
+    # the UDP length leaves out padding and a trailing FCS
+    payload = frame[offset + 8 : offset + max(length, 8)]
+    return UDPPacket(*wlan, src, dst, sport, dport, payload)
+
+
+def dissect_80211(frame, offset=0):
+    """
+    :param frame: captured bytes
+    :param offset: where the 802.11 header starts
+    :return: UDPPacket, None if the frame is no data frame (the UDP fields are None if it holds no
+             UDP datagram, so its sequence number can still be tracked)
+    """
+    if len(frame) < offset + 24:
+        return None
+    fc, flags = frame[offset], frame[offset + 1]
+    subtype = fc >> 4
+    if (fc >> 2) & 3 != TYPE_DATA or subtype & SUBTYPE_NO_DATA:
+        return None
+    # a copy, frames read from a followed capture are bytearrays and can not be dict keys
+    transmitter = bytes(frame[offset + 10 : offset + 16])
+    seq_ctrl = struct.unpack_from("<H", frame, offset + 22)[0]
+    header_len = 24
+    if flags & FLAG_TO_DS and flags & FLAG_FROM_DS:
+        header_len += 6  # fourth address
+    tid = 0
+    if subtype & SUBTYPE_QOS:
+        if len(frame) < offset + header_len + 2:
+            return None
+        tid = frame[offset + header_len] & 0x0F
+        header_len += 2
+        if flags & FLAG_ORDER:
+            header_len += 4
+    wlan = (transmitter, tid, seq_ctrl >> 4, seq_ctrl & 0x0F, bool(flags & FLAG_RETRY))
+    llc = offset + header_len
+    if (
+        flags & FLAG_PROTECTED  # encrypted, nothing to read
+        or frame[llc : llc + 6] != LLC_SNAP
+        or frame[llc + 6 : llc + 8] != b"\x08\x00"
+    ):
+        return UDPPacket(*wlan, *NO_UDP)
+    return _udp(frame, llc + 8, wlan) or UDPPacket(*wlan, *NO_UDP)
+
+
+def dissect(linktype, frame):
+    """
+    Parse a captured frame down to its UDP datagram (radiotap -> 802.11 -> LLC -> IPv4 -> UDP, or
+    Ethernet / Linux cooked / raw IP -> IPv4 -> UDP)
+    :param linktype: link type of the capture, LINKTYPE_*
+    :param frame: captured bytes
+    :return: UDPPacket, None if the frame holds no UDP datagram and is no 802.11 data frame
+    """
+    if linktype == LINKTYPE_IEEE802_11_RADIOTAP:
+        if len(frame) < 4:
+            return None
+        return dissect_80211(frame, struct.unpack_from("<H", frame, 2)[0])
+    if linktype == LINKTYPE_IEEE802_11:
+        return dissect_80211(frame)
+
+    if linktype == LINKTYPE_RAW:
+        return _udp(frame, 0, NO_WLAN)
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+    elif linktype == LINKTYPE_LINUX_SLL:
+        offset = 14
+    else:
+        return None
+    if len(frame) < offset + 2:
+        return None
+    ethertype = struct.unpack_from("!H", frame, offset)[0]
+    if ethertype == ETHERTYPE_VLAN and len(frame) >= offset + 6:
+        offset += 4
+        ethertype = struct.unpack_from("!H", frame, offset)[0]
+    if ethertype != ETHERTYPE_IPV4:
+        return None
+    return _udp(frame, offset + 2, NO_WLAN)
@@ -0,0 +1,63 @@
+import socket
+import time
+
+import Dissect
+
+ETH_P_ALL = 0x0003  # every protocol
+RCVBUF_SIZE = 1 << 22  # socket receive buffer asked for, bytes
+SNAP_LEN = 65535
+TIMEOUT = 0.2  # seconds a read waits before looking at stop again
+
+# interface type (/sys/class/net/IFACE/type) to the link type of its frames
+ARPHRD_LOOPBACK = 772
+ARPHRD_LINKTYPES = {
+    1: Dissect.LINKTYPE_ETHERNET,
+    ARPHRD_LOOPBACK: Dissect.LINKTYPE_ETHERNET,  # all zero Ethernet header
+    801: Dissect.LINKTYPE_IEEE802_11,
+    803: Dissect.LINKTYPE_IEEE802_11_RADIOTAP,  # monitor mode
+    65534: Dissect.LINKTYPE_RAW,  # no link layer header, e.g. tun
+}
+
+
+def interface_type(interface):
+    """
+    :param interface: network interface name
+    :return: ARPHRD type of the interface
+    """
+    with open("/sys/class/net/%s/type" % interface) as type_file:
+        return int(type_file.read())
+
+
+def capture_interface(interface, stop=None):
+    """
+    Capture every frame on an interface from a packet socket, instead of through tshark and a
+    capture file. Needs root (or CAP_NET_RAW); put a wireless card in monitor mode first to see
+    other stations' frames.
+    :param interface: network interface name
+    :param stop: threading.Event that ends the capture, None to capture until the generator is
+                 closed
+    :return: generator of (linktype, time stamp in seconds, frame bytes)
+    """
+    arphrd = interface_type(interface)
+    if arphrd not in ARPHRD_LINKTYPES:
+        raise ValueError(
+            "can not capture on %s, interface type %d" % (interface, arphrd)
+        )
+    linktype = ARPHRD_LINKTYPES[arphrd]
+    # loopback hands every packet to the socket twice, going out and coming in
+    skip_outgoing = arphrd == ARPHRD_LOOPBACK
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+        sock.bind((interface, 0))
+        sock.settimeout(TIMEOUT)
+        while stop is None or not stop.is_set():
+            try:
+                frame, address = sock.recvfrom(SNAP_LEN)
+            except socket.timeout:
+                continue
+            if skip_outgoing and address[2] == socket.PACKET_OUTGOING:
+                continue
+            yield linktype, time.time(), frame
+    finally:
+        sock.close()
@@ -1,49 +1,230 @@
-import pyshark
-import struct
-import sys
-import signal
+import argparse
+import json
 import os
+import signal
+import sys
+import threading
+import time
+
+import Dedup
+import Dissect
+import Pcap_Reader
+
+# framing of Alice's chunks lives in COMMON
+COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "COMMON")
+sys.path.append(COMMON_DIR)
+import Framing
+
+PORT = 5005  # Bob's port
+STATS_INTERVAL = 1.0  # seconds between running counters when following or live
+
+
+class Sniffer:
+    """
+    Eve's handling of captured frames: keep the datagrams to Bob's port, drop retransmissions and
+    write the payloads, one frame at a time. The same code runs on a finished capture, on one that
+    is still being written and on a live interface.
+    """
+
+    def __init__(self, write_file, port=PORT):
+        """
+        :param write_file: opened binary file the payloads are written to
+        :param port: UDP port of the datagrams to keep
+        """
+        self.write_file = write_file
+        self.port = port
+        self.dedup = Dedup.Deduplicator()
+        self.frames = 0  # captured frames looked at
+        self.received = 0  # unique datagrams to port
+        self.bytes = 0  # payload bytes written
+        self.unsequenced = 0  # frames without 802.11 headers, nothing to dedup them by
+        self.started = time.monotonic()
+
+    def handle(self, linktype, frame):
+        """
+        :param linktype: link type of the capture, Dissect.LINKTYPE_*
+        :param frame: captured bytes
+        :return: True if the frame was a new datagram to port
+        """
+        self.frames += 1
+        packet = Dissect.dissect(linktype, frame)
+        if packet is None:
+            return False
+        # every data frame moves the sequence window on, not only the ones to Bob
+        if packet.seq is None:
+            self.unsequenced += 1
+        elif not self.dedup.accept(
+            packet.transmitter, packet.tid, packet.seq, packet.frag
+        ):
+            return False
+        if packet.dport != self.port:
+            return False
+
+        self.received += 1
+        payload = packet.payload
+        if Framing.parse_header(payload) is not None:
+            payload = payload[Framing.HEADER_LEN :]  # keep only Alice's text
+        self.write_file.write(payload)
+        self.bytes += len(payload)
+        return True
+
+    def snapshot(self):
+        """
+        :return: dict of the counters so far
+        """
+        elapsed = time.monotonic() - self.started
+        return {
+            "time": time.time(),
+            "elapsed": elapsed,
+            "frames": self.frames,
+            "received": self.received,
+            "bytes": self.bytes,
+            "received_rate": self.received / elapsed if elapsed > 0 else 0.0,
+            "unsequenced": self.unsequenced,
+            "dedup": self.dedup.stats(),
+        }
+
+
+def report_stats(sniffer, interval, stop, json_file=None):
+    """
+    Print the running counters (and write them as JSON lines) every interval seconds until stop is
+    set, flushing the payloads written so far
+    :param sniffer: Sniffer to report on
+    :param interval: seconds between reports
+    :param stop: threading.Event
+    :param json_file: opened text file for the JSON lines, None for none
+    :return:
+    """
+    last_received = 0
+    while not stop.wait(interval):
+        snapshot = sniffer.snapshot()
+        sniffer.write_file.flush()
+        print(
+            "Eve: %d packets (%.1f/s), %d frames, %d duplicates, %d gaps"
+            % (
+                snapshot["received"],
+                (snapshot["received"] - last_received) / interval,
+                snapshot["frames"],
+                snapshot["dedup"]["duplicates"],
+                snapshot["dedup"]["gaps"],
+            )
+        )
+        last_received = snapshot["received"]
+        if json_file is not None:
+            json_file.write(json.dumps(snapshot) + "\n")
+            json_file.flush()
 
 
 def main():
     """
-    Packet sniffer (Eve) that uses pyshark to parse the packets
+    Packet sniffer (Eve) that parses the packets itself, from a capture file after the fact, from a
+    capture file while it is written (--follow) or straight from an interface (--live)
     :return:
     """
-    if len(sys.argv) < 3:
-        print("to few arguments")
-        return
-    if len(sys.argv) > 3:
-        print("to many arguments")
+    parser = argparse.ArgumentParser(
+        description="Eve: get Alice's payload out of captured packets"
+    )
+    parser.add_argument("capture", help="pcap/pcapng file, or interface with --live")
+    parser.add_argument("output", help="file the payloads are written to")
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="keep reading the capture file as it grows until CTRL-C",
+    )
+    parser.add_argument(
+        "--live",
+        action="store_true",
+        help="capture on the interface given instead of a file (needs root)",
+    )
+    parser.add_argument(
+        "--port", type=int, default=PORT, help="Bob's port (default %d)" % PORT
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=None,
+        help="seconds between running counters, 0 for none (default %.0f when following or "
+        "live, none otherwise)" % STATS_INTERVAL,
+    )
+    parser.add_argument(
+        "--stats-json",
+        help="also write the running counters as JSON lines to this file",
+    )
+    args = parser.parse_args()
 
-    cap_file = sys.argv[1]
-    write_file = sys.argv[2]
+    streaming = args.follow or args.live
+    if args.stats_interval is None:
+        args.stats_interval = STATS_INTERVAL if streaming else 0
 
     try:
-        print("Opening write file:",write_file)
-        write_file = open(write_file,'w')
+        print("Opening write file:", args.output)
+        write_file = open(args.output, "wb")
     except IOError:
         print("couldn't open write file")
+        return
 
-    print("Opening capture file:",cap_file)
-    capture = pyshark.FileCapture(cap_file,display_filter="udp && not dns && not mdns")
+    if args.live:
+        import Live_Capture  # packet sockets only exist on Linux
 
-    packets_received = 0
-    prev = ''
+        print("Capturing on:", args.capture)
+        packets = Live_Capture.capture_interface(args.capture)
+    elif args.follow:
+        print("Following capture file:", args.capture)
+        packets = Pcap_Reader.follow_capture(args.capture)
+    else:
+        print("Opening capture file:", args.capture)
+        packets = Pcap_Reader.iter_capture(Pcap_Reader.open_capture(args.capture))
 
-    print("Processing capture file")
-    for packet in capture:
-        if 'udp' in packet:
-            if packet['udp'].dstport == '5005':
-                if prev == packet.wlan.seq:
-                   continue
+    sniffer = Sniffer(write_file, args.port)
+    stop = threading.Event()
+    reporter = None
+    json_file = None
+    if args.stats_interval > 0:
+        if args.stats_json is not None:
+            json_file = open(args.stats_json, "w")
+        reporter = threading.Thread(
+            target=report_stats,
+            args=(sniffer, args.stats_interval, stop, json_file),
+            daemon=True,
+        )
+        reporter.start()
 
-                packets_received += 1
-                prev = packet.wlan.seq
-                write_file.write(bytes.fromhex(packet["data"].data).decode())
+    # stop on SIGINT even when started in the background, where it is ignored by default
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    print("Processing capture" + (", CTRL-C to stop" if streaming else ""))
+    try:
+        for linktype, _, frame in packets:
+            sniffer.handle(linktype, frame)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        packets.close()
+        stop.set()
+        if reporter is not None:
+            reporter.join()
+        if json_file is not None:
+            json_file.write(json.dumps(sniffer.snapshot()) + "\n")
+            json_file.close()
 
     write_file.close()
-    print("Received packets:", packets_received)
+    print("Received packets:", sniffer.received)
+    print_dedup(sniffer.dedup, sniffer.unsequenced)
+
+
+def print_dedup(dedup, unsequenced=0):
+    """
+    Print the duplicate/gap counts, in total and per transmitter and TID
+    :param dedup: Dedup.Deduplicator the frames went through
+    :param unsequenced: frames without 802.11 sequence numbers
+    :return:
+    """
+    line = "{frames} data frames: {unique} unique, {duplicates} duplicates, "
+    line += "{gaps} gaps, {out_of_order} out of order, {resyncs} sequence restarts"
+    print("All", line.format(**dedup.stats()))
+    for (transmitter, tid), counts in sorted(dedup.stream_stats().items()):
+        print("  %s TID %d:" % (transmitter.hex(":"), tid), line.format(**counts))
+    if unsequenced:
+        print("Frames without 802.11 sequence numbers (not deduplicated):", unsequenced)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+import mmap
+import os
+import struct
+import time
+
+PCAP_MAGIC = 0xA1B2C3D4  # classic pcap, microsecond time stamps
+PCAP_MAGIC_NS = 0xA1B23C4D  # classic pcap, nanosecond time stamps
+PCAPNG_SHB = 0x0A0D0D0A  # section header block, starts a pcapng file
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# pcapng block types
+PCAPNG_IDB = 1  # interface description
+PCAPNG_PB = 2  # packet block (obsolete)
+PCAPNG_SPB = 3  # simple packet block
+PCAPNG_EPB = 6  # enhanced packet block
+IF_TSRESOL = 9  # interface option with the time stamp resolution
+
+FOLLOW_POLL = 0.1  # seconds between looks at the end of a capture that is being written
+READ_CHUNK = 1 << 20  # bytes read from a followed capture at a time
+
+# magic, version, thiszone, sigfigs, snaplen, linktype
+PCAP_HEADER = struct.Struct("IHHiIII")
+# seconds, fraction, captured length, original length
+PCAP_RECORD = struct.Struct("IIII")
+
+
+def open_capture(file_name):
+    """
+    Map a capture file into memory
+    :param file_name: pcap or pcapng file
+    :return: read only buffer with the whole file
+    """
+    with open(file_name, "rb") as capture_file:
+        try:
+            return mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b""  # an empty file can not be mapped
+
+
+def _tsresol(buf, offset, end, endian):
+    # time stamp resolution in seconds from the options of an interface description block
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + "HH", buf, offset)
+        if code == 0:
+            break
+        if code == IF_TSRESOL and length >= 1:
+            value = buf[offset + 4]
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0**-value
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+class CaptureParser:
+    """
+    Parses a pcap or pcapng capture one piece at a time. The format, byte order and interfaces are
+    kept between pieces, so a capture can be read while it is still being written.
+    """
+
+    def __init__(self):
+        self.format = None  # "pcap" or "pcapng" once the start of the capture was seen
+        self.endian = "<"
+        self.linktype = None  # of a pcap file
+        self.scale = 1e-6  # seconds per time stamp fraction of a pcap file
+        self.record = None
+        self.interfaces = []  # (linktype, time stamp resolution) per pcapng interface
+        self.consumed = 0
+
+    def packets(self, buf):
+        """
+        :param buf: capture bytes, starting where the bytes consumed by the last call ended
+        :return: generator of (linktype, time stamp in seconds or None, frame bytes) for every
+                 complete packet in buf; consumed counts the bytes of buf used so far
+        """
+        self.consumed = 0
+        if self.format is None:
+            if len(buf) < 4:
+                return
+            if struct.unpack_from("<I", buf)[0] == PCAPNG_SHB:
+                self.format = "pcapng"
+            else:
+                if len(buf) < PCAP_HEADER.size:
+                    return
+                self._pcap_header(buf)
+                self.consumed = PCAP_HEADER.size
+        if self.format == "pcap":
+            yield from self._pcap(buf)
+        else:
+            yield from self._pcapng(buf)
+
+    def _pcap_header(self, buf):
+        self.format = "pcap"
+        magic = struct.unpack_from("<I", buf)[0]
+        if magic not in (PCAP_MAGIC, PCAP_MAGIC_NS):
+            self.endian = ">"
+            magic = struct.unpack_from(">I", buf)[0]
+        self.scale = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+        header = struct.Struct(self.endian + PCAP_HEADER.format)
+        self.record = struct.Struct(self.endian + PCAP_RECORD.format)
+        self.linktype = header.unpack_from(buf)[-1] & 0xFFFF  # upper bits: FCS info
+
+    def _pcap(self, buf):
+        record = self.record
+        offset = self.consumed
+        end = len(buf)
+        while offset + record.size <= end:
+            seconds, fraction, caplen, _ = record.unpack_from(buf, offset)
+            start = offset + record.size
+            if start + caplen > end:
+                return
+            offset = self.consumed = start + caplen
+            yield self.linktype, seconds + fraction * self.scale, buf[start:offset]
+
+    def _pcapng(self, buf):
+        offset = self.consumed
+        end = len(buf)
+        while offset + 12 <= end:
+            endian = self.endian
+            block_type = struct.unpack_from(endian + "I", buf, offset)[0]
+            if block_type == PCAPNG_SHB:
+                # the byte order can change with every section
+                endian = "<"
+                if struct.unpack_from("<I", buf, offset + 8)[0] != BYTE_ORDER_MAGIC:
+                    endian = ">"
+            block_len = struct.unpack_from(endian + "I", buf, offset + 4)[0]
+            if block_len < 12:
+                raise ValueError("broken pcapng block at byte %d" % offset)
+            if offset + block_len > end:
+                return
+            block_end = offset + block_len - 4
+            packet = None
+
+            if block_type == PCAPNG_SHB:
+                self.endian = endian
+                self.interfaces = []
+            elif block_type == PCAPNG_IDB:
+                linktype = struct.unpack_from(endian + "H", buf, offset + 8)[0]
+                resolution = _tsresol(buf, offset + 16, block_end, endian)
+                self.interfaces.append((linktype, resolution))
+            elif block_type in (PCAPNG_EPB, PCAPNG_PB):
+                if block_type == PCAPNG_EPB:
+                    fields = struct.unpack_from(endian + "IIII", buf, offset + 8)
+                    interface, high, low, caplen = fields
+                else:
+                    fields = struct.unpack_from(endian + "HHIII", buf, offset + 8)
+                    interface, _, high, low, caplen = fields
+                if interface < len(self.interfaces):
+                    linktype, resolution = self.interfaces[interface]
+                    start = offset + 28
+                    frame = buf[start : min(start + caplen, block_end)]
+                    packet = linktype, ((high << 32) | low) * resolution, frame
+            elif block_type == PCAPNG_SPB and self.interfaces:
+                orig_len = struct.unpack_from(endian + "I", buf, offset + 8)[0]
+                start = offset + 12
+                frame = buf[start : min(start + orig_len, block_end)]
+                packet = self.interfaces[0][0], None, frame
+
+            offset = self.consumed = offset + block_len
+            if packet is not None:
+                yield packet
+
+
+def iter_capture(buf):
+    """
+    :param buf: contents of a pcap or pcapng file
+    :return: generator of (linktype, time stamp in seconds or None, frame bytes), stops at a
+             packet that was cut short
+    """
+    return CaptureParser().packets(buf)
+
+
+def follow_capture(file_name, follow=True, poll=FOLLOW_POLL, chunk_size=READ_CHUNK):
+    """
+    Read a capture file while it is being written, like tail -f: packets are handed out as soon
+    as they are complete, and only the part of a packet that has not been written yet is kept
+    :param file_name: pcap or pcapng file, waited for if it does not exist yet (follow only)
+    :param follow: keep waiting for more packets at the end of the file, False stops there
+                   (e.g. to replay a finished capture through the same code)
+    :param poll: seconds between looks at the end of the file
+    :param chunk_size: bytes read at a time
+    :return: generator of (linktype, time stamp in seconds or None, frame bytes)
+    """
+    while follow and not os.path.exists(file_name):
+        time.sleep(poll)
+    parser = CaptureParser()
+    pending = bytearray()
+    with open(file_name, "rb") as capture_file:
+        while True:
+            data = capture_file.read(chunk_size)
+            if not data:
+                if not follow:
+                    return
+                time.sleep(poll)
+                continue
+            pending += data
+            # the frames handed out are copies, so pending can be cut after
+            yield from parser.packets(pending)
+            del pending[: parser.consumed]
@@ -0,0 +1,107 @@
+"""
+The vectorized 10 bit CSI decoder against the loop decoder it replaced, bit for bit.
+Run with pytest or on its own: python3 tests/test_decoder.py
+"""
+
+import os
+import struct
+import sys
+
+import numpy as np
+
+ALICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ALICE")
+sys.path.append(ALICE_DIR)
+import CSI_Device_Sim
+import CSI_Python_Parser
+
+CONFIGS = [
+    (nr, nc, tones) for nr in (1, 2, 3) for nc in (1, 2, 3) for tones in (56, 114)
+]
+
+
+def loop_decode(buff, nr, nc, num_tones):
+    """
+    record_CSI_data as it was before it was vectorized, reading 16 bits at a time
+    :return: list of nr * nc complex arrays, nc_idx * nr + nr_idx
+    """
+    resolution = CSI_Python_Parser.BIT_RESOLUTION
+    data = [np.empty(num_tones, dtype=complex) for _ in range(nr * nc)]
+    index = 0
+    bits_left = 16
+    bit_mask = (1 << resolution) - 1
+    current_data = struct.unpack("=H", buff[index : index + 2])[0]
+    index += 2
+
+    def next_value():
+        nonlocal index, bits_left, current_data
+        if bits_left - resolution < 0:
+            current_data += struct.unpack("=H", buff[index : index + 2])[0] << bits_left
+            index += 2
+            bits_left += 16
+        value = CSI_Python_Parser.bit_convert(current_data & bit_mask, resolution)
+        bits_left -= resolution
+        current_data >>= resolution
+        return value
+
+    for tone_idx in range(num_tones):
+        for nc_idx in range(nc):
+            for nr_idx in range(nr):
+                imag = next_value()
+                real = next_value()
+                data[nc_idx * nr + nr_idx][tone_idx] = complex(real, imag)
+    return data
+
+
+def random_packed(nr, nc, num_tones, rng):
+    """
+    :return: packed CSI of random 10 bit values, padded so the loop decoder can read 16 bits past
+             the end
+    """
+    values = rng.integers(-512, 512, 2 * nr * nc * num_tones)
+    return CSI_Device_Sim.pack_CSI_bits(values) + bytes(2)
+
+
+def test_decode_matches_loop_decoder():
+    rng = np.random.default_rng(1)
+    for nr, nc, num_tones in CONFIGS:
+        buff = random_packed(nr, nc, num_tones, rng)
+        expected = np.array(loop_decode(buff, nr, nc, num_tones))
+        decoded = CSI_Python_Parser.record_CSI_data(buff, nr, nc, num_tones, True)
+        assert decoded.shape == (nr * nc, num_tones)
+        assert np.array_equal(decoded, expected), (nr, nc, num_tones)
+
+
+def test_decode_from_kernel_buffer():
+    # the kernel buffer has the CSI status and its length in front of the CSI
+    rng = np.random.default_rng(2)
+    for nr, nc, num_tones in CONFIGS:
+        buff = random_packed(nr, nc, num_tones, rng)
+        kernel = bytes(CSI_Python_Parser.CSI_ST_LEN + 2) + buff
+        expected = CSI_Python_Parser.record_CSI_data(buff, nr, nc, num_tones, True)
+        decoded = CSI_Python_Parser.record_CSI_data(kernel, nr, nc, num_tones, False)
+        assert np.array_equal(decoded, expected), (nr, nc, num_tones)
+
+
+def test_decode_batch_matches_single_packets():
+    rng = np.random.default_rng(3)
+    nr, nc, num_tones = 3, 3, 114
+    packets = [random_packed(nr, nc, num_tones, rng) for _ in range(8)]
+    raw = np.frombuffer(b"".join(packets), dtype=np.uint8).reshape(len(packets), -1)
+    batch = CSI_Python_Parser.decode_CSI_data(raw, nr, nc, num_tones)
+    for i, buff in enumerate(packets):
+        assert np.array_equal(batch[i], np.array(loop_decode(buff, nr, nc, num_tones)))
+
+
+def test_sign_extension_extremes():
+    values = np.array([-512, 511, -1, 0, 1, -511, 256, -256])
+    raw = np.frombuffer(CSI_Device_Sim.pack_CSI_bits(values), dtype=np.uint8)
+    assert (
+        CSI_Python_Parser.unpack_CSI_bits(raw, len(values)).tolist() == values.tolist()
+    )
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
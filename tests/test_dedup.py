@@ -0,0 +1,102 @@
+"""
+Eve's 802.11 deduplication: retransmissions, the sequence number wrap, late frames, restarts and
+separate streams, and a Sniffer writing every chunk of a capture with retries exactly once.
+Run with pytest or on its own: python3 tests/test_dedup.py
+"""
+
+import io
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TESTS_DIR, "..", "EVE"))
+sys.path.append(TESTS_DIR)
+import Dedup
+import Dissect
+import Packet_Sniff
+from test_pcap import TRANSMITTER, ipv4_udp, wlan_data
+
+OTHER = bytes.fromhex("020000000002")
+
+
+def accept_all(dedup, seqs, transmitter=TRANSMITTER, tid=0):
+    return [dedup.accept(transmitter, tid, seq) for seq in seqs]
+
+
+def test_retransmissions_are_dropped():
+    dedup = Dedup.Deduplicator()
+    assert accept_all(dedup, [0, 1, 1, 2, 0]) == [True, True, False, True, False]
+    stats = dedup.stats()
+    assert (stats["unique"], stats["duplicates"], stats["gaps"]) == (3, 2, 0)
+
+
+def test_fragments_are_told_apart():
+    dedup = Dedup.Deduplicator()
+    assert dedup.accept(TRANSMITTER, 0, 7, 0)
+    assert dedup.accept(TRANSMITTER, 0, 7, 1)
+    assert not dedup.accept(TRANSMITTER, 0, 7, 1)
+
+
+def test_wrap_from_4095_to_0():
+    dedup = Dedup.Deduplicator()
+    seqs = [4094, 4095, 0, 4095, 1, 0]
+    assert accept_all(dedup, seqs) == [True, True, True, False, True, False]
+    assert dedup.stats()["gaps"] == 0
+
+
+def test_gaps_and_late_frames():
+    dedup = Dedup.Deduplicator()
+    assert all(accept_all(dedup, [10, 14, 12]))
+    stats = dedup.stats()
+    assert (stats["gaps"], stats["out_of_order"]) == (2, 1)  # 11 and 13 missing
+    assert not dedup.accept(TRANSMITTER, 0, 12)
+
+
+def test_window_and_restarts():
+    dedup = Dedup.Deduplicator(window=16)
+    assert all(accept_all(dedup, [0, 100]))
+    # 0 fell out of the window, so it is taken for a transmitter that started over
+    assert dedup.accept(TRANSMITTER, 0, 0)
+    assert dedup.stats()["resyncs"] == 1
+    try:
+        Dedup.Deduplicator(window=1000)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a window that is no power of 2 was accepted")
+
+
+def test_streams_are_kept_apart():
+    dedup = Dedup.Deduplicator()
+    assert dedup.accept(TRANSMITTER, 0, 5)
+    assert dedup.accept(TRANSMITTER, 6, 5)
+    assert dedup.accept(OTHER, 0, 5)
+    assert not dedup.accept(OTHER, 0, 5)
+    assert dedup.stats()["streams"] == 3
+    assert dedup.stream_stats()[(OTHER, 0)]["duplicates"] == 1
+
+
+def test_sniffer_writes_every_chunk_once():
+    out = io.BytesIO()
+    sniffer = Packet_Sniff.Sniffer(out, port=5005)
+    chunks = [b"chunk %d " % num for num in range(6)]
+    frames = []
+    for num, chunk in enumerate(chunks):
+        seq = (4093 + num) % 4096
+        frame = wlan_data(ipv4_udp(chunk), seq)
+        frames += [frame, wlan_data(ipv4_udp(chunk), seq, retry=True)]
+    # a datagram to another port still moves the window on
+    frames.append(wlan_data(ipv4_udp(b"not for Bob", dport=53), 3))
+    for frame in frames:
+        sniffer.handle(Dissect.LINKTYPE_IEEE802_11_RADIOTAP, frame)
+    assert out.getvalue() == b"".join(chunks)
+    snapshot = sniffer.snapshot()
+    assert (snapshot["received"], snapshot["frames"]) == (6, 13)
+    assert snapshot["dedup"]["duplicates"] == 6
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
@@ -0,0 +1,170 @@
+"""
+Framing of Alice's chunks and Bob's reassembly: headers, duplicates, reordering and loss, and a
+payload sent by CSISender over loopback put back together by a Receiver.
+Run with pytest or on its own: python3 tests/test_framing.py
+"""
+
+import os
+import socket
+import sys
+
+import numpy as np
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TESTS_DIR, "..", "COMMON"))
+sys.path.append(os.path.join(TESTS_DIR, "..", "ALICE"))
+import CSI_Sender
+import Framing
+
+CHUNK = 16
+
+
+def frames(payload, seqs, session=7):
+    """
+    :return: datagrams of the chunks with the given sequence numbers, the way CSISender frames them
+    """
+    n_chunks = (len(payload) + CHUNK - 1) // CHUNK
+    datagrams = []
+    for seq in seqs:
+        offset = (seq % n_chunks) * CHUNK
+        header = Framing.pack_header(
+            session, seq, offset, len(payload), send_time=100.0
+        )
+        datagrams.append(header + payload[offset : offset + CHUNK])
+    return datagrams
+
+
+def receive_all(datagrams):
+    receiver = Framing.Receiver()
+    for datagram in datagrams:
+        receiver.receive(datagram, ("127.0.0.1", 1), recv_time=100.5)
+    return receiver
+
+
+def test_header_round_trip():
+    header = Framing.pack_header(
+        0xDEADBEEF, 5, 80, 1000, Framing.FLAG_WRAPPED, send_time=12.5
+    )
+    assert len(header) == Framing.HEADER_LEN
+    assert Framing.parse_header(header + b"chunk") == (
+        0xDEADBEEF,
+        5,
+        80,
+        1000,
+        Framing.FLAG_WRAPPED,
+        12.5,
+    )
+    assert Framing.parse_header(b"no header here, just payload") is None
+    assert Framing.parse_header(header[:-1]) is None
+
+
+def test_reassembly_with_duplicates_reordering_and_loss():
+    payload = bytes(range(256)) * 2
+    seqs = [0, 2, 1, 1, 3, 5, 4, 7, 6, 9, 8, 9, 11, 12, 13, 14, 15, 15]  # 10 lost
+    receiver = receive_all(frames(payload, seqs))
+    (session,) = receiver.sessions.values()
+    report = session.report()
+    assert report["frames"] == len(seqs)
+    assert report["unique"] == 15
+    assert report["duplicates"] == 3
+    assert report["reordered"] == 4
+    assert report["lost"] == 1
+    assert report["payload_covered"] == 15 * CHUNK
+    expected = bytearray(len(payload))
+    expected[: 16 * CHUNK] = payload[: 16 * CHUNK]
+    expected[10 * CHUNK : 11 * CHUNK] = bytes(CHUNK)
+    assert session.payload == expected
+    assert report["latency_ms_p50"] == 500.0
+
+
+def test_chunks_before_the_first_one_received():
+    payload = bytes(range(160))
+    # the first chunk to arrive is not the first one sent, and earlier ones come twice
+    receiver = receive_all(frames(payload, [5, 3, 3, 6, 0, 5, 0]))
+    (session,) = receiver.sessions.values()
+    assert session.first_seq == 0
+    assert session.unique == 4
+    assert session.duplicates == 3
+    assert session.lost() == 3  # 1, 2 and 4
+    assert session.untracked == 0
+
+
+def test_lost_never_goes_negative():
+    payload = bytes(CHUNK * 4)
+    far = Framing.MAX_SEQ_TRACKED + 10
+    # too far below the first chunk to track, so duplicates cannot be told apart
+    receiver = receive_all(frames(payload, [far, 1, 1, 1]))
+    (session,) = receiver.sessions.values()
+    assert session.untracked == 3
+    assert session.lost() == 0
+
+
+def test_sessions_and_unframed_datagrams_are_kept_apart():
+    payload = bytes(CHUNK * 2)
+    datagrams = frames(payload, [0, 1], session=1) + frames(payload, [0], session=2)
+    receiver = receive_all(datagrams + [b"bare payload"])
+    assert receiver.unframed == 1
+    assert sorted(session.unique for session in receiver.sessions.values()) == [1, 2]
+
+
+def test_oversized_payloads_and_extra_sessions_are_rejected():
+    header = Framing.pack_header(1, 0, 0, Framing.MAX_PAYLOAD_LEN + 1)
+    receiver = Framing.Receiver(max_sessions=2)
+    session, chunk = receiver.receive(header + b"chunk", ("127.0.0.1", 1))
+    assert session is None and bytes(chunk) == b"chunk"
+    for session_id in (2, 3, 4):
+        (datagram,) = frames(bytes(CHUNK), [0], session=session_id)
+        receiver.receive(datagram, ("127.0.0.1", 1))
+    # the sessions already there keep being reassembled
+    receiver.receive(frames(bytes(CHUNK * 2), [1], session=2)[0], ("127.0.0.1", 1))
+    assert receiver.rejected == 2
+    assert sorted(session.session for session in receiver.sessions.values()) == [2, 3]
+    assert receiver.sessions[(("127.0.0.1", 1), 2)].unique == 2
+    try:
+        CSI_Sender.CSISender(bytes(Framing.MAX_PAYLOAD_LEN + 1), [("127.0.0.1", 9)])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a payload Bob would not reassemble was accepted")
+
+
+def test_latency_sample_is_bounded():
+    session = Framing.Session(1, CHUNK)
+    count = Framing.LATENCY_SAMPLES * 3
+    for seq in range(count):
+        session.add(seq, 0, b"", 100.0, 100.0 + seq / count)
+    assert len(session.latencies) == Framing.LATENCY_SAMPLES
+    report = session.report()
+    # a uniform sample of latencies spread evenly over 0 to 1 s
+    assert 400 < report["latency_ms_p50"] < 600
+    assert abs(report["latency_ms_max"] - (count - 1) / count * 1000.0) < 1e-6
+
+
+def test_sender_to_receiver_over_loopback():
+    payload = np.random.default_rng(1).bytes(CHUNK * 50 + 5)
+    bob = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    bob.bind(("127.0.0.1", 0))
+    bob.settimeout(5)
+    sender = CSI_Sender.CSISender(payload, [bob.getsockname()], CHUNK, repeat=2)
+    while sender.send():
+        pass
+    sender.close()
+
+    receiver = Framing.Receiver()
+    for _ in range(sender.datagrams):
+        datagram, addr = bob.recvfrom(CHUNK + Framing.HEADER_LEN)
+        receiver.receive(datagram, addr)
+    bob.close()
+    (session,) = receiver.sessions.values()
+    assert session.payload == payload
+    assert session.unique == 51
+    assert session.duplicates == 51
+    assert session.lost() == 0
+    assert sender.exhausted == 1
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
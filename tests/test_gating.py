@@ -0,0 +1,94 @@
+"""
+The CSI gate criteria (range, variance, spread and RSSI) on hand built streams, with zero magnitude
+tones and with a stream selection that is not the first streams of the packet.
+Run with pytest or on its own: python3 tests/test_gating.py
+"""
+
+import os
+import sys
+import types
+
+import numpy as np
+
+ALICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ALICE")
+sys.path.append(ALICE_DIR)
+import CSI_Gating
+
+
+def tones(*dB):
+    # one stream with a tone of each magnitude in dB, None for a zero magnitude tone
+    return [0 if value is None else 10 ** (value / 20.0) for value in dB]
+
+
+def packet(streams, nr=2, rssi=(10, 50, 0)):
+    data = np.array(streams, dtype=np.complex64)
+    return types.SimpleNamespace(
+        data=data, nr=nr, rssi_0=rssi[0], rssi_1=rssi[1], rssi_2=rssi[2]
+    )
+
+
+def flags(criterion, threshold, csi_object, streams=None):
+    gate = CSI_Gating.CSIGate([(criterion, threshold)], streams=streams)
+    return gate.stream_flags(csi_object).tolist()
+
+
+# a 20 dB range and a 100 dB^2 variance, without and with zero magnitude tones, and no tones at all
+STREAMS = [tones(0, 20, 0, 20), tones(0, None, 20, None), tones(None, None, None, None)]
+
+
+def test_range():
+    csi_object = packet(STREAMS)
+    assert flags(CSI_Gating.db_range, 20.01, csi_object) == [True, True, False]
+    assert flags(CSI_Gating.db_range, 19.99, csi_object) == [False, False, False]
+    # a stream with a single non-zero tone has no range at all
+    assert flags(CSI_Gating.db_range, 0, packet([tones(None, 7)])) == [True]
+
+
+def test_variance():
+    csi_object = packet(STREAMS)
+    assert flags(CSI_Gating.db_variance, 100.01, csi_object) == [True, True, False]
+    assert flags(CSI_Gating.db_variance, 99.99, csi_object) == [False, False, False]
+
+
+def test_spread_ignores_the_outlying_tones():
+    dB = [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
+    stream = tones(*dB, None, None)
+    low, high = np.percentile(dB, CSI_Gating.SPREAD_PERCENTILES)
+    csi_object = packet([stream, tones(*([None] * len(stream)))])
+    spread = high - low
+    assert spread < 100  # less than the range of the stream
+    assert flags(CSI_Gating.db_spread, spread + 0.01, csi_object) == [True, False]
+    assert flags(CSI_Gating.db_spread, spread - 0.01, csi_object) == [False, False]
+
+
+def test_criteria_see_the_selected_streams():
+    # streams 0 and 2 vary by 40 dB, streams 1 and 3 are flat
+    csi_object = packet([tones(0, 40), tones(3, 3), tones(0, 40), tones(5, 5)])
+    for criterion in (
+        CSI_Gating.db_range,
+        CSI_Gating.db_variance,
+        CSI_Gating.db_spread,
+    ):
+        assert flags(criterion, 1, csi_object, (1, 3)) == [True, True]
+        assert flags(criterion, 1, csi_object, (0, 2, 7)) == [False, False]
+    gate = CSI_Gating.CSIGate([(CSI_Gating.db_range, 1)], "all", (3, 1))
+    assert gate(csi_object)
+
+
+def test_rssi_uses_the_receive_antenna_of_each_stream():
+    # nr = 2: streams 0 and 2 come in on antenna 0, streams 1 and 3 on antenna 1
+    csi_object = packet([tones(0, 0)] * 4, nr=2, rssi=(10, 50, 0))
+    assert flags(CSI_Gating.rssi, 40, csi_object) == [False, True, False, True]
+    assert flags(CSI_Gating.rssi, 40, csi_object, (1, 3)) == [True, True]
+    assert flags(CSI_Gating.rssi, 40, csi_object, (2,)) == [False]
+
+    no_antennae = packet([tones(0, 0)] * 2, nr=0)
+    assert flags(CSI_Gating.rssi, -100, no_antennae) == [False, False]
+    assert not CSI_Gating.CSIGate([(CSI_Gating.rssi, -100)], "any")(no_antennae)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
@@ -0,0 +1,117 @@
+"""
+Key extraction from CSI: the FFT Toeplitz hash against the matrix product it stands for, the
+quantization of subcarriers against their window, and KeyExtractor fed packet by packet and in
+batches.
+Run with pytest or on its own: python3 tests/test_key.py
+"""
+
+import os
+import sys
+
+import numpy as np
+
+ALICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ALICE")
+sys.path.append(ALICE_DIR)
+import CSI_Key
+
+
+def toeplitz_matrix(seed_bits, n_bits, out_len):
+    # row i holds seed_bits[i : i + n_bits] reversed, so every diagonal is constant
+    return np.array(
+        [
+            [seed_bits[row + n_bits - 1 - col] for col in range(n_bits)]
+            for row in range(out_len)
+        ],
+        dtype=np.int64,
+    )
+
+
+def test_toeplitz_hash_is_the_gf2_matrix_product():
+    rng = np.random.default_rng(3)
+    for n_bits, out_len in ((1, 1), (8, 3), (57, 20), (300, 299), (1000, 64)):
+        bits = rng.integers(0, 2, n_bits, dtype=np.uint8)
+        seed_bits = rng.integers(0, 2, n_bits + out_len - 1, dtype=np.uint8)
+        matrix = toeplitz_matrix(seed_bits, n_bits, out_len)
+        assert np.all(matrix[1:, 1:] == matrix[:-1, :-1])
+        expected = (matrix @ bits.astype(np.int64)) % 2
+        key = CSI_Key.toeplitz_hash(bits, out_len, seed_bits)
+        assert key.dtype == np.uint8
+        assert np.array_equal(key, expected), (n_bits, out_len)
+    assert len(CSI_Key.toeplitz_hash(bits, 0, seed_bits)) == 0
+
+
+def test_quantize_levels_and_guard():
+    # eight packets of one subcarrier, quantized against themselves into four levels of two
+    window = np.arange(8, dtype=np.float32)[:, np.newaxis]
+    level, keep = CSI_Key.quantize(window, window, levels=4, guard=0.2)
+    assert level[:, 0].tolist() == [0, 0, 1, 1, 2, 2, 3, 3]
+    assert keep.all()
+    # every value lies a quarter of a level from an edge, a guard of 0.6 drops all but the
+    # outer edges, which have no neighbouring level to be confused with
+    level, keep = CSI_Key.quantize(window, window, levels=4, guard=0.6)
+    assert keep[:, 0].tolist() == [True] + [False] * 6 + [True]
+
+    # tones without CSI are never kept, nor is anything quantized against a single value
+    values = np.array([[np.nan, 3.0]], dtype=np.float32)
+    _, keep = CSI_Key.quantize(values, np.tile(window, (1, 2)), levels=4, guard=0.2)
+    assert keep.tolist() == [[False, True]]
+    sparse = np.full((8, 1), np.nan, dtype=np.float32)
+    sparse[0] = 1.0
+    _, keep = CSI_Key.quantize(window[:1], sparse, levels=4, guard=0.2)
+    assert not keep.any()
+
+
+def test_gray_code_neighbours_differ_in_one_bit():
+    gray = CSI_Key.gray_bits(8)
+    assert gray.shape == (8, 3)
+    assert all(np.count_nonzero(gray[i] != gray[i + 1]) == 1 for i in range(7))
+
+
+def fading(packets, seed=1):
+    return np.concatenate(list(CSI_Key.synth_csi(2, 2, 56, packets, 32, seed=seed)))
+
+
+def test_key_extractor_batches_match_packets():
+    data = fading(512)
+    one_by_one = CSI_Key.KeyExtractor(seed=5)
+    blocks = [block for packet in data for block in one_by_one.add_packet(packet)]
+    batched = CSI_Key.KeyExtractor(seed=5)
+    batched_blocks = []
+    for first in range(0, len(data), 100):
+        batched_blocks += batched.add(data[first : first + 100])
+
+    assert blocks == batched_blocks
+    stats = batched.stats()
+    assert stats["packets"] == 512
+    assert stats["blocks"] == 512 // CSI_Key.HOP
+    # a fading channel gives key bits, packed into bytes block by block
+    assert 0 < stats["key_bits"] <= stats["raw_bits"]
+    assert blocks and all(len(block) > 0 for block in blocks)
+    padding = sum(len(block) for block in blocks) * 8 - stats["key_bits"]
+    assert 0 <= padding < 8 * len(blocks)
+    assert 0 <= stats["disagreement"] < 0.5
+
+
+def test_key_extractor_without_new_channel_gives_no_key():
+    # the same channel over and over: nothing changes between blocks, so nothing is secret
+    data = np.repeat(fading(1), 256, axis=0)
+    extractor = CSI_Key.KeyExtractor()
+    assert extractor.add(data) == []
+    assert extractor.stats()["key_bits"] == 0
+
+
+def test_key_extractor_arguments():
+    for kwargs in ({"levels": 3}, {"hop": 1}, {"hop": 65, "window": 64}):
+        try:
+            CSI_Key.KeyExtractor(**kwargs)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("KeyExtractor accepted %s" % kwargs)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
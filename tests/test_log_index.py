@@ -0,0 +1,138 @@
+"""
+The sidecar index of CSILog: written on first open, reused on reopen, extended by refresh() as
+records are appended, and rebuilt when it no longer matches the log.
+Run with pytest or on its own: python3 tests/test_log_index.py
+"""
+
+import os
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+ALICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ALICE")
+sys.path.append(ALICE_DIR)
+import CSI_Device_Sim
+import CSI_Log
+import CSI_Python_Parser
+import CSI_Read_File
+
+BUFFERS = CSI_Device_Sim.synth_buffers(2, 2, 56, variety=8, seed=0)
+
+
+def append_records(file_name, first, count):
+    """
+    Append count records to a log, starting it if it is new; record n has tfs_stamp n
+    """
+    new = not os.path.exists(file_name)
+    with open(file_name, "ab") as log_file:
+        if new:
+            CSI_Python_Parser.start_file(log_file)
+        for num in range(first, first + count):
+            buff = bytearray(BUFFERS[num % len(BUFFERS)])
+            struct.pack_into("=Q", buff, 0, num)
+            buf_len = len(buff) - 2
+            CSI_Python_Parser.to_file(
+                log_file, buff[:buf_len], buf_len, 1700000000.0 + num * 0.001
+            )
+
+
+def fresh_index(file_name):
+    # what the index has to hold, built without one
+    with CSI_Log.CSILog(file_name) as log:
+        return log.index.copy()
+
+
+def index_on_disk(file_name):
+    return np.fromfile(file_name + CSI_Log.INDEX_SUFFIX, dtype=CSI_Log.INDEX_DTYPE)
+
+
+def recording_walks(starts):
+    # find_records wrapper that notes where every walk of the log started
+    find_records = CSI_Read_File.find_records
+
+    def recording(buff, start=None):
+        starts.append(start)
+        return find_records(buff, start)
+
+    return recording
+
+
+def test_index_is_written_and_reused():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "csi.log")
+        append_records(file_name, 0, 20)
+        with CSI_Log.CSILog(file_name, use_index=True) as log:
+            assert len(log) == 20
+        assert np.array_equal(index_on_disk(file_name), fresh_index(file_name))
+
+        starts = []
+        original = CSI_Read_File.find_records
+        CSI_Read_File.find_records = recording_walks(starts)
+        try:
+            with CSI_Log.CSILog(file_name, use_index=True) as log:
+                assert len(log) == 20
+                assert [record.tfs_stamp for record in log[18:]] == [18, 19]
+        finally:
+            CSI_Read_File.find_records = original
+        # the reopened log only looked past the records the index already had
+        assert starts == [os.path.getsize(file_name)]
+
+
+def test_refresh_extends_the_index():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "csi.log")
+        append_records(file_name, 0, 5)
+        with CSI_Log.CSILog(file_name, use_index=True) as log:
+            append_records(file_name, 5, 7)
+            assert log.refresh() == 12
+            append_records(file_name, 12, 3)
+            assert log.refresh() == 15
+            assert log[-1].tfs_stamp == 14
+        assert np.array_equal(index_on_disk(file_name), fresh_index(file_name))
+
+
+def test_stale_index_is_rebuilt():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "csi.log")
+        append_records(file_name, 0, 10)
+        CSI_Log.CSILog(file_name, use_index=True).close()
+
+        # a new log under the same name, its records do not match the old index
+        os.remove(file_name)
+        append_records(file_name, 100, 12)
+        with CSI_Log.CSILog(file_name, use_index=True) as log:
+            assert len(log) == 12
+            assert log[0].tfs_stamp == 100
+        assert np.array_equal(index_on_disk(file_name), fresh_index(file_name))
+
+
+def test_truncated_log_and_index_are_rebuilt():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "csi.log")
+        append_records(file_name, 0, 10)
+        CSI_Log.CSILog(file_name, use_index=True).close()
+
+        # the log lost part of its last record: the index points past its end
+        with open(file_name, "r+b") as log_file:
+            log_file.truncate(os.path.getsize(file_name) - 10)
+        with CSI_Log.CSILog(file_name, use_index=True) as log:
+            assert len(log) == 9
+        assert np.array_equal(index_on_disk(file_name), fresh_index(file_name))
+
+        # the index lost part of its last entry: it is rewritten whole
+        index_name = file_name + CSI_Log.INDEX_SUFFIX
+        with open(index_name, "r+b") as index_file:
+            index_file.truncate(os.path.getsize(index_name) - 5)
+        with CSI_Log.CSILog(file_name, use_index=True) as log:
+            assert len(log) == 9
+        assert os.path.getsize(index_name) == 9 * CSI_Log.INDEX_DTYPE.itemsize
+        assert np.array_equal(index_on_disk(file_name), fresh_index(file_name))
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
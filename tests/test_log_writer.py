@@ -0,0 +1,128 @@
+"""
+The background log writer: rotation by size and by time into numbered files that are each a
+complete log, partly filled batches written on a timer, and records dropped while every batch
+waits on disk.
+Run with pytest or on its own: python3 tests/test_log_writer.py
+"""
+
+import glob
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+ALICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ALICE")
+sys.path.append(ALICE_DIR)
+import CSI_Device_Sim
+import CSI_Log
+import CSI_Log_Writer
+
+BUFFERS = CSI_Device_Sim.synth_buffers(2, 2, 56, variety=8, seed=0)
+
+
+def write_records(writer, first, count):
+    """
+    :return: what write() returned for each record; record n has tfs_stamp n
+    """
+    accepted = []
+    for num in range(first, first + count):
+        buff = bytearray(BUFFERS[num % len(BUFFERS)])
+        struct.pack_into("=Q", buff, 0, num)
+        accepted.append(writer.write(buff, len(buff) - 2, 1700000000.0 + num * 0.001))
+    return accepted
+
+
+def log_files(file_name):
+    # the log and its rotated files in the order they were written
+    rotated = glob.glob(glob.escape(file_name) + ".*")
+    return [file_name] + sorted(rotated, key=lambda name: int(name.rsplit(".", 1)[1]))
+
+
+def stamps(file_name):
+    with CSI_Log.CSILog(file_name) as log:
+        return [record.tfs_stamp for record in log]
+
+
+def test_rotate_by_size():
+    record_len = CSI_Log_Writer.CSI_Python_Parser.BINARY_LOG_PREFIX_STRUCT.size + (
+        len(BUFFERS[0]) - 2
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "csi.log")
+        # batches of 4 records, room for 2 batches in a file and enough batches for all records
+        writer = CSI_Log_Writer.CSILogWriter(
+            file_name,
+            batch_size=4 * record_len,
+            rotate_bytes=8 * record_len + 100,
+            fsync="rotate",
+            max_batches=11,
+        )
+        assert all(write_records(writer, 0, 40))
+        writer.close()
+
+        files = log_files(file_name)
+        assert len(files) == 5
+        assert all(len(stamps(name)) == 8 for name in files)
+        assert sum((stamps(name) for name in files), []) == list(range(40))
+        assert (writer.records, writer.dropped) == (40, 0)
+
+
+def test_rotate_by_time():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "csi.log")
+        writer = CSI_Log_Writer.CSILogWriter(
+            file_name, flush_interval=0.02, rotate_seconds=0.05
+        )
+        # holding the lock keeps the timer from splitting a lot of records across files
+        with writer.lock:
+            write_records(writer, 0, 5)
+        time.sleep(0.2)
+        with writer.lock:
+            write_records(writer, 5, 5)
+        writer.close()
+
+        # the second lot of records went to a new file once the first was old enough
+        files = log_files(file_name)
+        assert [stamps(name) for name in files] == [list(range(5)), list(range(5, 10))]
+
+
+def test_partial_batch_is_written_after_the_flush_interval():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "csi.log")
+        writer = CSI_Log_Writer.CSILogWriter(file_name, flush_interval=0.05)
+        write_records(writer, 0, 3)
+        deadline = time.monotonic() + 5
+        while writer.bytes_written == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert stamps(file_name) == [0, 1, 2]
+        writer.close()
+
+
+def test_records_are_dropped_while_every_batch_waits_on_disk():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "csi.log")
+        writer = CSI_Log_Writer.CSILogWriter(file_name, batch_size=1, max_batches=2)
+        release = threading.Event()
+        write_batch = writer._write_batch
+
+        def slow_write_batch(batch, length):
+            release.wait()
+            write_batch(batch, length)
+
+        writer._write_batch = slow_write_batch
+        # every record fills a batch, and nothing is free until the first one is written
+        accepted = write_records(writer, 0, 4)
+        release.set()
+        writer.close()
+        assert accepted == [True, True, False, False]
+        assert (writer.records, writer.dropped) == (2, 2)
+        assert stamps(file_name) == [0, 1]
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
@@ -0,0 +1,243 @@
+"""
+Eve's native capture parsing: pcap and pcapng files built here byte by byte, read whole, in pieces
+and followed while they are written, and the frames dissected down to their UDP datagrams.
+Run with pytest or on its own: python3 tests/test_pcap.py
+"""
+
+import os
+import struct
+import sys
+import tempfile
+
+EVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "EVE")
+sys.path.append(EVE_DIR)
+import Dissect
+import Pcap_Reader
+
+ALICE_IP = bytes([10, 10, 0, 2])
+BOB_IP = bytes([10, 10, 0, 3])
+TRANSMITTER = bytes.fromhex("020000000001")
+
+
+def ipv4_udp(payload, sport=40000, dport=5005, flags_fragment=0):
+    udp = struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+    ip = struct.pack(
+        "!BBHHHBBH4s4s",
+        0x45,
+        0,
+        20 + len(udp),
+        1,
+        flags_fragment,
+        64,
+        Dissect.IPPROTO_UDP,
+        0,
+        ALICE_IP,
+        BOB_IP,
+    )
+    return ip + udp
+
+
+def ethernet(ip, vlan=False):
+    header = bytes(12)
+    if vlan:
+        header += struct.pack("!HH", Dissect.ETHERTYPE_VLAN, 7)
+    return header + struct.pack("!H", Dissect.ETHERTYPE_IPV4) + ip
+
+
+def wlan_data(ip, seq, qos=True, retry=False, protected=False):
+    """
+    :return: radiotap header and an 802.11 data frame carrying ip
+    """
+    subtype = Dissect.SUBTYPE_QOS if qos else 0
+    flags = Dissect.FLAG_TO_DS
+    if retry:
+        flags |= Dissect.FLAG_RETRY
+    if protected:
+        flags |= Dissect.FLAG_PROTECTED
+    header = struct.pack(
+        "<BBH6s6s6sH",
+        Dissect.TYPE_DATA << 2 | subtype << 4,
+        flags,
+        0,
+        bytes(6),
+        TRANSMITTER,
+        bytes(6),
+        seq << 4,
+    )
+    if qos:
+        header += struct.pack("<H", 5)  # TID 5
+    radiotap = struct.pack("<BBHI", 0, 0, 8, 0)
+    return radiotap + header + Dissect.LLC_SNAP + b"\x08\x00" + ip
+
+
+def pcap_file(linktype, frames, endian="<", nanoseconds=False):
+    magic = Pcap_Reader.PCAP_MAGIC_NS if nanoseconds else Pcap_Reader.PCAP_MAGIC
+    data = struct.pack(endian + "IHHiIII", magic, 2, 4, 0, 0, 65535, linktype)
+    for num, frame in enumerate(frames):
+        fraction = 500000000 if nanoseconds else 500000
+        data += struct.pack(
+            endian + "IIII", 100 + num, fraction, len(frame), len(frame)
+        )
+        data += frame
+    return data
+
+
+def _block(endian, block_type, body):
+    body += bytes(-len(body) % 4)
+    length = 12 + len(body)
+    return (
+        struct.pack(endian + "II", block_type, length)
+        + body
+        + struct.pack(endian + "I", length)
+    )
+
+
+def pcapng_section(linktype, frames, endian="<", tsresol=None):
+    """
+    :return: section header, one interface and an enhanced packet block per frame, then one
+             simple packet block with the first frame again
+    """
+    data = _block(
+        endian,
+        Pcap_Reader.PCAPNG_SHB,
+        struct.pack(endian + "IHHq", Pcap_Reader.BYTE_ORDER_MAGIC, 1, 0, -1),
+    )
+    options = b""
+    if tsresol is not None:
+        options = struct.pack(endian + "HHB3x", Pcap_Reader.IF_TSRESOL, 1, tsresol)
+        options += struct.pack(endian + "HH", 0, 0)
+    data += _block(
+        endian,
+        Pcap_Reader.PCAPNG_IDB,
+        struct.pack(endian + "HHI", linktype, 0, 65535) + options,
+    )
+    for num, frame in enumerate(frames):
+        stamp = (100 + num) * (10**9 if tsresol == 9 else 10**6)
+        high, low = stamp >> 32, stamp & 0xFFFFFFFF
+        body = struct.pack(endian + "IIIII", 0, high, low, len(frame), len(frame))
+        data += _block(endian, Pcap_Reader.PCAPNG_EPB, body + frame)
+    data += _block(
+        endian,
+        Pcap_Reader.PCAPNG_SPB,
+        struct.pack(endian + "I", len(frames[0])) + frames[0],
+    )
+    return data
+
+
+FRAMES = [ethernet(ipv4_udp(b"chunk %d" % num)) for num in range(5)]
+
+
+def test_pcap_both_byte_orders_and_resolutions():
+    for endian in "<>":
+        for nanoseconds in (False, True):
+            data = pcap_file(Dissect.LINKTYPE_ETHERNET, FRAMES, endian, nanoseconds)
+            packets = list(Pcap_Reader.iter_capture(data))
+            assert [frame for _, _, frame in packets] == FRAMES
+            assert {linktype for linktype, _, _ in packets} == {1}
+            assert [stamp for _, stamp, _ in packets] == [
+                100.5 + num for num in range(len(FRAMES))
+            ]
+
+
+def test_pcapng_sections_with_their_own_byte_order():
+    little = pcapng_section(Dissect.LINKTYPE_ETHERNET, FRAMES, "<")
+    big = pcapng_section(Dissect.LINKTYPE_IEEE802_11_RADIOTAP, FRAMES[:2], ">", 9)
+    packets = list(Pcap_Reader.iter_capture(little + big))
+    linktypes = [linktype for linktype, _, _ in packets]
+    assert linktypes == [1] * 6 + [127] * 3
+    expected = FRAMES + FRAMES[:1] + FRAMES[:2] + FRAMES[:1]
+    assert [frame for _, _, frame in packets] == expected
+    stamps = [stamp for _, stamp, _ in packets]
+    assert stamps[:5] == [100.0 + num for num in range(5)]
+    assert stamps[5] is None  # simple packet blocks have no time stamp
+    assert stamps[6:8] == [100.0, 101.0]
+
+
+def test_a_packet_cut_short_ends_the_capture():
+    for data in (
+        pcap_file(Dissect.LINKTYPE_ETHERNET, FRAMES),
+        pcapng_section(Dissect.LINKTYPE_ETHERNET, FRAMES),
+    ):
+        packets = list(Pcap_Reader.iter_capture(data[:-3]))
+        assert len(packets) == len(list(Pcap_Reader.iter_capture(data))) - 1
+
+
+def test_parsing_in_pieces_gives_the_same_packets():
+    for data in (
+        pcap_file(Dissect.LINKTYPE_ETHERNET, FRAMES),
+        pcapng_section(Dissect.LINKTYPE_ETHERNET, FRAMES),
+    ):
+        expected = [bytes(frame) for _, _, frame in Pcap_Reader.iter_capture(data)]
+        parser = Pcap_Reader.CaptureParser()
+        pending = bytearray()
+        frames = []
+        for start in range(0, len(data), 7):
+            pending += data[start : start + 7]
+            frames += [bytes(frame) for _, _, frame in parser.packets(pending)]
+            del pending[: parser.consumed]
+        assert frames == expected
+
+
+def test_follow_capture_of_a_finished_file():
+    data = pcapng_section(Dissect.LINKTYPE_ETHERNET, FRAMES)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "eve.pcapng")
+        with open(file_name, "wb") as capture_file:
+            capture_file.write(data)
+        packets = list(Pcap_Reader.follow_capture(file_name, False, chunk_size=50))
+        assert [bytes(frame) for _, _, frame in packets] == FRAMES + FRAMES[:1]
+        mapped = Pcap_Reader.open_capture(file_name)
+        assert len(list(Pcap_Reader.iter_capture(mapped))) == len(packets)
+
+
+def test_dissect_wired_link_types():
+    ip = ipv4_udp(b"payload", 1234, 5005)
+    frames = {
+        Dissect.LINKTYPE_ETHERNET: ethernet(ip),
+        Dissect.LINKTYPE_LINUX_SLL: bytes(14) + struct.pack("!H", 0x0800) + ip,
+        Dissect.LINKTYPE_RAW: ip + bytes(4),  # padding after the datagram
+    }
+    for linktype, frame in frames.items():
+        packet = Dissect.dissect(linktype, frame)
+        assert packet.transmitter is None
+        assert (packet.src, packet.dst) == (ALICE_IP, BOB_IP)
+        assert (packet.sport, packet.dport) == (1234, 5005)
+        assert bytes(packet.payload) == b"payload"
+    vlan = Dissect.dissect(Dissect.LINKTYPE_ETHERNET, ethernet(ip, vlan=True))
+    assert bytes(vlan.payload) == b"payload"
+    fragment = ipv4_udp(b"payload", flags_fragment=0x2000)
+    assert Dissect.dissect(Dissect.LINKTYPE_ETHERNET, ethernet(fragment)) is None
+    assert Dissect.dissect(Dissect.LINKTYPE_ETHERNET, bytes(12) + b"\x86\xdd") is None
+
+
+def test_dissect_80211_data_frames():
+    ip = ipv4_udp(b"chunk")
+    packet = Dissect.dissect(
+        Dissect.LINKTYPE_IEEE802_11_RADIOTAP, wlan_data(ip, 4095, retry=True)
+    )
+    # transmitter, tid, seq, frag
+    assert packet[:4] == (TRANSMITTER, 5, 4095, 0)
+    assert packet.retry
+    assert bytes(packet.payload) == b"chunk"
+
+    plain = Dissect.dissect(
+        Dissect.LINKTYPE_IEEE802_11, wlan_data(ip, 7, qos=False)[8:]
+    )
+    assert (plain.tid, plain.seq, bytes(plain.payload)) == (0, 7, b"chunk")
+
+    # encrypted: the sequence number can still be tracked, the datagram not
+    protected = Dissect.dissect(
+        Dissect.LINKTYPE_IEEE802_11_RADIOTAP, wlan_data(ip, 8, protected=True)
+    )
+    assert protected.seq == 8 and protected.payload is None
+
+    beacon = bytearray(wlan_data(ip, 9))
+    beacon[8] = 0x80  # management frame
+    assert Dissect.dissect(Dissect.LINKTYPE_IEEE802_11_RADIOTAP, bytes(beacon)) is None
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
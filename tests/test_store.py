@@ -0,0 +1,172 @@
+"""
+Round trip of decoded CSI through the chunked store: written packet by packet, in batches and
+converted from a raw log, read back through StoreView.
+Run with pytest or on its own: python3 tests/test_store.py
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import numpy as np
+
+ALICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ALICE")
+sys.path.append(ALICE_DIR)
+import CSI_Device_Sim
+import CSI_Python_Parser
+import CSI_Read_File
+import CSI_Store
+
+
+def random_csi(rng, streams, tones):
+    shape = (streams, tones)
+    return (
+        rng.integers(-512, 512, shape) + 1j * rng.integers(-512, 512, shape)
+    ).astype(np.complex64)
+
+
+def status(num):
+    # header fields of one packet the way record_status gives them
+    csi_object = types.SimpleNamespace(time_stamp=1700000000.0 + num * 0.001)
+    for column, _ in CSI_Store.STORE_COLUMNS:
+        if column != "time_stamp":
+            setattr(csi_object, column, num % 100)
+    return csi_object
+
+
+def test_append_round_trip_with_mixed_configs():
+    rng = np.random.default_rng(1)
+    # 3x3 packets fill the first chunk, then smaller ones reuse its rows
+    shapes = [(9, 114)] * 3 + [(1, 56), (4, 56), (9, 114), (1, 56)]
+    packets = [random_csi(rng, *shape) for shape in shapes]
+    with tempfile.TemporaryDirectory() as store_dir:
+        writer = CSI_Store.CSIStoreWriter(store_dir, chunk_size=3)
+        for num, data in enumerate(packets):
+            writer.append(status(num), data)
+        writer.append(status(len(packets)), None)  # a packet without CSI
+        writer.close()
+
+        store = CSI_Store.load_store(store_dir)
+        assert len(store) == len(packets) + 1
+        assert len(store.chunks) == 3
+        data, header = store.concatenate()
+        assert data.shape == (len(packets) + 1, 9, 114)
+        for num, packet in enumerate(packets):
+            expected = np.zeros((9, 114), dtype=np.complex64)
+            expected[: packet.shape[0], : packet.shape[1]] = packet
+            assert np.array_equal(data[num], expected), num
+        assert not data[-1].any()
+        assert header["nr"].tolist() == [num % 100 for num in range(len(packets) + 1)]
+        assert header["time_stamp"][1] - header["time_stamp"][0] == np.timedelta64(
+            1000, "us"
+        )
+
+
+def test_view_gathers_across_chunks_without_copying():
+    rng = np.random.default_rng(2)
+    data = np.stack([random_csi(rng, 4, 56) for _ in range(10)])
+    header = {
+        column: np.arange(10).astype(dtype) for column, dtype in CSI_Store.STORE_COLUMNS
+    }
+    with tempfile.TemporaryDirectory() as store_dir:
+        writer = CSI_Store.CSIStoreWriter(store_dir, chunk_size=4)
+        writer.append_many(data, header)
+        writer.close()
+
+        store = CSI_Store.load_store(store_dir)
+        assert len(store) == 10
+        # uncompressed chunks stay memory mapped
+        assert all(
+            isinstance(chunk[CSI_Store.DATA_COLUMN], np.memmap)
+            for chunk in store.chunks
+        )
+        rows = [9, 0, 5, 4, 3]
+        assert np.array_equal(store.data(rows), data[rows])
+        assert np.array_equal(store.data(slice(3, 7)), data[3:7])
+        assert np.array_equal(store.data(2), data[2:3])
+        assert store.column("payload_len", rows).tolist() == rows
+        chunk_lengths = [len(chunk_data) for chunk_data, _ in store.iter_chunks()]
+        assert chunk_lengths == [4, 4, 2]
+
+
+def test_convert_log_matches_decoded_log():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_name = os.path.join(tmp_dir, "csi.log")
+        buffers = CSI_Device_Sim.synth_buffers(2, 2, 56, seed=0)
+        with open(log_name, "wb") as log_file:
+            CSI_Python_Parser.start_file(log_file)
+            for num, buff in enumerate(buffers):
+                buf_len = len(buff) - 2
+                CSI_Python_Parser.to_file(
+                    log_file, buff[:buf_len], buf_len, 1700000000.0 + num * 0.001
+                )
+
+        for compress in (False, True):
+            store_dir = os.path.join(tmp_dir, "store_%d" % compress)
+            count = CSI_Store.convert_log(log_name, store_dir, 16, compress)
+            assert count == len(buffers)
+            expected, headers = CSI_Read_File.parse_info_bulk(log_name)
+            data, header = CSI_Store.load_store(store_dir).concatenate()
+            assert np.array_equal(data, expected)
+            assert np.array_equal(header["payload_len"], headers["payload_len"])
+            assert np.array_equal(
+                header["time_stamp"], CSI_Read_File.header_times(headers)
+            )
+
+
+def test_partial_chunk_is_written_after_the_flush_interval():
+    with tempfile.TemporaryDirectory() as store_dir:
+        writer = CSI_Store.CSIStoreWriter(
+            store_dir, chunk_size=100, flush_interval=0.05
+        )
+        for num in range(5):
+            writer.append(status(num), np.ones((2, 56), dtype=np.complex64))
+        deadline = time.monotonic() + 5
+        while not CSI_Store.list_chunks(store_dir) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # on disk without close(), and the writer still takes packets afterwards
+        assert len(CSI_Store.load_store(store_dir)) == 5
+        writer.append(status(5), None)
+        writer.close()
+        assert len(CSI_Store.load_store(store_dir)) == 6
+
+
+def test_packets_are_dropped_while_every_chunk_waits_on_disk():
+    write_chunk = CSI_Store.write_chunk
+    release = threading.Event()
+
+    def slow_write_chunk(*args):
+        release.wait()
+        write_chunk(*args)
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        CSI_Store.write_chunk = slow_write_chunk
+        try:
+            writer = CSI_Store.CSIStoreWriter(store_dir, chunk_size=2, max_chunks=2)
+            accepted = [writer.append(status(num), None) for num in range(6)]
+            release.set()
+            writer.close()
+        finally:
+            CSI_Store.write_chunk = write_chunk
+        # two chunks fill up, then nothing is free until the first one is written
+        assert accepted == [True] * 4 + [False] * 2
+        assert (writer.records, writer.dropped) == (4, 2)
+        assert len(CSI_Store.load_store(store_dir)) == 4
+
+
+def test_empty_store():
+    with tempfile.TemporaryDirectory() as store_dir:
+        CSI_Store.CSIStoreWriter(store_dir).close()
+        store = CSI_Store.load_store(store_dir)
+        assert len(store) == 0
+        assert store.data().shape == (0, 0, 0)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")